@@ -49,6 +49,10 @@ module CoExpression
     string p_value;/*p_value is the p-value of the statistical significance of differential expression*/
     string method;/*method is the method used for identification of differentially expressed genes*/
     string num_genes;/*num_gene is user for specify how many differentially expressed genes are needed*/
+    string engine;/*engine is 'R' (default) to run the coex_filter tool or 'native' to compute the statistics in process*/
+    string correction;/*correction is the multiple testing correction of the native engine: 'BH', 'bonferroni' or 'none' (default 'none' for anova and 'BH' for lor)*/
+    string selection;/*selection is the num_features rule of the native engine: 'coex_filter' (default) picks exactly the genes coex_filter does, 'top' the genes with the smallest p-values*/
+    string output_mode;/*output_mode of filter_genes is 'matrix' (default) to save a copy of the selected rows or 'index' to save a CoExpression.FilteredExpressionMatrix with only their positions in the input matrix version; index outputs are internal to CoExpression: only its methods read them (other apps, the narrative methods and coex-filter-genes cannot), and the clusters of const_coex_net_clust refer to their source ExpressionMatrix; 'index' is refused unless the deployment sets index_output=true*/
   } FilterGenesParams;
 
   typedef structure {	  
@@ -59,6 +63,7 @@ module CoExpression
 
   /* Description of diff_p_distribution:
     diff_p_distribution provides the function to generate p-value distribution as png or MAK.FloatDataTable object.
+    With engine 'native' the p-values are computed in process and the MAK.FloatDataTable holds the counts of the binned -log2(p-value) histogram, one column per bin, with plot_type 'bar'.
   */   
   async funcdef diff_p_distribution(FilterGenesParams args) returns (FigureProperties result);
   
@@ -74,9 +79,12 @@ module CoExpression
     ws_expression_matrix_id inobj_id; /* series object id */
     string outobj_id; /*outobj_id is the output object id*/
     string cut_off; /*cut_off is the statistical threshold to define a coexpression relationship*/
-    string net_method; /*net_method is the method to construct coexpression network. Currently, two methods have been implemented: WGCNA(Weighted Gene Co-Expression Network) and simple PCC-based approach*/
+    string net_method; /*net_method is the method to construct coexpression network. Currently, two methods have been implemented: WGCNA(Weighted Gene Co-Expression Network) and simple PCC-based approach. 'spearman' and 'bicor' (biweight midcorrelation) select robust kernels for the simple network, and 'WGCNA-spearman' and 'WGCNA-bicor' for the WGCNA network*/
     string clust_method; /*clust_method is the method to identify network clusters. Currently, two methods have been implemented:  WGCNA(Weighted Gene Co-Expression Network) and hclust(Hierarchical clustering)*/
     string num_modules; /*num_modules is used to define the number of modules need to be identified from the network*/
+    string engine; /*engine is 'R' (default) to run coex_cluster2, 'native' to select the soft threshold power, build the network and cluster in process; the WGCNA tree is still cut by cutreeDynamic in coex_cluster2*/
+    string power_engine; /*power_engine is 'R' (default) to let coex_cluster2 run pickSoftThreshold or 'native' to select the WGCNA power in process and pass it to coex_cluster2; the native engine always selects it in process*/
+    string precision; /*precision is 'float64' (default) or 'float32' for the arithmetic of the native engine; float32 halves memory and bandwidth*/
   } ConstCoexNetClustParams;
 
   typedef structure {
@@ -24,6 +24,20 @@ module CoExpression
     obj_ref original_data; /* original data object */
   } FigureProperties;
 
+  /* @id ws KBaseFeatureValues.ExpressionMatrix */
+  typedef string ws_expression_matrix_id;
+
+  /*
+      Filtered expression matrix stored as the selected rows of a fixed version of its source matrix instead of a copy of their values.
+      Internal to CoExpression: only its methods read it, and their outputs refer to the source ExpressionMatrix instead.
+      @optional description
+  */
+  typedef structure {
+    ws_expression_matrix_id source_matrix_ref; /* source matrix as wsid/objid/ver */
+    list<int> row_index; /* positions of the selected rows in the source matrix, in output order */
+    string description;
+  } FilteredExpressionMatrix;
+
   /* @id ws CoExpression.FigureProperties */
   typedef string ws_figure_properties;
 
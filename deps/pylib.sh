@@ -1 +1 @@
-pip install requests_toolbelt filemagic ftputil bunch requests pandas numpy 
+pip install requests_toolbelt filemagic ftputil bunch requests pandas numpy scipy 
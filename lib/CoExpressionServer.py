@@ -11,6 +11,7 @@ from os import environ
 from ConfigParser import ConfigParser
 from biokbase import log
 import biokbase.nexus
+from biokbase.CoExpression.auth_cache import CachingAuthClient
 
 DEPLOY = 'KB_DEPLOYMENT_CONFIG'
 SERVICE = 'KB_SERVICE_NAME'
@@ -272,11 +273,12 @@ class Application(object):
                              name='CoExpression.const_coex_net_clust',
                              types=[dict])
         self.method_authentication['CoExpression.const_coex_net_clust'] = 'required'
-        self.auth_client = biokbase.nexus.Client(
+        # validated tokens are cached by the Impl (see biokbase.CoExpression.auth_cache)
+        self.auth_client = CachingAuthClient(biokbase.nexus.Client(
             config={'server': 'nexus.api.globusonline.org',
                     'verify_ssl': True,
                     'client': None,
-                    'client_secret': None})
+                    'client_secret': None}), impl_CoExpression.token_cache)
 
     def __call__(self, environ, start_response):
         # Context object, equivalent to the perl impl CallContext
@@ -25,6 +25,21 @@ import numpy as np
 import biokbase.workspace.client
 from biokbase.CoExpression.authclient import KBaseAuth as _KBaseAuth
 import biokbase.Transform.script_utils as script_utils 
+import biokbase.CoExpression.coex_filter as native_filter
+import biokbase.CoExpression.coex_net as native_net
+import biokbase.CoExpression.coex_cluster as native_cluster
+from biokbase.CoExpression.expr_index import ExprIndex
+from biokbase.CoExpression.matrix_cache import MatrixCache
+import biokbase.CoExpression.expr_stream as expr_stream
+import biokbase.CoExpression.intermediate as intermediate
+from biokbase.CoExpression.scratch import Scratch
+from biokbase.CoExpression.ws_output import OutputBatch, info2ref
+import biokbase.CoExpression.filtered_view as filtered_view
+from biokbase.CoExpression.token_cache import TokenCache
+import biokbase.CoExpression.auth_cache as auth_cache
+import biokbase.CoExpression.ws_pool as ws_pool
+from biokbase.CoExpression.result_cache import ResultCache
+from biokbase.CoExpression.normalized import NormalizedStore
 
 def error_report(err_msg, expr, workspace_service_url, workspace_name, provenance, ws):
 
@@ -89,15 +104,46 @@ class CoExpression:
     CLSTR_DIR = 'clstr_dir'
     FINAL_DIR = 'final_dir'
     EXPRESS_FN = 'expression.tsv'
+    EXPRESS_BIN_FN = 'expression.f64'
     SAMPLE_FN = 'sample.tsv'
     COEX_FILTER = 'coex_filter'
     COEX_CLUSTER = 'coex_cluster2'
     FLTRD_FN = 'filtered.tsv'
     CLSTR_FN = 'clusters.tsv'
     CSTAT_FN = 'cluster_stat.tsv'
+    TREE_FN = 'tree.tsv'
     FINAL_FN = 'filtered.json'
     PVFDT_FN = 'pv_distribution.json'
+    SFT_FN = 'power_distribution.json'
     GENELST_FN = 'selected.tsv'
+    TOM_MEMORY_BUDGET = native_cluster.DEFAULT_MEMORY_BUDGET
+    EXCHANGE_FORMAT = 'tsv'
+    INDEX_OUTPUT = False
+    MATRIX_CACHE_DIR = 'matrix_cache'
+    MATRIX_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+    INTERMEDIATE_CODEC = 'none'
+    SCRATCH_ROOT = 'scratch'
+    AUTH_CACHE_TTL = 300
+    AUTH_CACHE_SIZE = 1000
+    user_cache = None
+    TOKEN_CACHE_TTL = auth_cache.DEFAULT_TTL
+    TOKEN_CACHE_FAILURE_TTL = auth_cache.DEFAULT_FAILURE_TTL
+    TOKEN_CACHE_SIZE = auth_cache.DEFAULT_SIZE
+    TOKEN_CACHE_STATS_INTERVAL = auth_cache.DEFAULT_STATS_INTERVAL
+    token_cache = None
+    WS_POOL_SIZE = 10
+    WS_TIMEOUT = 1800
+    ws_pool = None
+    RESULT_CACHE_DIR = 'result_cache'
+    RESULT_CACHE_SIZE = 1024 * 1024 * 1024
+    # parameters that only name inputs and outputs; they do not change a result
+    RESULT_KEY_IGNORE = ['workspace_name', 'object_name', 'out_expr_object_name', 'out_fs_object_name',
+                         'out_object_name', 'out_figure_object_name', 'output_mode']
+    result_cache = None
+    NORMALIZED_CACHE_DIR = 'normalized_cache'
+    NORMALIZED_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+    normalized_store = None
+    matrix_cache = None
     __WS_URL = 'https://ci.kbase.us/services/ws'
     __HS_URL = 'https://ci.kbase.us/services/handle_service'
     __SHOCK_URL = 'https://ci.kbase.us/services/shock-api'
@@ -105,6 +151,27 @@ class CoExpression:
     logger = None
 
 
+    def _getUserId(self, token):
+        # user id of token, shared by all calls for AUTH_CACHE_TTL seconds or until _forgetToken
+        user_id = self.user_cache.get(token)
+        if user_id is None:
+            user_id = _KBaseAuth(self.__AUTH_SERVICE_URL).get_user(token)
+            self.user_cache.put(token, user_id)
+        return user_id
+
+    def _forgetToken(self, token):
+        # the workspace rejected token (revoked or expired): stop accepting it from the caches
+        self.user_cache.invalidate(token)
+        self.token_cache.valid_tokens.invalidate(token)
+
+    def _scratchFn(self, odir, fn):
+        # intermediate file name, with the suffix of the configured codec
+        return intermediate.path("{0}/{1}".format(odir, fn), self.INTERMEDIATE_CODEC)
+
+    def _openScratch(self, fn, mode='r'):
+        # compressed with the configured codec on write, detected on read
+        return intermediate.open_file(fn, mode, self.INTERMEDIATE_CODEC)
+
     def _dumpExp2File(self, oexpr, odir, ofn):
         try:
             os.makedirs(odir)
@@ -115,15 +182,203 @@ class CoExpression:
             df = pd.DataFrame(oexpr['data']['values'], index=oexpr['data']['row_ids'], columns=oexpr['data']['col_ids'])
             mask = pd.Series(df.index == 'NA').add(pd.Series(df.index == '')).values == 0  # remove 'NA' or '' (missing gene name)
             df = df.iloc[mask,]
-            df.to_csv(path_or_buf = odir + "/" + ofn, sep='\t', na_rep = 'NA' )
+            with self._openScratch(self._scratchFn(odir, ofn), 'w') as ofh:
+                df.to_csv(path_or_buf = ofh, sep='\t', na_rep = 'NA' )
         except:
             self.logger.error("Failed to dump expression object into tsv file:" + traceback.format_exc());
             raise
         
+    def _dumpExp2Bin(self, oexpr, odir, ofn):
+        # raw little-endian float64 block in column-major (R) order, ids in ofn.rows / ofn.cols
+        try:
+            os.makedirs(odir)
+        except:
+            pass
+
+        try:
+            row_ids, values = self._exprMatrix(oexpr)
+            bin_fn = self._scratchFn(odir, ofn)
+            with self._openScratch(bin_fn, 'wb') as bf:
+                for j in range(values.shape[1]): # column by column is R's order, no transposed copy
+                    bf.write(values[:, j].astype('<f8').tostring())
+            with self._openScratch(bin_fn + '.rows', 'w') as rf:
+                rf.write("".join(["{0}\n".format(x) for x in row_ids]))
+            with self._openScratch(bin_fn + '.cols', 'w') as cf:
+                cf.write("".join(["{0}\n".format(x) for x in oexpr['data']['col_ids']]))
+        except:
+            self.logger.error("Failed to dump expression object into binary file:" + traceback.format_exc());
+            raise
+
+    def _dumpExprInput(self, oexpr, scratch):
+        # expression input of the R tools and the matching options; TSV unless exchange_format is 'binary'
+        raw_dir = scratch.dir(self.RAWEXPR_DIR)
+        if self.EXCHANGE_FORMAT == 'binary':
+            self._dumpExp2Bin(oexpr, raw_dir, self.EXPRESS_BIN_FN)
+            return self._scratchFn(raw_dir, self.EXPRESS_BIN_FN), ['--binary', 'y']
+        self._dumpExp2File(oexpr, raw_dir, self.EXPRESS_FN)
+        return self._scratchFn(raw_dir, self.EXPRESS_FN), []
+
+    def _getExpr(self, ws, obj, token):
+        return self._getExprRef(ws, obj, token)[1]
+
+    def _getExprRef(self, ws, obj, token):
+        return self._getExprView(ws, obj, token)[:2]
+
+    def _getExprView(self, ws, obj, token):
+        # versioned ref and ExpressionMatrix data of obj (a workspace object identity), from the local cache
+        # when possible; data.values is a float64 array (NaN for missing values).
+        # A FilteredExpressionMatrix is materialized from its source matrix and returned as the third
+        # value (None for an ExpressionMatrix), so outputs can refer to the source instead.
+        info = ws.get_object_info_new({'objects': [obj]})[0]
+        ref = "{0}/{1}/{2}".format(info[6], info[0], info[4])
+        if filtered_view.is_view_type(info[2]):
+            view = filtered_view.FilteredView(ws.get_objects([{'ref': ref}])[0]['data'],
+                                              lambda source_ref: self._getExpr(ws, {'ref': source_ref}, token))
+            return ref, view.expression_matrix(), view
+        expr = self.matrix_cache.get(ref)
+        if expr is None:
+            try:
+                expr = expr_stream.get_expression(self.__WS_URL, token, ref, timeout=self.WS_TIMEOUT, session=self.ws_pool.session)
+            except Exception:
+                self.logger.info("Streaming decode of {0} failed, using get_objects: {1}".format(ref, traceback.format_exc()))
+                expr = ws.get_objects([{'ref': ref}])[0]['data']
+                expr['data']['values'] = np.array(expr['data']['values'], dtype=float).reshape(-1, len(expr['data']['col_ids']))
+            self.matrix_cache.put(ref, expr)
+        else:
+            self.logger.info("Loaded {0} from the matrix cache".format(ref))
+        return ref, expr, None
+
+    def _resultKey(self, ref, method, param):
+        # content address of the result of method on the input object version ref (or list of refs)
+        return self.result_cache.key(ref, method,
+                                     dict((k, v) for k, v in param.items() if k not in self.RESULT_KEY_IGNORE))
+
+    def _exprRows(self, oexpr):
+        # same rows as _dumpExp2File writes: drop 'NA' or '' (missing gene name)
+        return [i for i, x in enumerate(oexpr['data']['row_ids']) if x != 'NA' and x != '']
+
+    def _exprMatrix(self, oexpr):
+        keep = self._exprRows(oexpr)
+        row_ids = [oexpr['data']['row_ids'][i] for i in keep]
+        values = np.array(oexpr['data']['values'], dtype=float).reshape(-1, len(oexpr['data']['col_ids']))[keep]
+        return row_ids, values
+
+    def _runCoexFilter(self, oexpr, param, scratch):
+        expr_fn, expr_opts = self._dumpExprInput(oexpr, scratch)
+
+        ## Prepare sample file
+        ncol = len(oexpr['data']['col_ids'])
+        with self._openScratch(self._scratchFn(scratch.dir(self.RAWEXPR_DIR), self.SAMPLE_FN), 'wt') as s:
+          s.write("0")
+          for j in range(1,ncol):
+            s.write("\t{0}".format(j))
+          s.write("\n")
+ 
+        ## Run coex_filter
+        cmd_coex_filter = [self.COEX_FILTER, '-i', expr_fn, '-o', self._scratchFn(scratch.dir(self.FLTRD_DIR), self.FLTRD_FN),
+                           '-m', param['method'], '-s', self._scratchFn(scratch.dir(self.RAWEXPR_DIR), self.SAMPLE_FN),
+                           '-x', self._scratchFn(scratch.dir(self.RAWEXPR_DIR), self.GENELST_FN), '-t', 'y'] + expr_opts
+        if 'num_features' in param:
+          cmd_coex_filter.append("-n")
+          cmd_coex_filter.append(str(param['num_features']))
+ 
+        if 'p_value' in param:
+          cmd_coex_filter.append("-p")
+          cmd_coex_filter.append(str(param['p_value']))
+ 
+        tool_process = subprocess.Popen(cmd_coex_filter, stderr=subprocess.PIPE, cwd=scratch.root)
+        stdout, stderr = tool_process.communicate()
+        
+        if stdout is not None and len(stdout) > 0:
+            self.logger.info(stdout)
+ 
+        if stderr is not None and len(stderr) > 0:
+            self.logger.info(stderr)
+ 
+        with self._openScratch(self._scratchFn(scratch.dir(self.RAWEXPR_DIR), self.GENELST_FN), 'r') as glh:
+          gl = glh.readlines()
+        return [x.strip('\n') for x in gl]
+
+    def _nativePvalues(self, oexpr, param):
+        # coex_filter p-values using the sample.tsv grouping (one group per column)
+        row_ids, values = self._exprMatrix(oexpr)
+        sample_index = range(values.shape[1])
+        if param['method'] in ['anova', 'a']:
+            stat, pvalues = native_filter.anova_pvalues(values, sample_index, param.get('correction', 'none'))
+            order = None
+        elif param['method'] in ['lor', 'l']:
+            pvalues, order = native_filter.lor_pvalues(values, sample_index, param.get('correction', 'BH'))
+        else:
+            raise ValueError("Filtering method '{0}' is not supported by the native engine".format(param['method']))
+        return row_ids, pvalues, order
+
+    def _nativeFilter(self, oexpr, param):
+        # in-process equivalent of _runCoexFilter returning the selected row positions of oexpr
+        row_ids, pvalues, order = self._nativePvalues(oexpr, param)
+        idx = native_filter.select_genes(pvalues, param.get('p_value'), param.get('num_features'), order,
+                                         param.get('selection', 'coex_filter'))
+        return np.asarray(self._exprRows(oexpr), dtype=int)[idx]
+
+    def _nativePvDistribution(self, oexpr, param):
+        # FloatDataTable of the binned -log2(p-value) histogram, built without files
+        row_ids, pvalues, order = self._nativePvalues(oexpr, param)
+        edges, counts = native_filter.pvalue_histogram(pvalues)
+        mids = (edges[:-1] + edges[1:]) / 2
+        return OrderedDict([('name', "Histogram of P-values"), ('row_labels', ["Number of features"]),
+                            ('column_labels', ["{0:.4g}".format(x) for x in mids]),
+                            ('data', [[float(c) for c in counts]])])
+
+    def _kernelRows(self, ref, oexpr, param):
+        # correlation kernel rows (net_method, precision of param) of the rows _exprMatrix keeps, from the
+        # stored normalized matrix of the matrix version ref; computed and stored on first use
+        network, kernel = native_net.network_method(param.get('net_method', 'simple'))
+        nm = self.normalized_store.load(ref, kernel, oexpr['data']['values'], native_net.precision_dtype(param.get('precision')))
+        keep = self._exprRows(oexpr)
+        return nm.rows() if len(keep) == len(nm) else nm.rows(keep)
+
+    def _nativeCluster(self, oexpr, param, power, scratch, z=None):
+        # in-process equivalent of coex_cluster2: same cluster and cluster_stat content, without the files
+        row_ids, values = self._exprMatrix(oexpr)
+        modules, stats = native_cluster.detect_modules(values, param.get('net_method', 'simple'), param.get('clust_method', 'WGCNA'),
+                                                       power, param.get('minModuleSize'), param.get('detectCutHeight'),
+                                                       scratch.dir(self.CLSTR_DIR), self.TOM_MEMORY_BUDGET, param.get('precision'), z,
+                                                       self._cutreeDynamic(scratch))
+        cid2genelist = {}
+        for gene, cluster in zip(row_ids, modules):
+            if cluster not in cid2genelist:
+                cid2genelist[cluster] = []
+            cid2genelist[cluster].append(gene)
+        cid2stat = {cluster: [mcor, msec] for cluster, mcor, msec in stats}
+        return cid2genelist, cid2stat
+
+    def _cutreeDynamic(self, scratch):
+        # tree cut of the native WGCNA clustering: coex_cluster2 runs cutreeDynamic on the native tree
+        def tree_cut(tree, cut_height, min_size):
+            tree_fn = os.path.join(scratch.dir(self.CLSTR_DIR), self.TREE_FN)
+            clstr_fn = self._scratchFn(scratch.dir(self.CLSTR_DIR), self.CLSTR_FN)
+            native_cluster.write_r_tree(tree_fn, tree)
+            cmd_coex_cluster = [self.COEX_CLUSTER, '--tree', tree_fn, '-o', clstr_fn,
+                                '--minModuleSize', str(min_size), '--detectCutHeight', str(cut_height)]
+            tool_process = subprocess.Popen(cmd_coex_cluster, stderr=subprocess.PIPE, cwd=scratch.root)
+            stdout, stderr = tool_process.communicate()
+            if tool_process.returncode != 0:
+                self.logger.error(stderr)
+                raise Exception(stderr)
+            if stderr is not None and len(stderr) > 0:
+                self.logger.info(stderr)
+            with self._openScratch(clstr_fn, 'r') as glh:
+                glh.readline() # skip header
+                return [line.rstrip().replace('"','') for line in glh]
+        return tree_cut
+
     def _subselectExp(self, oexpr, gl):
-        exp_idx = [oexpr['data']['row_ids'].index(x) for x in gl]
-        oexpr['data']['row_ids'] = [oexpr['data']['row_ids'][x] for x in exp_idx]
-        oexpr['data']['values'] = [oexpr['data']['values'][x] for x in exp_idx]
+        index = ExprIndex.from_matrix(oexpr['data'])
+        return self._subselectRows(oexpr, index.positions(gl), index)
+
+    def _subselectRows(self, oexpr, exp_idx, index=None):
+        if index is None:
+            index = ExprIndex.from_matrix(oexpr['data'])
+        oexpr['data']['row_ids'], oexpr['data']['values'] = index.take(exp_idx)
         return oexpr
 
     #END_CLASS_HEADER
@@ -149,6 +404,53 @@ class CoExpression:
               self.__COEX_FILTER = config['coex_filter']
         if 'coex_cluster' in config:
               self.__COEX_CLUSTER = config['coex_cluster']
+        if 'tom_memory_budget' in config: # bytes of TOM block buffers for the native engine
+          self.TOM_MEMORY_BUDGET = int(config['tom_memory_budget'])
+        if 'exchange_format' in config: # expect 'binary' or 'tsv'
+          self.EXCHANGE_FORMAT = config['exchange_format']
+        if 'index_output' in config: # 'true' allows filter_genes' output_mode 'index'
+          self.INDEX_OUTPUT = config['index_output'].lower() == 'true'
+        if 'matrix_cache_dir' in config:
+          self.MATRIX_CACHE_DIR = config['matrix_cache_dir']
+        if 'matrix_cache_size' in config: # bytes, 0 disables the cache
+          self.MATRIX_CACHE_SIZE = int(config['matrix_cache_size'])
+        if 'scratch_root' in config: # per-call scratch directories are created below it, e.g. on tmpfs
+          self.SCRATCH_ROOT = config['scratch_root']
+        if 'intermediate_codec' in config: # expect 'none' or 'gzip'
+          self.INTERMEDIATE_CODEC = intermediate.check_codec(config['intermediate_codec'])
+        self.matrix_cache = MatrixCache(self.MATRIX_CACHE_DIR, self.MATRIX_CACHE_SIZE)
+        if 'auth_cache_ttl' in config: # seconds, 0 disables the token -> user id cache
+          self.AUTH_CACHE_TTL = float(config['auth_cache_ttl'])
+        if 'auth_cache_size' in config:
+          self.AUTH_CACHE_SIZE = int(config['auth_cache_size'])
+        self.user_cache = TokenCache(self.AUTH_CACHE_TTL, self.AUTH_CACHE_SIZE)
+        if 'token_cache_ttl' in config: # seconds a validated token is accepted by the server without the auth service
+          self.TOKEN_CACHE_TTL = float(config['token_cache_ttl'])
+        if 'token_cache_failure_ttl' in config: # seconds a rejected token is refused without the auth service
+          self.TOKEN_CACHE_FAILURE_TTL = float(config['token_cache_failure_ttl'])
+        if 'token_cache_size' in config:
+          self.TOKEN_CACHE_SIZE = int(config['token_cache_size'])
+        if 'token_cache_stats_interval' in config: # validations between logged cache counters, 0 disables
+          self.TOKEN_CACHE_STATS_INTERVAL = int(config['token_cache_stats_interval'])
+        # token validation cache of the server's auth client (see auth_cache.CachingAuthClient)
+        self.token_cache = auth_cache.AuthCache(
+            self.TOKEN_CACHE_TTL, self.TOKEN_CACHE_FAILURE_TTL, self.TOKEN_CACHE_SIZE, self.TOKEN_CACHE_STATS_INTERVAL,
+            lambda stats: logging.getLogger('CoExpression').info("Token validation cache: {0}".format(stats)))
+        if 'ws_pool_size' in config: # kept-alive connections to the workspace shared by all calls
+          self.WS_POOL_SIZE = int(config['ws_pool_size'])
+        if 'ws_timeout' in config: # seconds
+          self.WS_TIMEOUT = float(config['ws_timeout'])
+        self.ws_pool = ws_pool.get_pool(self.__WS_URL, self.WS_POOL_SIZE, self.WS_TIMEOUT)
+        if 'result_cache_dir' in config:
+          self.RESULT_CACHE_DIR = config['result_cache_dir']
+        if 'result_cache_size' in config: # bytes, 0 disables reuse of filter, cluster and heatmap results
+          self.RESULT_CACHE_SIZE = int(config['result_cache_size'])
+        self.result_cache = ResultCache(self.RESULT_CACHE_DIR, self.RESULT_CACHE_SIZE)
+        if 'normalized_cache_dir' in config:
+          self.NORMALIZED_CACHE_DIR = config['normalized_cache_dir']
+        if 'normalized_cache_size' in config: # bytes, 0 disables the stored normalized / correlation matrices
+          self.NORMALIZED_CACHE_SIZE = int(config['normalized_cache_size'])
+        self.normalized_store = NormalizedStore(self.NORMALIZED_CACHE_DIR, self.NORMALIZED_CACHE_SIZE)
         if 'force_shock_node_2b_public' in config: # expect 'true' or 'false' string
           self.__PUBLIC_SHOCK_NODE = config['force_shock_node_2b_public']
     
@@ -172,103 +474,109 @@ class CoExpression:
         # ctx is the context object
         # return variables are: result
         #BEGIN diff_p_distribution
+        scratch = Scratch(self.SCRATCH_ROOT, [self.RAWEXPR_DIR, self.FLTRD_DIR])
         try:
-            os.makedirs(self.RAWEXPR_DIR)
-        except:
-            pass
-        try:
-            os.makedirs(self.FLTRD_DIR)
-        except:
-            pass
-        try:
-            os.makedirs(self.FINAL_DIR)
-        except:
-            pass
  
-        if self.logger is None:
-            self.logger = script_utils.stderrlogger(__file__)
+            if self.logger is None:
+                self.logger = script_utils.stderrlogger(__file__)
         
-        result = {}
-        self.logger.info("Starting conversion of KBaseFeatureValues.ExpressionMatrix to TSV")
-        token = ctx['token']
+            result = {}
+            self.logger.info("Starting conversion of KBaseFeatureValues.ExpressionMatrix to TSV")
+            token = ctx['token']
  
-        eenv = os.environ.copy()
-        eenv['KB_AUTH_TOKEN'] = token
+            eenv = os.environ.copy()
+            eenv['KB_AUTH_TOKEN'] = token
 
-        param = args
+            param = args
 
-        auth_client = _KBaseAuth(self.__AUTH_SERVICE_URL)
-        user_id = auth_client.get_user(token)
-        workspace_name_t = Template(param['workspace_name'])
-        workspace_name = workspace_name_t.substitute(user_id=user_id)
+            user_id = self._getUserId(token)
+            workspace_name_t = Template(param['workspace_name'])
+            workspace_name = workspace_name_t.substitute(user_id=user_id)
  
+            provenance = [{}]
+            if 'provenance' in ctx:
+                    provenance = ctx['provenance']
+            provenance[0]['input_ws_objects']=[workspace_name+'/'+param['object_name']]
  
-        from biokbase.workspace.client import Workspace
-        ws = Workspace(url=self.__WS_URL, token=token)
-        expr = ws.get_objects([{'workspace': workspace_name, 'name' : param['object_name']}])[0]['data']
+            ws = self.ws_pool.client(token, self._forgetToken)
+            expr = self._getExpr(ws, {'workspace': workspace_name, 'name' : param['object_name']}, token)
  
  
-        self._dumpExp2File(expr, self.RAWEXPR_DIR, self.EXPRESS_FN)
+            self.logger.info("Identifying differentially expressed genes")
  
-        self.logger.info("Identifying differentially expressed genes")
- 
-        ## Prepare sample file
-        # detect num of columns
-        ncol = len(expr['data']['col_ids'])
+            ## Prepare sample file
+            # detect num of columns
+            ncol = len(expr['data']['col_ids'])
         
-        # force to use ANOVA if the number of sample is two
-        if(ncol == 3): param['method'] = 'anova'
- 
-        with open("{0}/{1}".format(self.RAWEXPR_DIR, self.SAMPLE_FN), 'wt') as s:
-          s.write("0")
-          for j in range(1,ncol):
-            s.write("\t{0}".format(j))
-          s.write("\n")
+            # force to use ANOVA if the number of sample is two
+            if(ncol == 3): param['method'] = 'anova'
+ 
+            fig_properties = {"xlabel" : "-log2(p-value)", "ylabel" : "Number of features", "xlog_mode" : "-log2", "ylog_mode" : "none", "title" : "Histogram of P-values", "plot_type" : "histogram"}
+            if param.get('engine', 'R') == 'native':
+              ## binned -log2(p-value) histogram computed in process, no files
+              try:
+                pvfdt = self._nativePvDistribution(expr, param)
+              except ValueError as e:
+                self.logger.error(str(e))
+                return error_report(str(e), expr,self.__WS_URL, workspace_name, provenance, ws)
+              # the table holds bin counts already, drawn as bars over the -log2(p-value) bin centers
+              fig_properties['xlog_mode'] = 'none'
+              fig_properties['plot_type'] = 'bar'
+            else:
+              expr_fn, expr_opts = self._dumpExprInput(expr, scratch)
+              with self._openScratch(self._scratchFn(scratch.dir(self.RAWEXPR_DIR), self.SAMPLE_FN), 'wt') as s:
+                s.write("0")
+                for j in range(1,ncol):
+                  s.write("\t{0}".format(j))
+                s.write("\n")
  
  
-        ## Run coex_filter
-        cmd_coex_filter = [self.COEX_FILTER, '-i', "{0}/{1}".format(self.RAWEXPR_DIR, self.EXPRESS_FN), '-o', "{0}/{1}".format(self.FLTRD_DIR, self.FLTRD_FN),
-           '-m', param['method'], '-n', '10', '-s', "{0}/{1}".format(self.RAWEXPR_DIR, self.SAMPLE_FN),
-           '-x', "{0}/{1}".format(self.RAWEXPR_DIR, self.GENELST_FN), '-t', 'y', '-j', self.PVFDT_FN]
-        if 'num_features' in param:
-          cmd_coex_filter.append("-n")
-          cmd_coex_filter.append(str(param['num_features']))
+              ## Run coex_filter
+              cmd_coex_filter = [self.COEX_FILTER, '-i', expr_fn, '-o', self._scratchFn(scratch.dir(self.FLTRD_DIR), self.FLTRD_FN),
+                 '-m', param['method'], '-n', '10', '-s', self._scratchFn(scratch.dir(self.RAWEXPR_DIR), self.SAMPLE_FN),
+                 '-x', self._scratchFn(scratch.dir(self.RAWEXPR_DIR), self.GENELST_FN), '-t', 'y', '-j', self._scratchFn(scratch.root, self.PVFDT_FN)] + expr_opts
+              if 'num_features' in param:
+                cmd_coex_filter.append("-n")
+                cmd_coex_filter.append(str(param['num_features']))
  
-        if 'p_value' in param:
-          cmd_coex_filter.append("-p")
-          cmd_coex_filter.append(str(param['p_value']))
+              if 'p_value' in param:
+                cmd_coex_filter.append("-p")
+                cmd_coex_filter.append(str(param['p_value']))
  
  
-        tool_process = subprocess.Popen(cmd_coex_filter, stderr=subprocess.PIPE)
-        stdout, stderr = tool_process.communicate()
+              tool_process = subprocess.Popen(cmd_coex_filter, stderr=subprocess.PIPE, cwd=scratch.root)
+              stdout, stderr = tool_process.communicate()
         
-        if stdout is not None and len(stdout) > 0:
-            self.logger.info(stdout)
- 
-        if stderr is not None and len(stderr) > 0:
-            self.logger.info(stderr)
- 
-        ## loading pvalue distribution FDT
-        pvfdt = {'row_labels' :[], 'column_labels' : [], "data" : [[]]};
-        pvfdt = OrderedDict(pvfdt)
-        with open(self.PVFDT_FN, 'r') as myfile:
-           pvfdt = json.load(myfile)
-        data_obj_name = "{0}.fdt".format(param['out_figure_object_name'])
-        pvfdt['id'] = data_obj_name
- 
- 
-        fig_properties = {"xlabel" : "-log2(p-value)", "ylabel" : "Number of features", "xlog_mode" : "-log2", "ylog_mode" : "none", "title" : "Histogram of P-values", "plot_type" : "histogram"}
-        sstatus = ws.save_objects({'workspace' : workspace_name, 'objects' : [{'type' : 'MAK.FloatDataTable',
-                                                                              'data' : pvfdt,
-                                                                              'name' : data_obj_name}]})
-
-        data_ref = "{0}/{1}/{2}".format(sstatus[0][6], sstatus[0][0], sstatus[0][4])
-        fig_properties['data_ref'] = data_ref
-
-        sstatus = ws.save_objects({'workspace' : workspace_name, 'objects' : [{'type' : 'CoExpression.FigureProperties',
-                                                                              'data' : fig_properties,
-                                                                              'name' : (param['out_figure_object_name'])}]})
-        result = fig_properties
+              if stdout is not None and len(stdout) > 0:
+                  self.logger.info(stdout)
+ 
+              if stderr is not None and len(stderr) > 0:
+                  self.logger.info(stderr)
+ 
+              ## loading pvalue distribution FDT
+              pvfdt = {'row_labels' :[], 'column_labels' : [], "data" : [[]]};
+              pvfdt = OrderedDict(pvfdt)
+              with self._openScratch(self._scratchFn(scratch.root, self.PVFDT_FN), 'r') as myfile:
+                 pvfdt = json.load(myfile)
+            data_obj_name = "{0}.fdt".format(param['out_figure_object_name'])
+            pvfdt['id'] = data_obj_name
+ 
+ 
+            outputs = OutputBatch(ws, workspace_name)
+            outputs.add('fdt', {'type' : 'MAK.FloatDataTable',
+                                'data' : pvfdt,
+                                'name' : data_obj_name})
+
+            def figure(refs):
+                fig_properties['data_ref'] = refs['fdt']
+                return {'type' : 'CoExpression.FigureProperties',
+                        'data' : fig_properties,
+                        'name' : (param['out_figure_object_name'])}
+            outputs.add('figure', figure, ['fdt'])
+            outputs.save()
+            result = fig_properties
+        finally:
+            scratch.cleanup()
         #END diff_p_distribution
 
         # At some point might do deeper type checking...
@@ -282,164 +590,162 @@ class CoExpression:
         # ctx is the context object
         # return variables are: result
         #BEGIN filter_genes
+        scratch = Scratch(self.SCRATCH_ROOT, [self.RAWEXPR_DIR, self.FLTRD_DIR])
         try:
-            os.makedirs(self.RAWEXPR_DIR)
-        except:
-            pass
-        try:
-            os.makedirs(self.FLTRD_DIR)
-        except:
-            pass
-        try:
-            os.makedirs(self.FINAL_DIR)
-        except:
-            pass
  
-        if self.logger is None:
-            self.logger = script_utils.stderrlogger(__file__)
+            if self.logger is None:
+                self.logger = script_utils.stderrlogger(__file__)
         
-        result = {}
-        self.logger.info("Starting conversion of KBaseFeatureValues.ExpressionMatrix to TSV")
-        token = ctx['token']
+            result = {}
+            self.logger.info("Starting conversion of KBaseFeatureValues.ExpressionMatrix to TSV")
+            token = ctx['token']
  
-        eenv = os.environ.copy()
-        eenv['KB_AUTH_TOKEN'] = token
+            eenv = os.environ.copy()
+            eenv['KB_AUTH_TOKEN'] = token
 
-        param = args
+            param = args
 
-        auth_client = _KBaseAuth(self.__AUTH_SERVICE_URL)
-        user_id = auth_client.get_user(token)
-        workspace_name_t = Template(param['workspace_name'])
-        workspace_name = workspace_name_t.substitute(user_id=user_id)
+            user_id = self._getUserId(token)
+            workspace_name_t = Template(param['workspace_name'])
+            workspace_name = workspace_name_t.substitute(user_id=user_id)
  
-        provenance = [{}]
-        if 'provenance' in ctx:
-                provenance = ctx['provenance']
-        provenance[0]['input_ws_objects']=[workspace_name+'/'+param['object_name']]
+            provenance = [{}]
+            if 'provenance' in ctx:
+                    provenance = ctx['provenance']
+            provenance[0]['input_ws_objects']=[workspace_name+'/'+param['object_name']]
  
-        from biokbase.workspace.client import Workspace
-        ws = Workspace(url=self.__WS_URL, token=token)
-        expr = ws.get_objects([{'workspace': workspace_name, 'name' : param['object_name']}])[0]['data']
- 
-        self._dumpExp2File(expr, self.RAWEXPR_DIR, self.EXPRESS_FN)
+            output_mode = param.get('output_mode', 'matrix')
+            if output_mode not in ('matrix', 'index'):
+              raise ValueError("output_mode must be 'matrix' or 'index', not '{0}'".format(output_mode))
+            if output_mode == 'index' and not self.INDEX_OUTPUT:
+              raise ValueError("output_mode 'index' is not enabled on this deployment (index_output): "
+                               "other apps cannot read a CoExpression.FilteredExpressionMatrix")
+
+            ws = self.ws_pool.client(token, self._forgetToken)
+            expr_ref, expr, view = self._getExprView(ws, {'workspace': workspace_name, 'name' : param['object_name']}, token)
  
-        self.logger.info("Identifying differentially expressed genes")
+            self.logger.info("Identifying differentially expressed genes")
  
-        ## Prepare sample file
-        # detect num of columns
-        ncol = len(expr['data']['col_ids'])
+            # detect num of columns
+            ncol = len(expr['data']['col_ids'])
         
-        # force to use ANOVA if the number of sample is two
-        if(ncol == 3): param['method'] = 'anova'
- 
-        with open("{0}/{1}".format(self.RAWEXPR_DIR, self.SAMPLE_FN), 'wt') as s:
-          s.write("0")
-          for j in range(1,ncol):
-            s.write("\t{0}".format(j))
-          s.write("\n")
- 
- 
-        ## Run coex_filter
-        cmd_coex_filter = [self.COEX_FILTER, '-i', "{0}/{1}".format(self.RAWEXPR_DIR, self.EXPRESS_FN), '-o', "{0}/{1}".format(self.FLTRD_DIR, self.FLTRD_FN),
-                           '-m', param['method'], '-s', "{0}/{1}".format(self.RAWEXPR_DIR, self.SAMPLE_FN),
-                           '-x', "{0}/{1}".format(self.RAWEXPR_DIR, self.GENELST_FN), '-t', 'y']
-        if 'num_features' in param:
-          cmd_coex_filter.append("-n")
-          cmd_coex_filter.append(str(param['num_features']))
- 
-        if 'p_value' in param:
-          cmd_coex_filter.append("-p")
-          cmd_coex_filter.append(str(param['p_value']))
+            # force to use ANOVA if the number of sample is two
+            if(ncol == 3): param['method'] = 'anova'
+ 
+            if 'p_value' not in param and 'num_features' not in param:
+              self.logger.error("One of p_value or num_features must be defined");
+              return error_report("One of p_value or num_features must be defined", expr,self.__WS_URL, workspace_name, provenance, ws)
+              #sys.exit(2) #TODO: No error handling in narrative so we do graceful termination
+ 
+            #if 'p_value' in param and 'num_features' in param:
+            #  self.logger.error("Both of p_value and num_features cannot be defined together");
+            #  sys.exit(3)
+ 
+            ## Select genes with the native engine or coex_filter, or reuse an earlier selection
+            rows = None
+            result_key = self._resultKey(expr_ref, 'filter_genes', param)
+            cached = self.result_cache.get(result_key)
+            if cached is not None:
+              self.logger.info("Reusing the gene selection stored for {0}".format(expr_ref))
+              gl = cached['gl']
+              if cached['rows'] is not None:
+                rows = np.asarray(cached['rows'], dtype=int)
+            elif param.get('engine', 'R') == 'native':
+              try:
+                rows = self._nativeFilter(expr, param)
+              except ValueError as e:
+                self.logger.error(str(e))
+                return error_report(str(e), expr,self.__WS_URL, workspace_name, provenance, ws)
+              gl = [expr['data']['row_ids'][i] for i in rows]
+            else:
+              gl = self._runCoexFilter(expr, param, scratch)
+            if cached is None:
+              self.result_cache.put(result_key, {'gl': gl, 'rows': rows})
+ 
+            ## checking genelist
+            if(len(gl) < 1) :
+              self.logger.error("No genes are selected")
+              return error_report("Increase p_value or specify num_features", expr,self.__WS_URL, workspace_name, provenance, ws)
+              #sys.exit(4)
+ 
+            ## Upload FVE
+            if 'description' not in expr: 
+                expr['description'] = "Filtered Expression Matrix"
+            expr['description'] += " : Filtered by '{1}' method ".format(expr['description'], param['method'])
+ 
+            outputs = OutputBatch(ws, workspace_name)
+            if output_mode == 'index':
+              ## only the selected row positions of the source matrix version, no copy of the values;
+              ## a type internal to CoExpression, see filtered_view
+              if rows is None:
+                rows = ExprIndex(expr['data']['row_ids']).positions(gl)
+              source_ref = expr_ref
+              if view is not None:
+                # filtering a view selects from its source, never a view of a view
+                source_ref, rows = view.source_ref(), view.source_rows(rows)
+              outputs.add('expr', {'type' : filtered_view.VIEW_TYPE,
+                                   'data' : filtered_view.view_object(source_ref, rows, expr['description']),
+                                   'name' : (param['out_expr_object_name'])})
+            else:
+              if rows is None:
+                expr = self._subselectExp(expr, gl)
+              else:
+                expr = self._subselectRows(expr, rows)
+              outputs.add('expr', {'type' : 'KBaseFeatureValues.ExpressionMatrix',
+                                   'data' : expr,
+                                   'name' : (param['out_expr_object_name'])})
  
-        if 'p_value' not in param and 'num_features' not in param:
-          self.logger.error("One of p_value or num_features must be defined");
-          return error_report("One of p_value or num_features must be defined", expr,self.__WS_URL, workspace_name, provenance, ws)
-          #sys.exit(2) #TODO: No error handling in narrative so we do graceful termination
+            ## Upload FeatureSet
+            fs ={'elements': {}}
+            fs['description'] = "FeatureSet identified by filtering method '{0}' ".format(param['method'])
  
-        #if 'p_value' in param and 'num_features' in param:
-        #  self.logger.error("Both of p_value and num_features cannot be defined together");
-        #  sys.exit(3)
+            fs['description'] += "from {0}/{1}".format(workspace_name, param['object_name'])
  
-        tool_process = subprocess.Popen(cmd_coex_filter, stderr=subprocess.PIPE)
-        stdout, stderr = tool_process.communicate()
-        
-        if stdout is not None and len(stdout) > 0:
-            self.logger.info(stdout)
- 
-        if stderr is not None and len(stderr) > 0:
-            self.logger.info(stderr)
- 
-        ## checking genelist
-        with open("{0}/{1}".format(self.RAWEXPR_DIR, self.GENELST_FN),'r') as glh:
-          gl = glh.readlines()
-        gl = [x.strip('\n') for x in gl]
- 
-        if(len(gl) < 1) :
-          self.logger.error("No genes are selected")
-          return error_report("Increase p_value or specify num_features", expr,self.__WS_URL, workspace_name, provenance, ws)
-          #sys.exit(4)
- 
-        ## Upload FVE
-        if 'description' not in expr: 
-            expr['description'] = "Filtered Expression Matrix"
-        expr['description'] += " : Filtered by '{1}' method ".format(expr['description'], param['method'])
- 
-        expr = self._subselectExp(expr, gl)
- 
-        ex_info = ws.save_objects({'workspace' : workspace_name, 'objects' : [{'type' : 'KBaseFeatureValues.ExpressionMatrix',
-                                                                              'data' : expr,
-                                                                              'name' : (param['out_expr_object_name'])}]})[0]
- 
-        ## Upload FeatureSet
-        fs ={'elements': {}}
-        fs['description'] = "FeatureSet identified by filtering method '{0}' ".format(param['method'])
- 
-        fs['description'] += "from {0}/{1}".format(workspace_name, param['object_name'])
- 
-        for g in gl:
-          if 'genome_ref' in expr:
-            fs['elements'][g] = [expr['genome_ref']]
-          else:
-            fs['elements'][g] = []
- 
-        fs_info = ws.save_objects({'workspace' : workspace_name, 'objects' : [{'type' : 'KBaseCollections.FeatureSet',
-                                                                              'data' : fs,
-                                                                              'name' : (param['out_fs_object_name'])}]})[0]
-
-        ## Create report object:
-	report = "Filtering expression matrix using {0} on {1}".format(param['method'],param['object_name'])
-        reportObj = {
-                        'objects_created':[{
-                                'ref':"{0}/{1}/{2}".format(fs_info[6], fs_info[0], fs_info[4]),
-                                'description':'Filtered FeatureSet' },
-                             {
-                                'ref':"{0}/{1}/{2}".format(ex_info[6], ex_info[0], ex_info[4]),
-                                'description':'Filetered ExpressionMatrix' 
-                             }],
-                        'text_message':report
-                    }
-
-        # generate a unique name for the Method report
-        reportName = 'FilterExpression_'+str(hex(uuid.getnode()))
-        report_info = ws.save_objects({
-                                        'id':ex_info[6],
-                                        'objects':[
-                                        {
-                                        'type':'KBaseReport.Report',
-                                        'data':reportObj,
-                                        'name':reportName,
-                                        'meta':{},
-                                        'hidden':1, 
-                                        'provenance':provenance
-                                        }
-                                        ]
-                                        })[0]
-
-        result = { "report_name" : reportName,"report_ref" : "{0}/{1}/{2}".format(report_info[6],report_info[0],report_info[4]) }
-
-
-
-        #result = {'workspace_name' : workspace_name, 'out_expr_object_name' : param['out_expr_object_name'], 'out_fs_object_name' : param['out_fs_object_name']}
+            for g in gl:
+              if 'genome_ref' in expr:
+                fs['elements'][g] = [expr['genome_ref']]
+              else:
+                fs['elements'][g] = []
+ 
+            outputs.add('fs', {'type' : 'KBaseCollections.FeatureSet',
+                               'data' : fs,
+                               'name' : (param['out_fs_object_name'])})
+
+            ## Create report object:
+            report = "Filtering expression matrix using {0} on {1}".format(param['method'],param['object_name'])
+
+            # generate a unique name for the Method report
+            reportName = 'FilterExpression_'+str(hex(uuid.getnode()))
+
+            def report_object(refs):
+                reportObj = {
+                                'objects_created':[{
+                                        'ref':refs['fs'],
+                                        'description':'Filtered FeatureSet' },
+                                     {
+                                        'ref':refs['expr'],
+                                        'description':'Filtered ExpressionMatrix' 
+                                     }],
+                                'text_message':report
+                            }
+                return {
+                        'type':'KBaseReport.Report',
+                        'data':reportObj,
+                        'name':reportName,
+                        'meta':{},
+                        'hidden':1, 
+                        'provenance':provenance
+                        }
+            outputs.add('report', report_object, ['expr', 'fs'])
+            outputs.save()
+
+            result = { "report_name" : reportName,"report_ref" : outputs.ref('report') }
+
+
+
+            #result = {'workspace_name' : workspace_name, 'out_expr_object_name' : param['out_expr_object_name'], 'out_fs_object_name' : param['out_fs_object_name']}
+        finally:
+            scratch.cleanup()
         #END filter_genes
 
         # At some point might do deeper type checking...
@@ -453,158 +759,205 @@ class CoExpression:
         # ctx is the context object
         # return variables are: result
         #BEGIN const_coex_net_clust
+        scratch = Scratch(self.SCRATCH_ROOT, [self.RAWEXPR_DIR, self.CLSTR_DIR])
         try:
-            os.makedirs(self.RAWEXPR_DIR)
-        except:
-            pass
-        try:
-            os.makedirs(self.CLSTR_DIR)
-        except:
-            pass
-        try:
-            os.makedirs(self.FINAL_DIR)
-        except:
-            pass
  
-        if self.logger is None:
-            self.logger = script_utils.stderrlogger(__file__)
+            if self.logger is None:
+                self.logger = script_utils.stderrlogger(__file__)
         
-        result = {}
-        self.logger.info("Starting conversion of KBaseFeatureValues.ExpressionMatrix to TSV")
-        token = ctx['token']
-
-        param = args
-
-        auth_client = _KBaseAuth(self.__AUTH_SERVICE_URL)
-        user_id = auth_client.get_user(token)
-        workspace_name_t = Template(param['workspace_name'])
-        workspace_name = workspace_name_t.substitute(user_id=user_id)
-
-        provenance = [{}]
-        if 'provenance' in ctx:
-                provenance = ctx['provenance']
-        provenance[0]['input_ws_objects']=[workspace_name+'/'+param['object_name']]
- 
-        from biokbase.workspace.client import Workspace
-        ws = Workspace(url=self.__WS_URL, token=token)
-        expr = ws.get_objects([{'workspace': workspace_name, 'name' : param['object_name']}])[0]['data']
- 
- 
-        eenv = os.environ.copy()
-        eenv['KB_AUTH_TOKEN'] = token
-        self._dumpExp2File(expr, self.RAWEXPR_DIR, self.EXPRESS_FN)
+            result = {}
+            self.logger.info("Starting conversion of KBaseFeatureValues.ExpressionMatrix to TSV")
+            token = ctx['token']
+
+            param = args
+
+            user_id = self._getUserId(token)
+            workspace_name_t = Template(param['workspace_name'])
+            workspace_name = workspace_name_t.substitute(user_id=user_id)
+
+            provenance = [{}]
+            if 'provenance' in ctx:
+                    provenance = ctx['provenance']
+            provenance[0]['input_ws_objects']=[workspace_name+'/'+param['object_name']]
+ 
+            ws = self.ws_pool.client(token, self._forgetToken)
+            expr_ref, expr, view = self._getExprView(ws, {'workspace': workspace_name, 'name' : param['object_name']}, token)
+ 
+            ## Reuse the clusters of an earlier run on the same matrix version and parameters
+            result_key = self._resultKey(expr_ref, 'const_coex_net_clust', param)
+            cached = self.result_cache.get(result_key)
+            if cached is not None:
+              self.logger.info("Reusing the clusters stored for {0}".format(expr_ref))
+              cid2genelist = OrderedDict((cluster, genes) for cluster, genes in cached['clusters'])
+              cid2stat = dict((cluster, [mcor, msec]) for cluster, mcor, msec in cached['stats'])
+              power = cached['power']
+            else:
+              ## Select the WGCNA soft threshold power in process, for the native clustering
+              ## or, with power_engine 'native', for coex_cluster2 through --power
+              power = None
+              z = None
+              native = param.get('engine', 'R') == 'native'
+              if native or param.get('power_engine', 'R') == 'native':
+                try:
+                  network, kernel = native_net.network_method(param.get('net_method', 'simple'))
+                  if native or network == 'WGCNA':
+                    # correlation rows shared by the power selection and the clustering
+                    z = self._kernelRows(expr_ref, expr, param)
+                  if network == 'WGCNA':
+                    row_ids, values = self._exprMatrix(expr)
+                    power, sft_table = native_net.pick_soft_threshold(values, param.get('maxpower'), param.get('minRsq'), param.get('maxmediank'),
+                                                                      kernel=kernel, dtype=native_net.precision_dtype(param.get('precision')), z=z)
+                except ValueError as e:
+                  self.logger.error(str(e))
+                  return error_report(str(e), expr,self.__WS_URL, workspace_name, provenance, ws)
+              if power is not None:
+                with self._openScratch(self._scratchFn(scratch.dir(self.CLSTR_DIR), self.SFT_FN), 'w') as sfh:
+                  json.dump(sft_table, sfh)
+                self.logger.info("Selected soft threshold power {0}".format(power))
+ 
+ 
+              #sys.exit(2) #TODO: No error handling in narrative so we do graceful termination
+ 
+              #if 'p_value' in param and 'num_features' in param:
+              #  self.logger.error("Both of p_value and num_features cannot be defined together");
+              #  sys.exit(3)
+ 
+              if native:
+                try:
+                  cid2genelist, cid2stat = self._nativeCluster(expr, param, power, scratch, z)
+                except ValueError as e:
+                  self.logger.error(str(e))
+                  return error_report(str(e), expr,self.__WS_URL, workspace_name, provenance, ws)
+              else:
+                eenv = os.environ.copy()
+                eenv['KB_AUTH_TOKEN'] = token
+                expr_fn, expr_opts = self._dumpExprInput(expr, scratch)
  
-        self.logger.info("Identifying differentially expressed genes")
+                self.logger.info("Identifying differentially expressed genes")
  
-        ## Prepare sample file
-        # detect num of columns
-        ncol = len(expr['data']['col_ids'])
+                ## Prepare sample file
+                # detect num of columns
+                ncol = len(expr['data']['col_ids'])
         
-        # grouping information 
-        with open("{0}/{1}".format(self.RAWEXPR_DIR, self.SAMPLE_FN), 'wt') as s:
-          s.write("0")
-          for j in range(1,ncol):
-            s.write("\t{0}".format(j))
-          s.write("\n")
- 
- 
-        ## Run coex_cluster
-        cmd_coex_cluster = [self.COEX_CLUSTER, '-t', 'y',
-                           '-i', "{0}/{1}".format(self.RAWEXPR_DIR, self.EXPRESS_FN), 
-                           '-o', "{0}/{1}".format(self.CLSTR_DIR, self.CLSTR_FN), '-m', "{0}/{1}".format(self.CLSTR_DIR, self.CSTAT_FN) ]
- 
-        for p in ['net_method', 'minRsq', 'maxmediank', 'maxpower', 'clust_method', 'minModuleSize', 'detectCutHeight']:
-           if p in param:
-             cmd_coex_cluster.append("--{0}".format(p))
-             cmd_coex_cluster.append(str(param[p]))
+                # grouping information 
+                with self._openScratch(self._scratchFn(scratch.dir(self.RAWEXPR_DIR), self.SAMPLE_FN), 'wt') as s:
+                  s.write("0")
+                  for j in range(1,ncol):
+                    s.write("\t{0}".format(j))
+                  s.write("\n")
+ 
+ 
+                ## Run coex_cluster
+                cmd_coex_cluster = [self.COEX_CLUSTER, '-t', 'y',
+                                   '-i', expr_fn, 
+                                   '-o', self._scratchFn(scratch.dir(self.CLSTR_DIR), self.CLSTR_FN), '-m', self._scratchFn(scratch.dir(self.CLSTR_DIR), self.CSTAT_FN) ] + expr_opts
+ 
+                r_param = dict(param)
+                if r_param.get('net_method') in native_net.NET_METHODS:
+                  # coex_cluster2 takes the network type and the correlation kernel separately
+                  r_param['net_method'], r_param['cor_method'] = native_net.network_method(r_param['net_method'])
+                for p in ['net_method', 'cor_method', 'minRsq', 'maxmediank', 'maxpower', 'clust_method', 'minModuleSize', 'detectCutHeight']:
+                   if p in r_param:
+                     cmd_coex_cluster.append("--{0}".format(p))
+                     cmd_coex_cluster.append(str(r_param[p]))
+                if power is not None:
+                  cmd_coex_cluster.append("--power")
+                  cmd_coex_cluster.append(str(power))
   
- 
-        #sys.exit(2) #TODO: No error handling in narrative so we do graceful termination
- 
-        #if 'p_value' in param and 'num_features' in param:
-        #  self.logger.error("Both of p_value and num_features cannot be defined together");
-        #  sys.exit(3)
- 
-        tool_process = subprocess.Popen(cmd_coex_cluster, stderr=subprocess.PIPE)
-        stdout, stderr = tool_process.communicate()
+                tool_process = subprocess.Popen(cmd_coex_cluster, stderr=subprocess.PIPE, cwd=scratch.root)
+                stdout, stderr = tool_process.communicate()
         
-        if stdout is not None and len(stdout) > 0:
-            self.logger.info(stdout)
+                if stdout is not None and len(stdout) > 0:
+                    self.logger.info(stdout)
  
-        if stderr is not None and len(stderr) > 0:
-            if re.search(r'^There were \d+ warnings \(use warnings\(\) to see them\)', stderr):
-              self.logger.info(stderr)
-            else:
-              self.logger.error(stderr)
-              raise Exception(stderr)
+                if stderr is not None and len(stderr) > 0:
+                    if re.search(r'^There were \d+ warnings \(use warnings\(\) to see them\)', stderr):
+                      self.logger.info(stderr)
+                    else:
+                      self.logger.error(stderr)
+                      raise Exception(stderr)
  
         
-        # build index for gene list
-        pos_index ={expr['data']['row_ids'][i]: i for i in range(0, len(expr['data']['row_ids']))}
- 
- 
-        # parse clustering results
-        cid2genelist = {}
-        cid2stat = {}
-        with open("{0}/{1}".format(self.CLSTR_DIR, self.CSTAT_FN),'r') as glh:
-            glh.readline() # skip header
-            for line in glh:
-                cluster, mcor, msec = line.rstrip().replace('"','').split("\t")
-                cid2stat[cluster]= [mcor, msec]
-        with open("{0}/{1}".format(self.CLSTR_DIR, self.CLSTR_FN),'r') as glh:
-            glh.readline() # skip header
-            for line in glh:
-                gene, cluster = line.rstrip().replace('"','').split("\t")
-                if cluster not in cid2genelist:
-                    cid2genelist[cluster] = []
-                cid2genelist[cluster].append(gene)
- 
-        if(len(cid2genelist) < 1) :
-          self.logger.error("Clustering failed")
-          return error_report("Error: No cluster output", expr,self.__WS_URL, workspace_name, provenance, ws)
-          #sys.exit(4)
- 
-        self.logger.info("Uploading the results onto WS")
-        feature_clusters = []
-        for cluster in cid2genelist:
-            feature_clusters.append( {"meancor": float(cid2stat[cluster][0]), "msec": float(cid2stat[cluster][0]), "id_to_pos" : { gene : pos_index[gene] for gene in cid2genelist[cluster]}})
-
-        ## Upload Clusters
-        feature_clusters ={"original_data": "{0}/{1}".format(workspace_name,param['object_name']),
-                           "feature_clusters": feature_clusters}
- 
-        cl_info = ws.save_objects({'workspace' : workspace_name, 'objects' : [{'type' : 'KBaseFeatureValues.FeatureClusters',
-                                                                          'data' : feature_clusters,
-                                                                          'name' : (param['out_object_name'])}]})[0]
-        ## Create report object:
-	report = "Clustering expression matrix using WGCNA on {0}".format(param['object_name'])
-        reportObj = {
-                        'objects_created':[                             {
-                                'ref':"{0}/{1}/{2}".format(cl_info[6], cl_info[0], cl_info[4]),
-                                'description':'WGCNA FeatureClusters' 
-                             }],
-                        'text_message':report
-                    }
-
-        # generate a unique name for the Method report
-        reportName = 'WGCNA_Clusters_'+str(hex(uuid.getnode()))
-        report_info = ws.save_objects({
-                                        'id':cl_info[6],
-                                        'objects':[
-                                        {
-                                        'type':'KBaseReport.Report',
-                                        'data':reportObj,
-                                        'name':reportName,
-                                        'meta':{},
-                                        'hidden':1, 
-                                        'provenance':provenance
-                                        }
-                                        ]
-                                        })[0]
-
-        #result = { "report_name" : reportName,"report_ref" : "{0}/{1}/{2}".format(report_info[6],report_info[0],report_info[4]) }
-        #result = {'workspace_name' : workspace_name, 'out_object_name' : param['out_object_name']}
-        result = {'workspace' : workspace_name, 'output' : param['out_object_name']}
+                # parse clustering results
+                cid2genelist = {}
+                cid2stat = {}
+                with self._openScratch(self._scratchFn(scratch.dir(self.CLSTR_DIR), self.CSTAT_FN), 'r') as glh:
+                    glh.readline() # skip header
+                    for line in glh:
+                        cluster, mcor, msec = line.rstrip().replace('"','').split("\t")
+                        cid2stat[cluster]= [mcor, msec]
+                with self._openScratch(self._scratchFn(scratch.dir(self.CLSTR_DIR), self.CLSTR_FN), 'r') as glh:
+                    glh.readline() # skip header
+                    for line in glh:
+                        gene, cluster = line.rstrip().replace('"','').split("\t")
+                        if cluster not in cid2genelist:
+                            cid2genelist[cluster] = []
+                        cid2genelist[cluster].append(gene)
+              # clusters as pairs in their original order; cluster ids need not be strings
+              self.result_cache.put(result_key, {'clusters': [[cluster, genes] for cluster, genes in cid2genelist.items()],
+                                                 'stats': [[cluster] + list(stat) for cluster, stat in cid2stat.items()],
+                                                 'power': power})
+ 
+
+            # build index for gene list
+            pos_index = ExprIndex(expr['data']['row_ids']).pos
+            original_data = "{0}/{1}".format(workspace_name,param['object_name'])
+            if view is not None:
+              # a filtered view is internal to CoExpression: the clusters refer to its source matrix
+              original_data = view.source_ref()
+              pos_index = dict(zip(expr['data']['row_ids'], view.source_rows(range(len(view)))))
+ 
+ 
+            if(len(cid2genelist) < 1) :
+              self.logger.error("Clustering failed")
+              return error_report("Error: No cluster output", expr,self.__WS_URL, workspace_name, provenance, ws)
+              #sys.exit(4)
+ 
+            self.logger.info("Uploading the results onto WS")
+            feature_clusters = []
+            for cluster in cid2genelist:
+                feature_clusters.append( {"meancor": float(cid2stat[cluster][0]), "msec": float(cid2stat[cluster][0]), "id_to_pos" : { gene : pos_index[gene] for gene in cid2genelist[cluster]}})
+
+            ## Upload Clusters
+            feature_clusters ={"original_data": original_data,
+                               "feature_clusters": feature_clusters}
+ 
+            outputs = OutputBatch(ws, workspace_name)
+            outputs.add('clusters', {'type' : 'KBaseFeatureValues.FeatureClusters',
+                                     'data' : feature_clusters,
+                                     'name' : (param['out_object_name'])})
+            ## Create report object:
+            report = "Clustering expression matrix using WGCNA on {0}".format(param['object_name'])
+            if power is not None:
+              report += " with soft threshold power {0}".format(power)
+
+            # generate a unique name for the Method report
+            reportName = 'WGCNA_Clusters_'+str(hex(uuid.getnode()))
+
+            def report_object(refs):
+                reportObj = {
+                                'objects_created':[                             {
+                                        'ref':refs['clusters'],
+                                        'description':'WGCNA FeatureClusters' 
+                                     }],
+                                'text_message':report
+                            }
+                return {
+                        'type':'KBaseReport.Report',
+                        'data':reportObj,
+                        'name':reportName,
+                        'meta':{},
+                        'hidden':1, 
+                        'provenance':provenance
+                        }
+            outputs.add('report', report_object, ['clusters'])
+            outputs.save()
+
+            #result = { "report_name" : reportName,"report_ref" : "{0}/{1}/{2}".format(report_info[6],report_info[0],report_info[4]) }
+            #result = {'workspace_name' : workspace_name, 'out_object_name' : param['out_object_name']}
+            result = {'workspace' : workspace_name, 'output' : param['out_object_name']}
+        finally:
+            scratch.cleanup()
         #END const_coex_net_clust
 
         # At some point might do deeper type checking...
@@ -618,18 +971,6 @@ class CoExpression:
         # ctx is the context object
         # return variables are: result
         #BEGIN view_heatmap
-        try:
-            os.makedirs(self.RAWEXPR_DIR)
-        except:
-            pass
-        try:
-            os.makedirs(self.FLTRD_DIR)
-        except:
-            pass
-        try:
-            os.makedirs(self.FINAL_DIR)
-        except:
-            pass
  
         if self.logger is None:
             self.logger = script_utils.stderrlogger(__file__)
@@ -643,255 +984,276 @@ class CoExpression:
 
         param = args
 
-        auth_client = _KBaseAuth(self.__AUTH_SERVICE_URL)
-        user_id = auth_client.get_user(token)
+        user_id = self._getUserId(token)
         workspace_name_t = Template(param['workspace_name'])
         workspace_name = workspace_name_t.substitute(user_id=user_id)
  
  
-        from biokbase.workspace.client import Workspace
-        ws = Workspace(url=self.__WS_URL, token=token)
-        fc = ws.get_objects([{'workspace': workspace_name, 'name' : param['object_name']}])[0]['data']
+        ws = self.ws_pool.client(token, self._forgetToken)
+        fc_obj = ws.get_objects([{'workspace': workspace_name, 'name' : param['object_name']}])[0]
+        fc = fc_obj['data']
         if 'original_data' not in fc:
             raise Exception("FeatureCluster object does not have information for the original ExpressionMatrix")
-        oexpr = ws.get_objects([{ 'ref' : fc['original_data']}])[0]
 
-        df2 = pd.DataFrame(oexpr['data']['data']['values'], index=oexpr['data']['data']['row_ids'], columns=oexpr['data']['data']['col_ids'])
-
-        # L2 normalization
-        df3 = df2.div(df2.pow(2).sum(axis=1).pow(0.5), axis=0)
-
-        # type - ? level, ratio, log-ratio  <---> "untransformed"
-        # scale - ? probably: raw, ln, log2, log10
-        self.logger.info("Expression matrix type: {0}, scale: {1}".format(oexpr['data']['type'],oexpr['data']['scale'] ))
-        # do default behavior
-        factor = 0.125
-        fc_df = df2 + df2[df2 !=0].abs().min().min() * factor
-        if param['control_condition']  in fc_df.columns:
-            fc_df = (fc_df.div(fc_df.loc[:,fc_df.columns[param['control_condition']]], axis=0)).apply(np.log2)
+        ## Reuse the heatmap of an earlier call on the same clusters, matrix version and parameters
+        expr_ref = info2ref(ws.get_object_info_new({'objects': [{'ref': fc['original_data']}]})[0])
+        result_key = self._resultKey([info2ref(fc_obj['info']), expr_ref], 'view_heatmap', param)
+        cached = self.result_cache.get(result_key)
+        if cached is not None:
+            self.logger.info("Reusing the heatmap stored for {0}".format(expr_ref))
+            fdt = cached['fdt']
+            fig_properties = cached['fig_properties']
         else:
-            fc_df = (fc_df.div(fc_df.loc[:,fc_df.columns[0]], axis=0)).apply(np.log2)
-        # now fc_df will be reset
-        if oexpr['data']['type'] == 'level' or oexpr['data']['type'] == 'untransformed': # need to compute fold changes
-            if 'scale' not in oexpr['data'] or oexpr['data']['scale'] == 'raw' or oexpr['data']['scale'] == "1.0":
-              factor = 0.125
-              fc_df = df2 + df2[df2 !=0].abs().min().min() * factor
-              if param['control_condition']  in fc_df.columns:
-                  fc_df = (fc_df.div(fc_df.loc[:,fc_df.columns[param['control_condition']]], axis=0)).apply(np.log2)
-              else:
-                  fc_df = (fc_df.div(fc_df.loc[:,fc_df.columns[0]], axis=0)).apply(np.log2)
-            else:
-              fc_df = df2
-              if param['control_condition']  in fc_df.columns:
-                  fc_df = (fc_df.div(fc_df.loc[:,fc_df.columns[param['control_condition']]], axis=0))
-              else:
-                  fc_df = (fc_df.div(fc_df.loc[:,fc_df.columns[0]], axis=0))
-              if oexpr['data']['scale'] == "log10":
-                  fc_df = fc_df/np.log10(2)
-              elif oexpr['data']['scale'] == "ln":
-                  fc_df = fc_df/np.log(2)
-              else:
-                  pass
-        elif oexpr['data']['type'] == 'ratio':
-            fc_df = df2.apply(np.log2)
-        elif oexpr['data']['type'] == 'log-ratio':
-            fc_df = df2
-            if oexpr['data']['scale'] == "log10":
-                fc_df = fc_df/np.log10(2)
-            elif oexpr['data']['scale'] == "ln":
-                fc_df = fc_df/np.log(2)
+            oexpr = {'data' : self._getExpr(ws, { 'ref' : expr_ref}, token)}
+
+            df2 = pd.DataFrame(oexpr['data']['data']['values'], index=oexpr['data']['data']['row_ids'], columns=oexpr['data']['data']['col_ids'])
+            eindex = ExprIndex(oexpr['data']['data']['row_ids'])
+
+            # L2 normalization, stored per matrix version and read cluster by cluster
+            l2 = self.normalized_store.load(expr_ref, 'l2', oexpr['data']['data']['values'])
+            corr = None
+
+            # type - ? level, ratio, log-ratio  <---> "untransformed"
+            # scale - ? probably: raw, ln, log2, log10
+            self.logger.info("Expression matrix type: {0}, scale: {1}".format(oexpr['data']['type'],oexpr['data']['scale'] ))
+            # do default behavior
+            factor = 0.125
+            fc_df = df2 + df2[df2 !=0].abs().min().min() * factor
+            if param['control_condition']  in fc_df.columns:
+                fc_df = (fc_df.div(fc_df.loc[:,fc_df.columns[param['control_condition']]], axis=0)).apply(np.log2)
             else:
-                pass
-
-        else: # do the same thing with simple level or untransformed
-            if 'scale' not in oexpr['data'] or oexpr['data']['scale'] == 'raw' or oexpr['data']['scale'] == "1.0":
-              factor = 0.125
-              fc_df = df2 + df2[df2 !=0].abs().min().min() * factor
-              if param['control_condition']  in fc_df.columns:
-                  fc_df = (fc_df.div(fc_df.loc[:,fc_df.columns[param['control_condition']]], axis=0)).apply(np.log2)
-              else:
-                  fc_df = (fc_df.div(fc_df.loc[:,fc_df.columns[0]], axis=0)).apply(np.log2)
-            else:
-              fc_df = df2
-              if param['control_condition']  in fc_df.columns:
-                  fc_df = (fc_df.div(fc_df.loc[:,fc_df.columns[param['control_condition']]], axis=0))
-              else:
-                  fc_df = (fc_df.div(fc_df.loc[:,fc_df.columns[0]], axis=0))
-              if oexpr['data']['scale'] == "log10":
-                  fc_df = fc_df/np.log10(2)
-              elif oexpr['data']['scale'] == "ln":
-                  fc_df = fc_df/np.log(2)
-              else:
-                  pass
+                fc_df = (fc_df.div(fc_df.loc[:,fc_df.columns[0]], axis=0)).apply(np.log2)
+            # now fc_df will be reset
+            if oexpr['data']['type'] == 'level' or oexpr['data']['type'] == 'untransformed': # need to compute fold changes
+                if 'scale' not in oexpr['data'] or oexpr['data']['scale'] == 'raw' or oexpr['data']['scale'] == "1.0":
+                  factor = 0.125
+                  fc_df = df2 + df2[df2 !=0].abs().min().min() * factor
+                  if param['control_condition']  in fc_df.columns:
+                      fc_df = (fc_df.div(fc_df.loc[:,fc_df.columns[param['control_condition']]], axis=0)).apply(np.log2)
+                  else:
+                      fc_df = (fc_df.div(fc_df.loc[:,fc_df.columns[0]], axis=0)).apply(np.log2)
+                else:
+                  fc_df = df2
+                  if param['control_condition']  in fc_df.columns:
+                      fc_df = (fc_df.div(fc_df.loc[:,fc_df.columns[param['control_condition']]], axis=0))
+                  else:
+                      fc_df = (fc_df.div(fc_df.loc[:,fc_df.columns[0]], axis=0))
+                  if oexpr['data']['scale'] == "log10":
+                      fc_df = fc_df/np.log10(2)
+                  elif oexpr['data']['scale'] == "ln":
+                      fc_df = fc_df/np.log(2)
+                  else:
+                      pass
+            elif oexpr['data']['type'] == 'ratio':
+                fc_df = df2.apply(np.log2)
+            elif oexpr['data']['type'] == 'log-ratio':
+                fc_df = df2
+                if oexpr['data']['scale'] == "log10":
+                    fc_df = fc_df/np.log10(2)
+                elif oexpr['data']['scale'] == "ln":
+                    fc_df = fc_df/np.log(2)
+                else:
+                    pass
+
+            else: # do the same thing with simple level or untransformed
+                if 'scale' not in oexpr['data'] or oexpr['data']['scale'] == 'raw' or oexpr['data']['scale'] == "1.0":
+                  factor = 0.125
+                  fc_df = df2 + df2[df2 !=0].abs().min().min() * factor
+                  if param['control_condition']  in fc_df.columns:
+                      fc_df = (fc_df.div(fc_df.loc[:,fc_df.columns[param['control_condition']]], axis=0)).apply(np.log2)
+                  else:
+                      fc_df = (fc_df.div(fc_df.loc[:,fc_df.columns[0]], axis=0)).apply(np.log2)
+                else:
+                  fc_df = df2
+                  if param['control_condition']  in fc_df.columns:
+                      fc_df = (fc_df.div(fc_df.loc[:,fc_df.columns[param['control_condition']]], axis=0))
+                  else:
+                      fc_df = (fc_df.div(fc_df.loc[:,fc_df.columns[0]], axis=0))
+                  if oexpr['data']['scale'] == "log10":
+                      fc_df = fc_df/np.log10(2)
+                  elif oexpr['data']['scale'] == "ln":
+                      fc_df = fc_df/np.log(2)
+                  else:
+                      pass
        
-        self.logger.info("Compute cluster statistics")
+            self.logger.info("Compute cluster statistics")
 
-        cl = {}
-        afs = [];
-        cid = 1;
+            cl = {}
+            clpos = {}
+            afs = [];
+            cid = 1;
 
-        c_stat = pd.DataFrame()
-        for cluster in fc['feature_clusters']:
+            c_stat = pd.DataFrame()
+            for cluster in fc['feature_clusters']:
          
-          try: 
-            fs  = cluster['id_to_pos'].keys()
-          except:
-            continue # couldn't find feature_set
-
-          fsn = "Cluster_{0}".format(cid)
-          cid +=1
-          c_stat.loc[fsn,'size'] = len(fs)
-          if 'meancor' in cluster:
-              c_stat.loc[fsn,'mcor'] = cluster['meancor']
-          else:
-            pass
-            # TODO: Add mean cor calculation later
-            #raise Exception("Mean correlation is not included in FeatureCluster object") # now it is NaN
-
-          if 'quantile' in param:
-              # enforcing quantile to be in [0 .. 1] rnage
-              qt = float(param['quantile'])
-              if qt > 1.0: qt = 1.0
-              if qt < 0.0: qt = 0.0
-              c_stat.loc[fsn,'stdstat'] = fc_df.loc[fs,].std(axis=1).quantile(qt)
-          else:
-              c_stat.loc[fsn,'stdstat'] = fc_df.loc[fs,].std(axis=1).quantile(0.75)
+              try: 
+                fs  = cluster['id_to_pos'].keys()
+              except:
+                continue # couldn't find feature_set
+
+              fsn = "Cluster_{0}".format(cid)
+              cid +=1
+              fpos = eindex.positions(fs, skip_missing=True)
+              c_stat.loc[fsn,'size'] = len(fs)
+              if 'meancor' in cluster:
+                  c_stat.loc[fsn,'mcor'] = cluster['meancor']
+              else:
+                # mean Pearson correlation within the cluster from the stored correlation rows
+                if corr is None:
+                  corr = self.normalized_store.load(expr_ref, 'pearson', oexpr['data']['data']['values'])
+                c_stat.loc[fsn,'mcor'] = corr.mean_correlation(fpos)
+
+              if 'quantile' in param:
+                  # enforcing quantile to be in [0 .. 1] rnage
+                  qt = float(param['quantile'])
+                  if qt > 1.0: qt = 1.0
+                  if qt < 0.0: qt = 0.0
+                  c_stat.loc[fsn,'stdstat'] = fc_df.iloc[fpos].std(axis=1).quantile(qt)
+              else:
+                  c_stat.loc[fsn,'stdstat'] = fc_df.iloc[fpos].std(axis=1).quantile(0.75)
          
 
-          c1 = df3.loc[fs,].sum(axis=0)
-          if df3.loc[fs,].shape[0] < 1: # empty
-            continue
-          cl[fsn] = fs
-          #afs.extend(fs)
-
-          #c1 = df3.loc[fs,].sum(axis=0)
-          #c1 = c1 / np.sqrt(c1.pow(2).sum())
-          #if(len(cl.keys()) == 1):
-          #  centroids = c1.to_frame(fsn).T
-          #else:
-          #  centroids.loc[fsn] = c1
-
-        # now we have centroids and statistics
-        # let's subselect clusters
-        min_features = 200
-        if 'min_features' in param :
-          min_features = param['min_features']
+              if len(fpos) < 1: # empty
+                continue
+              cl[fsn] = fs
+              clpos[fsn] = fpos
+              #afs.extend(fs)
+
+              #c1 = df3.loc[fs,].sum(axis=0)
+              #c1 = c1 / np.sqrt(c1.pow(2).sum())
+              #if(len(cl.keys()) == 1):
+              #  centroids = c1.to_frame(fsn).T
+              #else:
+              #  centroids.loc[fsn] = c1
+
+            # now we have centroids and statistics
+            # let's subselect clusters
+            min_features = 200
+            if 'min_features' in param :
+              min_features = param['min_features']
         
-        c_stat.loc[:,'nmcor'] = c_stat.loc[:,'mcor'] / c_stat.loc[:,'mcor'].max()
-        c_stat.loc[:,'nstdstat'] = c_stat.loc[:,'stdstat'] / c_stat.loc[:,'stdstat'].max()
+            c_stat.loc[:,'nmcor'] = c_stat.loc[:,'mcor'] / c_stat.loc[:,'mcor'].max()
+            c_stat.loc[:,'nstdstat'] = c_stat.loc[:,'stdstat'] / c_stat.loc[:,'stdstat'].max()
         
-        if 'use_norm_weight' in param and param['use_norm_weight'] != 0:
-            if 'quantile_weight' in param:
-                c_stat.loc[:,'weight'] = c_stat.loc[:,'nmcor'] + float(param['quantile_weight']) * c_stat.loc[:,'nstdstat']
+            if 'use_norm_weight' in param and param['use_norm_weight'] != 0:
+                if 'quantile_weight' in param:
+                    c_stat.loc[:,'weight'] = c_stat.loc[:,'nmcor'] + float(param['quantile_weight']) * c_stat.loc[:,'nstdstat']
+                else:
+                    c_stat.loc[:,'weight'] = c_stat.loc[:,'nmcor'] + 1.0                             * c_stat.loc[:,'nstdstat']
             else:
-                c_stat.loc[:,'weight'] = c_stat.loc[:,'nmcor'] + 1.0                             * c_stat.loc[:,'nstdstat']
-        else:
-            if 'quantile_weight' in param:
-                c_stat.loc[:,'weight'] = c_stat.loc[:,'mcor'] + float(param['quantile_weight']) * c_stat.loc[:,'stdstat']
-            else:
-                c_stat.loc[:,'weight'] = c_stat.loc[:,'mcor'] + 0.1                             * c_stat.loc[:,'stdstat']
+                if 'quantile_weight' in param:
+                    c_stat.loc[:,'weight'] = c_stat.loc[:,'mcor'] + float(param['quantile_weight']) * c_stat.loc[:,'stdstat']
+                else:
+                    c_stat.loc[:,'weight'] = c_stat.loc[:,'mcor'] + 0.1                             * c_stat.loc[:,'stdstat']
 
-        c_stat.sort_values('weight', inplace=True, ascending=False)
+            c_stat.sort_values('weight', inplace=True, ascending=False)
 
-        pprint(c_stat)
+            pprint(c_stat)
 
-        centroids = pd.DataFrame()
-        for i in range(c_stat.shape[0]):
-            fsn = c_stat.index[i]
-            fs = cl[fsn]
-            if i != 0 and len(afs) + len(fs) > min_features :
-                break;
+            centroids = pd.DataFrame()
+            for i in range(c_stat.shape[0]):
+                fsn = c_stat.index[i]
+                fs = cl[fsn]
+                if i != 0 and len(afs) + len(fs) > min_features :
+                    break;
            
-            afs.extend(fs)
-
-            c1 = df3.loc[fs,].sum(axis=0)
-            c1 = c1 / np.sqrt(c1.pow(2).sum())
-            if(centroids.shape[0] < 1):
-              centroids = c1.to_frame(fsn).T
-            else:
-              centroids.loc[fsn] = c1
+                afs.extend(fs)
+
+                c1 = pd.DataFrame(l2.rows(clpos[fsn]), columns=df2.columns).sum(axis=0)
+                c1 = c1 / np.sqrt(c1.pow(2).sum())
+                if(centroids.shape[0] < 1):
+                  centroids = c1.to_frame(fsn).T
+                else:
+                  centroids.loc[fsn] = c1
            
-        pprint(centroids)
+            pprint(centroids)
         
-        if len(cl.keys()) == 0:
-            raise Exception("No feature ids were mapped to dataset or no clusters were selected")
+            if len(cl.keys()) == 0:
+                raise Exception("No feature ids were mapped to dataset or no clusters were selected")
         
-        # dataset centroid
-        dc = df3.loc[afs,].sum(axis=0)
-        dc = dc / np.sqrt(dc.pow(2).sum())
+            # normalized rows of the selected clusters only
+            apos = eindex.positions(afs, skip_missing=True)
+            df3 = pd.DataFrame(l2.rows(apos), index=df2.index[apos], columns=df2.columns)
+
+            # dataset centroid
+            dc = df3.loc[afs,].sum(axis=0)
+            dc = dc / np.sqrt(dc.pow(2).sum())
     
         
-        self.logger.info("Ordering Centroids and Data")
-        # the most far away cluster centroid from dataset centroid
-        fc = (centroids * dc).sum(axis=1).idxmin()
-        # the most far away centroid centroid from fc
-        ffc = (centroids * centroids.loc[fc,]).sum(axis=1).idxmin()
+            self.logger.info("Ordering Centroids and Data")
+            # the most far away cluster centroid from dataset centroid
+            fc = (centroids * dc).sum(axis=1).idxmin()
+            # the most far away centroid centroid from fc
+            ffc = (centroids * centroids.loc[fc,]).sum(axis=1).idxmin()
         
-        # major direction to order on unit ball space
-        md = centroids.loc[ffc,] - centroids.loc[fc,]
+            # major direction to order on unit ball space
+            md = centroids.loc[ffc,] - centroids.loc[fc,]
         
-        # unnormalized component of projection to the major direction (ignored md quantities because it is the same to all)
-        corder = (centroids * md).sum(axis=1).sort_values() # cluster order
-        coidx = corder.index
+            # unnormalized component of projection to the major direction (ignored md quantities because it is the same to all)
+            corder = (centroids * md).sum(axis=1).sort_values() # cluster order
+            coidx = corder.index
         
-        dorder =(df3.loc[afs,] * md).sum(axis=1).sort_values() # data order
+            dorder =(df3.loc[afs,] * md).sum(axis=1).sort_values() # data order
         
-        # get first fs table    
-        fig_properties = {"xlabel" : "Conditions", "ylabel" : "Features", "xlog_mode" : "none", "ylog_mode" : "none", "title" : "Log Fold Changes", "plot_type" : "heatmap", 'ygroup': []}
-        fig_properties['ygtick_labels'] = coidx.tolist()
-
-        if 'fold_change' in param and param['fold_change'] == 1:
-            frange = 2
-            if 'fold_change_range' in param:
-                frange = float(param['fold_change_range'])
-            final=fc_df.loc[dorder.loc[cl[coidx[0]],].index,]
-            fig_properties['ygroup'].append(final.shape[0])
+            # get first fs table    
+            fig_properties = {"xlabel" : "Conditions", "ylabel" : "Features", "xlog_mode" : "none", "ylog_mode" : "none", "title" : "Log Fold Changes", "plot_type" : "heatmap", 'ygroup': []}
+            fig_properties['ygtick_labels'] = coidx.tolist()
+
+            if 'fold_change' in param and param['fold_change'] == 1:
+                frange = 2
+                if 'fold_change_range' in param:
+                    frange = float(param['fold_change_range'])
+                final=fc_df.loc[dorder.loc[cl[coidx[0]],].index,]
+                fig_properties['ygroup'].append(final.shape[0])
             
-            for i in range(1,len(coidx)):
-                tf = fc_df.loc[dorder.loc[cl[coidx[i]],].index,]
-                fig_properties['ygroup'].append(tf.shape[0])
-                final = final.append(tf)
-
-            if 'fold_cutoff' in param and param['fold_cutoff'] == 1:
-                final[final > frange] = frange
-                final[final < - frange] = - frange
+                for i in range(1,len(coidx)):
+                    tf = fc_df.loc[dorder.loc[cl[coidx[i]],].index,]
+                    fig_properties['ygroup'].append(tf.shape[0])
+                    final = final.append(tf)
+
+                if 'fold_cutoff' in param and param['fold_cutoff'] == 1:
+                    final[final > frange] = frange
+                    final[final < - frange] = - frange
+                else:
+                    fc_df0b = final.sub(final.min(axis=1), axis=0)
+                    final = (fc_df0b.div(fc_df0b.max(axis=1), axis=0) - 0.5) * 2 * frange
             else:
-                fc_df0b = final.sub(final.min(axis=1), axis=0)
-                final = (fc_df0b.div(fc_df0b.max(axis=1), axis=0) - 0.5) * 2 * frange
-        else:
-            final=df2.loc[dorder.loc[cl[coidx[0]],].index,]
-            fig_properties['ygroup'].append(final.shape[0])
+                final=df2.loc[dorder.loc[cl[coidx[0]],].index,]
+                fig_properties['ygroup'].append(final.shape[0])
             
-            for i in range(1,len(coidx)):
-                tf = df2.loc[dorder.loc[cl[coidx[i]],].index,]
-                fig_properties['ygroup'].append(tf.shape[0])
-                final = final.append(tf)
+                for i in range(1,len(coidx)):
+                    tf = df2.loc[dorder.loc[cl[coidx[i]],].index,]
+                    fig_properties['ygroup'].append(tf.shape[0])
+                    final = final.append(tf)
         
-        ## loading pvalue distribution FDT
-        fdt = {'row_labels' :[], 'column_labels' : [], "data" : [[]]};
-        #fdt = OrderedDict(fdt)
-        # Nan to None
-        final = final.where(pd.notnull(final),None)
-        fdt['data'] = final.T.as_matrix().tolist() # make sure Transpose
-        fdt['row_labels'] = final.columns.tolist()
-        fdt['column_labels'] = final.index.tolist()
+            ## loading pvalue distribution FDT
+            fdt = {'row_labels' :[], 'column_labels' : [], "data" : [[]]};
+            #fdt = OrderedDict(fdt)
+            # Nan to None
+            final = final.where(pd.notnull(final),None)
+            fdt['data'] = final.T.as_matrix().tolist() # make sure Transpose
+            fdt['row_labels'] = final.columns.tolist()
+            fdt['column_labels'] = final.index.tolist()
+            self.result_cache.put(result_key, {'fdt': fdt, 'fig_properties': fig_properties})
         # TODO: Add group label later
         fdt['id'] = "{0}.fdt".format(param['out_figure_object_name'])
  
         self.logger.info("Saving the results")
-        sstatus = ws.save_objects({'workspace' : workspace_name, 'objects' : [{'type' : 'MAK.FloatDataTable',
-                                                                              'data' : fdt,
-                                                                              'hidden':1, 
-                                                                              'name' : "{0}.fdt".format(param['out_figure_object_name'])}]})
-
-        data_ref = "{0}/{1}/{2}".format(sstatus[0][6], sstatus[0][0], sstatus[0][4])
-        fig_properties['data_ref'] = data_ref
-
-        sstatus = ws.save_objects({'workspace' : workspace_name, 'objects' : [{'type' : 'CoExpression.FigureProperties',
-                                                                              'data' : fig_properties,
-                                                                              #'hidden':1, 
-                                                                              'name' : "{0}".format(param['out_figure_object_name'])}]})
-                                                                              #'name' : "{0}.fp".format(param['out_figure_object_name'])}]})
+        outputs = OutputBatch(ws, workspace_name)
+        outputs.add('fdt', {'type' : 'MAK.FloatDataTable',
+                            'data' : fdt,
+                            'hidden':1, 
+                            'name' : "{0}.fdt".format(param['out_figure_object_name'])})
+
+        def figure(refs):
+            fig_properties['data_ref'] = refs['fdt']
+            return {'type' : 'CoExpression.FigureProperties',
+                    'data' : fig_properties,
+                    #'hidden':1, 
+                    'name' : "{0}".format(param['out_figure_object_name'])}
+                    #'name' : "{0}.fp".format(param['out_figure_object_name'])}
+        outputs.add('figure', figure, ['fdt'])
+        outputs.save()
 
         #mchp = {}
         #mchp['figure_obj'] = "{0}/{1}/{2}".format(sstatus[0][6], sstatus[0][0], sstatus[0][4])
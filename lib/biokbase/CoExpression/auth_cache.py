@@ -0,0 +1,106 @@
+"""
+Cached token validation of the service front end.
+
+The generated CoExpressionServer validates the token of every authenticated
+request with the validate_token() of its auth client, a
+biokbase.nexus.Client.  Where the server creates that client it wraps it in
+a CachingAuthClient, which keeps the results in the two TokenCache
+instances of the Impl's AuthCache: validated tokens, and for a shorter time
+tokens the auth client rejected.
+
+Only definitive rejections are cached (see is_invalid_token()); connection
+problems, timeouts and error pages of the auth service are retried on the
+next request.
+"""
+import re
+import time
+
+from biokbase.CoExpression.token_cache import TokenCache
+
+DEFAULT_TTL = 300
+DEFAULT_FAILURE_TTL = 30
+DEFAULT_SIZE = 1000
+DEFAULT_STATS_INTERVAL = 1000
+
+# the client's own checks of a token: malformed, expired or badly signed
+INVALID_TOKEN_ERRORS = (ValueError, KeyError)
+# ValueErrors of the json module, raised when the signing key request returns an error page
+_JSON_ERROR = re.compile(r'No JSON object could be decoded|Expecting |Extra data|Unterminated string|'
+                         r'Invalid control character|Invalid \\escape')
+
+
+def is_invalid_token(error):
+    """True when error rejects the token itself, False for a transient failure."""
+    if isinstance(error, EnvironmentError):  # connection errors, timeouts and HTTP errors (requests' too)
+        return False
+    if isinstance(error, ValueError) and _JSON_ERROR.match(str(error)):
+        return False
+    return isinstance(error, INVALID_TOKEN_ERRORS)
+
+
+def _expired(result):
+    # validate_token() returns (user, client_id, expiry in seconds since the epoch)
+    try:
+        return time.time() > float(result[2])
+    except (IndexError, TypeError, ValueError):
+        return False
+
+
+class AuthCache(object):
+    """Validated and rejected token caches with their hit and miss counters."""
+
+    def __init__(self, ttl=DEFAULT_TTL, failure_ttl=DEFAULT_FAILURE_TTL, max_size=DEFAULT_SIZE,
+                 stats_interval=DEFAULT_STATS_INTERVAL, report=None):
+        self.valid_tokens = TokenCache(ttl, max_size)
+        self.failed_tokens = TokenCache(failure_ttl, max_size)
+        self.stats_interval = int(stats_interval)
+        self.report = report
+        self.lookups = 0
+
+    def validate(self, validate_token, token):
+        """Result of validate_token(token), from the caches when possible."""
+        try:
+            return self._validate(validate_token, token)
+        finally:
+            self._count()
+
+    def _validate(self, validate_token, token):
+        result = self.valid_tokens.get(token)
+        if result is not None:
+            if not _expired(result):
+                return result
+            self.valid_tokens.invalidate(token)
+        error = self.failed_tokens.get(token)
+        if error is not None:
+            raise error
+        try:
+            result = validate_token(token)
+        except Exception as e:
+            if is_invalid_token(e):
+                self.failed_tokens.put(token, e)
+            raise
+        self.valid_tokens.put(token, result)
+        return result
+
+    def stats(self):
+        """Hit/miss counters and sizes of the validated and rejected token caches."""
+        return {'valid': self.valid_tokens.stats(), 'failed': self.failed_tokens.stats()}
+
+    def _count(self):
+        self.lookups += 1
+        if self.report is not None and self.stats_interval > 0 and self.lookups % self.stats_interval == 0:
+            self.report(self.stats())
+
+
+class CachingAuthClient(object):
+    """An auth client (biokbase.nexus.Client) whose validate_token() goes through an AuthCache."""
+
+    def __init__(self, client, cache):
+        self.client = client
+        self.cache = cache
+
+    def validate_token(self, token):
+        return self.cache.validate(self.client.validate_token, token)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
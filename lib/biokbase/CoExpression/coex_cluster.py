@@ -0,0 +1,371 @@
+"""
+Native (in-process) counterpart of the clustering stage of coex_cluster2.
+
+The topological overlap matrix (TOM) of the WGCNA network is computed out of
+core: the adjacency is written to a memory-mapped file tile by tile and the
+overlap is computed in row blocks against it, with the block size derived
+from a memory budget, so that only a few blocks are resident at any time.
+
+Modules are then detected by hierarchical clustering of the dissimilarity
+memmap, done in place by nn_chain_linkage() so that no condensed copy is
+made, followed by a static (hclust) tree cut.  cutreeDynamic, which cuts
+the WGCNA tree, only exists in R: r_tree() converts the tree to the hclust
+object R would have built, for coex_cluster2 --tree to cut.  Modules are
+summarized with the mean correlation and msec statistics coex_cluster2
+writes to its cluster statistics file.
+"""
+import os
+
+import numpy as np
+from scipy.cluster import hierarchy
+
+import biokbase.CoExpression.coex_net as coex_net
+
+DEFAULT_MEMORY_BUDGET = 512 * 1024 * 1024  # bytes of block buffers
+ADJACENCY_FN = 'adjacency.mmap'
+DISS_TOM_FN = 'diss_tom.mmap'
+DISS_ADJ_FN = 'diss_adjacency.mmap'
+
+# coex_cluster2 defaults
+DEFAULT_MIN_MODULE_SIZE = 50
+DEFAULT_DETECT_CUT_HEIGHT = 0.99
+
+
+def block_rows(ngenes, memory_budget=DEFAULT_MEMORY_BUDGET, itemsize=8):
+    """
+    Number of rows per block so that two (rows x genes) panels and one
+    (rows x rows) result stay within memory_budget bytes.
+    """
+    ngenes = max(int(ngenes), 1)
+    rows = int(memory_budget // (itemsize * 2 * ngenes + 8 * ngenes))
+    return max(1, min(ngenes, rows))
+
+
+def adjacency_memmap(values, power, path, network_type='signed', dtype=np.float32,
+                     memory_budget=DEFAULT_MEMORY_BUDGET, kernel='pearson', precision=np.float64, z=None):
+    """
+    Write the WGCNA adjacency adjacency_base(r) ** power of the rows of a
+    (genes x samples) matrix to a (genes x genes) memory-mapped file with a
+    zero diagonal, r being the correlation of the kernel computed in
+    precision.  Returns the memmap and the connectivity of every gene.
+    z, when given, is coex_net.kernel_rows(values, kernel, precision)
+    computed earlier.
+    """
+    if z is None:
+        z = coex_net.kernel_rows(values, kernel, precision)
+    ngenes = z.shape[0]
+    adj = np.memmap(path, dtype=dtype, mode='w+', shape=(ngenes, ngenes))
+    k = np.zeros(ngenes)
+    itemsize = np.dtype(precision).itemsize
+    for i0, j0, tile in coex_net.iter_tiles(z, block_rows(ngenes, memory_budget, itemsize)):
+        a = coex_net.adjacency_base(tile, network_type) ** power
+        if i0 == j0:
+            np.fill_diagonal(a, 0)
+        i1, j1 = i0 + a.shape[0], j0 + a.shape[1]
+        adj[i0:i1, j0:j1] = a
+        k[i0:i1] += a.sum(axis=1)
+        if i0 != j0:
+            adj[j0:j1, i0:i1] = a.T
+            k[j0:j1] += a.sum(axis=0)
+    adj.flush()
+    return adj, k
+
+
+def tom_dissimilarity(values, power, workdir, network_type='signed', dtype=np.float32,
+                      memory_budget=DEFAULT_MEMORY_BUDGET, kernel='pearson', precision=np.float64, z=None):
+    """
+    1 - TOM of the WGCNA network of a (genes x samples) matrix, written to
+    workdir/diss_tom.mmap and returned as a (genes x genes) memmap.
+
+    The unsigned TOM of TOMsimilarity is used:
+    TOM_ij = (sum_u a_iu a_uj + a_ij) / (min(k_i, k_j) + 1 - a_ij) with a
+    zero-diagonal adjacency and TOM_ii = 1.  Blocks are multiplied in
+    precision.  The adjacency memmap is removed once the dissimilarity is
+    complete.
+    """
+    adj_path = _workfile(workdir, ADJACENCY_FN)
+    diss_path = _workfile(workdir, DISS_TOM_FN)
+    adj, k = adjacency_memmap(values, power, adj_path, network_type, dtype, memory_budget, kernel, precision, z)
+    ngenes = adj.shape[0]
+    diss = np.memmap(diss_path, dtype=dtype, mode='w+', shape=(ngenes, ngenes))
+
+    step = block_rows(ngenes, memory_budget, np.dtype(precision).itemsize)
+    for i0 in range(0, ngenes, step):
+        i1 = min(ngenes, i0 + step)
+        ai = np.asarray(adj[i0:i1], dtype=precision)
+        for j0 in range(i0, ngenes, step):
+            j1 = min(ngenes, j0 + step)
+            aj = ai if j0 == i0 else np.asarray(adj[j0:j1], dtype=precision)
+            aij = ai[:, j0:j1]
+            shared = ai.dot(aj.T)
+            denom = np.minimum(k[i0:i1, None], k[None, j0:j1]) + 1 - aij
+            tom = (shared + aij) / denom
+            if i0 == j0:
+                np.fill_diagonal(tom, 1)
+            diss[i0:i1, j0:j1] = 1 - tom
+            if i0 != j0:
+                diss[j0:j1, i0:i1] = (1 - tom).T
+    diss.flush()
+    del adj, diss
+    os.remove(adj_path)
+    return np.memmap(diss_path, dtype=dtype, mode='r+', shape=(ngenes, ngenes))
+
+
+def adjacency_dissimilarity(values, path, net_method='simple', power=None, block_size=coex_net.DEFAULT_BLOCK_SIZE,
+                            kernel='pearson', precision=np.float64, z=None):
+    """
+    1 - adjacency of the coex_cluster2 network: the correlation r of the
+    kernel for 'simple' and the signed adjacency ((1 + r) / 2) ** power for
+    'WGCNA', computed tile by tile and written to a float64 (genes x genes)
+    memmap at path, which is returned.
+    """
+    if z is None:
+        z = coex_net.kernel_rows(values, kernel, precision)
+    n = z.shape[0]
+    diss = np.memmap(path, dtype=np.float64, mode='w+', shape=(n, n))
+    for i0, j0, tile in coex_net.iter_tiles(z, block_size):
+        d = 1 - _adjacency(tile, net_method, power)
+        i1, j1 = i0 + d.shape[0], j0 + d.shape[1]
+        diss[i0:i1, j0:j1] = d
+        if i0 != j0:
+            diss[j0:j1, i0:i1] = d.T
+    return diss
+
+
+def nn_chain_linkage(diss, method='average'):
+    """
+    hierarchy.linkage() of a square dissimilarity matrix or memmap for the
+    'average' or 'complete' method, computed in place: diss is overwritten.
+
+    This is scipy's nearest-neighbor chain algorithm, with the same tie
+    breaking and labelling, so a float64 diss gives the same linkage matrix.
+    It reads one row of diss per step and rewrites the row and column of
+    every merged cluster instead of working on a condensed copy, so apart
+    from diss itself it needs memory linear in the number of genes.
+    """
+    if method not in ['average', 'complete']:
+        raise ValueError("Unsupported linkage method '{0}'".format(method))
+    n = diss.shape[0]
+    tree = np.zeros((max(n - 1, 0), 4))
+    size = np.ones(n, dtype=int)
+    active = np.ones(n, dtype=bool)
+    chain = []
+    for k in range(n - 1):
+        if not chain:
+            chain.append(int(np.argmax(active)))
+        while True:
+            x = chain[-1]
+            row = np.where(active, diss[x], np.inf)
+            row[x] = np.inf
+            y = int(np.argmin(row))
+            # the previous element of the chain wins ties, which ends the chain
+            if len(chain) > 1 and not row[y] < row[chain[-2]]:
+                y = chain[-2]
+                break
+            chain.append(y)
+        dist = row[y]
+        del chain[-2:]
+        x, y = min(x, y), max(x, y)
+        nx, ny = size[x], size[y]
+        tree[k] = x, y, dist, nx + ny
+        active[x] = False
+        size[x], size[y] = 0, nx + ny
+
+        others = np.nonzero(active)[0]
+        others = others[others != y]
+        dx, dy = np.asarray(diss[x])[others], np.asarray(diss[y])[others]
+        if method == 'average':
+            d = (nx * dx + ny * dy) / (nx + ny)
+        else:
+            d = np.maximum(dx, dy)
+        diss[y, others] = d
+        diss[others, y] = d
+
+    tree = tree[np.argsort(tree[:, 2], kind='mergesort')]
+    _label(tree, n)
+    return tree
+
+
+def cutree_k(linkage, k):
+    """
+    Cut a tree into k groups like R's cutree(tree, k): groups are numbered
+    in order of first appearance of their members.
+    """
+    groups = hierarchy.fcluster(linkage, int(k), criterion='maxclust')
+    return _renumber(groups)
+
+
+def r_tree(linkage):
+    """
+    merge, height and order of the hclust object R builds for the tree of a
+    linkage matrix.  In merge, gene i is -(i + 1) and the cluster formed by
+    merge step k is k (1-based); a gene comes before a cluster, otherwise
+    the smaller number first.  order lists the 1-based genes from left to
+    right in the dendrogram.
+    """
+    n = linkage.shape[0] + 1
+    merge = np.zeros((n - 1, 2), dtype=int)
+    for i in range(n - 1):
+        pair = [-(int(c) + 1) if c < n else int(c) - n + 1 for c in linkage[i, :2]]
+        merge[i] = sorted(pair, key=lambda m: (m > 0, abs(m)))
+    order = []
+    stack = [n - 1] if n > 1 else [-1]
+    while stack:
+        m = stack.pop()
+        if m < 0:
+            order.append(-m)
+        else:
+            stack.extend([merge[m - 1, 1], merge[m - 1, 0]])
+    return merge, linkage[:, 2].copy(), np.array(order)
+
+
+def write_r_tree(path, linkage):
+    """
+    Write the tree of a linkage matrix for coex_cluster2 --tree: the merge
+    and height of r_tree() as a tab separated table to path and the order
+    to path.order, one leaf per line.
+    """
+    merge, height, order = r_tree(linkage)
+    with open(path, 'w') as fh:
+        fh.write("merge1\tmerge2\theight\n")
+        for (a, b), h in zip(merge, height):
+            fh.write("{0}\t{1}\t{2!r}\n".format(a, b, float(h)))
+    with open(path + '.order', 'w') as fh:
+        fh.write("".join(["{0}\n".format(i) for i in order]))
+
+
+def module_stats(values, modules, net_method='simple', power=None, kernel='pearson', precision=np.float64, z=None):
+    """
+    Per-module statistics of coex_cluster2 in order of first appearance:
+    the mean adjacency within the module (diagonal included) and msec, the
+    mean squared deviation from the sample means relative to the overall
+    mean squared deviation of the module.  Returns a list of
+    (module, mcor, msec).
+    """
+    values = np.asarray(values, dtype=float)
+    if z is None:
+        z = coex_net.kernel_rows(values, kernel, precision)
+    modules = np.asarray(modules)
+    stats = []
+    for module in _unique(modules):
+        rows = np.nonzero(modules == module)[0]
+        total = 0.0
+        for i0, j0, tile in coex_net.iter_tiles(z[rows]):
+            a = _adjacency(tile, net_method, power)
+            if i0 == j0:
+                np.fill_diagonal(a, 1)
+                total += a.sum()
+            else:
+                total += 2 * a.sum()
+        mcor = total / float(len(rows) * len(rows))
+
+        data = values[rows]
+        mse_all = np.nanmean((data - np.nanmean(data)) ** 2)
+        msec = np.nanmean((data - np.nanmean(data, axis=0)) ** 2 / mse_all)
+        stats.append((module, mcor, msec))
+    return stats
+
+
+def detect_modules(values, net_method='simple', clust_method='WGCNA', power=None,
+                   min_module_size=DEFAULT_MIN_MODULE_SIZE, detect_cut_height=DEFAULT_DETECT_CUT_HEIGHT,
+                   workdir='.', memory_budget=DEFAULT_MEMORY_BUDGET, precision=None, z=None,
+                   tree_cut=None):
+    """
+    In-process replacement of coex_cluster2's clustering for a
+    (genes x samples) matrix.
+
+    'hclust' uses complete linkage on 1 - adjacency cut into min_module_size
+    groups, as coex_cluster2 does.  'WGCNA' uses average linkage on the
+    out-of-core TOM dissimilarity (heights rounded to 6 digits) cut by
+    tree_cut(linkage, detect_cut_height, min_module_size), which returns the
+    module of every gene and must be given since cutreeDynamic only exists
+    in R (see write_r_tree).  net_method selects the network and
+    correlation kernel (see coex_net.NET_METHODS) and precision ('float64'
+    or 'float32') the arithmetic.  z optionally
+    gives the kernel rows of values in that precision, e.g. a stored
+    normalized.NormalizedMatrix, so they are not recomputed.  The
+    dissimilarity is a float64 memmap in workdir, clustered in place by
+    nn_chain_linkage() and removed afterwards.  Returns the module name of
+    every gene and module_stats.
+    """
+    min_module_size = DEFAULT_MIN_MODULE_SIZE if min_module_size is None else int(float(min_module_size))
+    detect_cut_height = DEFAULT_DETECT_CUT_HEIGHT if detect_cut_height is None else float(detect_cut_height)
+    net_method, kernel = coex_net.network_method(net_method)
+    precision = coex_net.precision_dtype(precision)
+    if net_method == 'WGCNA' and power is None:
+        raise ValueError("Soft threshold power is required for the WGCNA network")
+
+    if clust_method in ['hclust', 'h']:
+        diss_path = _workfile(workdir, DISS_ADJ_FN)
+        diss = adjacency_dissimilarity(values, diss_path, net_method, power, kernel=kernel, precision=precision, z=z)
+        tree = nn_chain_linkage(diss, 'complete')
+        del diss
+        os.remove(diss_path)
+        modules = [str(x) for x in cutree_k(tree, min_module_size)]
+    elif clust_method in ['WGCNA', 'w']:
+        if net_method != 'WGCNA':
+            raise ValueError("WGCNA clustering requires an adjacency between 0 and 1 (net_method WGCNA)")
+        if tree_cut is None:
+            raise ValueError("WGCNA clustering needs a tree cut: cutreeDynamic is only available in R")
+        diss = tom_dissimilarity(values, power, workdir, dtype=np.float64, memory_budget=memory_budget,
+                                 kernel=kernel, precision=precision, z=z)
+        tree = nn_chain_linkage(diss, 'average')
+        del diss
+        os.remove(os.path.join(workdir, DISS_TOM_FN))
+        tree[:, 2] = np.round(tree[:, 2], 6)
+        modules = list(tree_cut(tree, detect_cut_height, min_module_size))
+    else:
+        raise ValueError("Please indicate a correct method. See help")
+    return modules, module_stats(values, modules, net_method, power, kernel, precision, z)
+
+
+def _adjacency(r, net_method, power):
+    if net_method == 'WGCNA':
+        return coex_net.adjacency_base(r, 'signed') ** power
+    return r
+
+
+def _workfile(workdir, fn):
+    try:
+        os.makedirs(workdir)
+    except OSError:
+        pass
+    return os.path.join(workdir, fn)
+
+
+def _label(tree, n):
+    # scipy's labelling of merges sorted by height: the cluster formed by merge i is n + i
+    parent = range(2 * n - 1)
+    size = [1] * (2 * n - 1)
+
+    def find(x):
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    for i in range(n - 1):
+        x, y = find(int(tree[i, 0])), find(int(tree[i, 1]))
+        tree[i, 0], tree[i, 1] = min(x, y), max(x, y)
+        parent[x] = parent[y] = n + i
+        size[n + i] = size[x] + size[y]
+        tree[i, 3] = size[n + i]
+
+
+def _renumber(groups):
+    mapping = {}
+    for g in groups:
+        if g not in mapping:
+            mapping[g] = len(mapping) + 1
+    return np.array([mapping[g] for g in groups])
+
+
+def _unique(x):
+    seen, out = set(), []
+    for v in x:
+        if v not in seen:
+            seen.add(v)
+            out.append(v)
+    return out
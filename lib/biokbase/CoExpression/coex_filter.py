@@ -0,0 +1,379 @@
+"""
+Native (in-process) counterpart of the coex_filter R tool.
+
+The functions here reproduce the per-gene statistics and the gene selection
+rules of scripts/coex_filter.R on a (genes x samples) numpy array so that
+CoExpression.filter_genes can skip the TSV round trip and the R start-up.
+"""
+import numpy as np
+from scipy import special, stats
+
+NA_PVALUE = 1.1  # coex_filter replaces NA/NaN p-values by 1.1
+# num_features rules: coex_filter's which(order(p) <= n), or the n smallest p-values
+SELECTIONS = ['coex_filter', 'top']
+PV_BINS = 50  # coex_filter plots its p-value histogram with 50 breaks
+
+# limma eBayes defaults
+LOR_PROPORTION = 0.01
+LOR_STDEV_COEF_LIM = (0.1, 4)
+
+
+def expand_samples(values, sample_index=None):
+    """
+    Apply the replicate handling of coex_filter to the data matrix.
+
+    When every column is its own group (the layout CoExpression writes to
+    sample.tsv), coex_filter duplicates the matrix and uses 1..n twice as
+    sample index.  Returns the (possibly duplicated) matrix and the sample
+    index as a float vector.
+    """
+    values = np.asarray(values, dtype=float)
+    ncol = values.shape[1]
+    if sample_index is None:
+        sample_index = range(ncol)
+    sample_index = np.asarray(sample_index, dtype=float)
+    if len(sample_index) != ncol:
+        raise ValueError("the length of sample index should be equal to the number of data columns")
+    if len(np.unique(sample_index)) == ncol:
+        sample_index = np.tile(np.arange(1, ncol + 1, dtype=float), 2)
+        values = np.hstack([values, values])
+    return values, sample_index
+
+
+def anova_pvalues(values, sample_index=None, correction='none'):
+    """
+    Per-gene ANOVA p-values for a (genes x samples) matrix in one batched pass.
+
+    coex_filter runs aov(y ~ sample_index) with a numeric sample index, so the
+    model has a single degree of freedom; the F statistic and its p-value are
+    computed here for all genes at once from centered cross products.  Missing
+    values are dropped per gene as aov does.  Returns (F, p) where p is
+    adjusted with p_adjust(correction) and undefined p-values are set to
+    NA_PVALUE like coex_filter.
+    """
+    y, x = expand_samples(values, sample_index)
+    mask = ~np.isnan(y)
+    n = mask.sum(axis=1).astype(float)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # per-gene centering of the covariate and the response
+        xm = mask.dot(x) / n
+        ym = np.where(mask, y, 0.0).sum(axis=1) / n
+        yc = np.where(mask, y - ym[:, None], 0.0)
+        xc = np.where(mask, x[None, :] - xm[:, None], 0.0)
+
+        sxx = (xc * xc).sum(axis=1)
+        sxy = (xc * yc).sum(axis=1)
+        syy = (yc * yc).sum(axis=1)
+
+        ssr = sxy * sxy / sxx
+        rss = np.maximum(syy - ssr, 0.0)
+        df = n - 2
+        fstat = ssr / (rss / df)
+        pvalues = special.fdtrc(1, np.where(df > 0, df, np.nan), fstat)
+
+    pvalues[~np.isfinite(pvalues)] = np.nan
+    pvalues = p_adjust(pvalues, correction)
+    pvalues[np.isnan(pvalues)] = NA_PVALUE
+    return fstat, pvalues
+
+
+def lor_design(sample_index):
+    """
+    Design matrix coex_filter hands to limma::lmFit.
+
+    The DES factor is built from the unique sample indices, each repeated as
+    many times as it occurs, and its levels are sorted as strings, which is
+    what as.factor does; the intercept plus one indicator column per
+    non-reference level is the model.matrix(~DES) design.
+    """
+    labels = []
+    for x in _unique(sample_index):
+        labels.extend(['S' + _format_number(x)] * int((sample_index == x).sum()))
+    levels = sorted(set(labels))
+    design = np.ones((len(labels), len(levels)))
+    for j, level in enumerate(levels[1:]):
+        design[:, j + 1] = [l == level for l in labels]
+    return design
+
+
+def lor_stats(values, sample_index=None, coef=1):
+    """
+    limma-style moderated statistics (lmFit + eBayes + topTable) for one
+    coefficient of the coex_filter design, for all genes at once.
+
+    Least squares fits are computed with one pseudo-inverse per pattern of
+    missing values, the residual variances are shrunk towards a common prior
+    estimated across all genes (squeezeVar), and the moderated t, its p-value
+    and the B (log-odds) statistic follow eBayes.  Returns a dict with 't',
+    'p_value', 'adj_p_value' (Benjamini-Hochberg), 'lods' and 'order', the
+    topTable ranking by decreasing B.
+    """
+    y, x = expand_samples(values, sample_index)
+    design = lor_design(x)
+    ngenes = y.shape[0]
+
+    beta = np.empty(ngenes)
+    unscaled = np.empty(ngenes)
+    sigma2 = np.empty(ngenes)
+    df = np.empty(ngenes)
+    mask = ~np.isnan(y)
+    patterns, pidx = _unique_rows(mask)
+    for k, pattern in enumerate(patterns):
+        rows = np.nonzero(pidx == k)[0]
+        X = design[pattern]
+        rank = np.linalg.matrix_rank(X) if X.shape[0] > 0 else 0
+        rdf = X.shape[0] - rank
+        if rank < design.shape[1] or rdf < 1:
+            beta[rows], unscaled[rows], sigma2[rows], df[rows] = np.nan, np.nan, np.nan, 0
+            continue
+        Y = y[rows][:, pattern]
+        B = np.linalg.pinv(X).dot(Y.T)
+        resid = Y - X.dot(B).T
+        beta[rows] = B[coef]
+        unscaled[rows] = np.sqrt(np.linalg.inv(X.T.dot(X))[coef, coef])
+        sigma2[rows] = (resid * resid).sum(axis=1) / rdf
+        df[rows] = rdf
+
+    # empirical Bayes shrinkage of the residual variances
+    s2_prior, df_prior = _fit_f_dist(sigma2, df)
+    if np.isinf(df_prior):
+        s2_post = np.repeat(s2_prior, ngenes)
+    else:
+        s2_post = (df * sigma2 + df_prior * s2_prior) / (df + df_prior)
+    df_total = np.minimum(df + df_prior, df[np.isfinite(sigma2)].sum())
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = beta / unscaled / np.sqrt(s2_post)
+        p_value = 2 * stats.t.sf(np.abs(t), df_total)
+
+        # B statistic
+        var_prior_lim = np.array(LOR_STDEV_COEF_LIM) ** 2 / s2_prior
+        var_prior = _tmixture(t, unscaled, df_total, LOR_PROPORTION, var_prior_lim)
+        if np.isnan(var_prior):
+            var_prior = 1.0 / s2_prior
+        r = (unscaled ** 2 + var_prior) / unscaled ** 2
+        t2 = t ** 2
+        if df_prior > 1e6:
+            kernel = t2 * (1 - 1 / r) / 2
+        else:
+            kernel = (1 + df_total) / 2 * np.log((t2 + df_total) / (t2 / r + df_total))
+        lods = np.log(LOR_PROPORTION / (1 - LOR_PROPORTION)) - np.log(r) / 2 + kernel
+
+    adj_p_value = p_adjust(p_value, 'BH')
+    order = np.argsort(-np.where(np.isnan(lods), -np.inf, lods), kind='mergesort')
+    return {'t': t, 'p_value': p_value, 'adj_p_value': adj_p_value, 'lods': lods, 'order': order}
+
+
+def lor_pvalues(values, sample_index=None, correction='BH'):
+    """
+    p-values coex_filter -m lor uses for selection (BH adjusted by default,
+    like topTable's adj.P.Val) in row order, and the topTable ranking.
+    """
+    res = lor_stats(values, sample_index)
+    if correction == 'BH':
+        pvalues = res['adj_p_value'].copy()
+    else:
+        pvalues = p_adjust(res['p_value'], correction)
+    pvalues[~np.isfinite(pvalues)] = NA_PVALUE
+    return pvalues, res['order']
+
+
+def p_adjust(pvalues, method='BH'):
+    """
+    Adjust p-values for multiple testing like R's p.adjust with method 'BH'
+    (or its alias 'fdr'), 'bonferroni' or 'none'; missing values are kept and
+    do not count as tests.
+    """
+    pvalues = np.asarray(pvalues, dtype=float)
+    adjusted = np.full(pvalues.shape, np.nan)
+    ok = ~np.isnan(pvalues)
+    p = pvalues[ok]
+    n = len(p)
+    if n == 0:
+        return adjusted
+    if method in ['BH', 'fdr']:
+        o = np.argsort(-p, kind='mergesort')
+        i = np.arange(n, 0, -1, dtype=float)
+        adj = np.empty(n)
+        adj[o] = np.minimum(1.0, np.minimum.accumulate(n / i * p[o]))
+    elif method == 'bonferroni':
+        adj = np.minimum(1.0, n * p)
+    elif method == 'none':
+        adj = p
+    else:
+        raise ValueError("Unknown p-value adjustment method '{0}'".format(method))
+    adjusted[ok] = adj
+    return adjusted
+
+
+def select_genes(pvalues, p_value=None, num_features=None, order=None, selection='coex_filter'):
+    """
+    Select genes following the rules of coex_filter.
+
+    Genes with p-value below p_value are kept; num_features then limits the
+    selection (or selects among all genes when no p-value cut-off below one
+    is given).  order is the ranking in which coex_filter lists its genes
+    (row order by default); the returned row indices follow that order.
+
+    With selection 'coex_filter' the num_features cut is coex_filter's
+    genelist[which(order(p) <= n)]: the genes listed at the sorted positions
+    of the first n listed genes, which are the n most significant genes only
+    when the listing is already sorted by p-value (as for lor).  'top' keeps
+    the n smallest p-values instead, ties broken by listing order.  Raises
+    ValueError with the coex_filter messages when no selection can be made.
+    """
+    if selection not in SELECTIONS:
+        raise ValueError("Unknown gene selection '{0}'".format(selection))
+    pvalues = np.asarray(pvalues, dtype=float)
+    if order is None:
+        order = np.arange(len(pvalues))
+    order = np.asarray(order)
+    p_threshold = 1.01 if p_value is None else float(p_value)
+    topnumber = 0 if num_features is None else int(num_features)
+
+    if topnumber > len(pvalues):
+        raise ValueError('Requested top genes are more than total genes.')
+    if not (pvalues < p_threshold).any():
+        raise ValueError('No highly differentially expressed gene was found. Please increase p-value threshold.')
+
+    cut = _order_le if selection == 'coex_filter' else _top_genes
+    ranked = pvalues[order]
+    if p_threshold < 1:
+        keep = ranked < p_threshold
+        selected = order[keep]
+        if topnumber > 0 and topnumber <= len(selected):
+            selected = selected[cut(ranked[keep], topnumber)]
+    elif topnumber > 0:
+        selected = order[cut(ranked, topnumber)]
+    else:
+        raise ValueError('Please specify either p-value or number of genes.')
+    return selected
+
+
+def pvalue_histogram(pvalues, bins=PV_BINS):
+    """
+    Histogram of -log2(p) over equal-width bins spanning the data.  Zero
+    p-values are taken at the smallest positive double.  Returns the bin
+    edges and the count of every bin (the last bin is right closed).
+    """
+    x = -np.log2(np.maximum(np.asarray(pvalues, dtype=float), np.finfo(float).tiny))
+    counts, edges = np.histogram(x[~np.isnan(x)], bins)
+    return edges, counts
+
+
+def _order_le(p, topnumber):
+    # 0-based which(order(p) <= topnumber) of R: order is stable and puts NaN last
+    return np.nonzero(np.argsort(p, kind='mergesort') < topnumber)[0]
+
+
+def _top_genes(p, topnumber):
+    # positions of the topnumber smallest p in listing order by O(n) partial
+    # selection, ties at the cut broken by that order
+    if topnumber >= len(p):
+        return np.arange(len(p))
+    kth = np.partition(p, topnumber - 1)[topnumber - 1]
+    below = np.nonzero(p < kth)[0]
+    ties = np.nonzero(p == kth)[0][:topnumber - len(below)]
+    return np.sort(np.concatenate([below, ties]))
+
+
+def _fit_f_dist(x, df1):
+    # limma::fitFDist without covariate: moment estimation of the scaled F prior
+    ok = np.isfinite(df1) & (df1 > 1e-15) & np.isfinite(x) & (x > -1e-15)
+    x, df1 = x[ok], df1[ok]
+    n = len(x)
+    if n == 0:
+        return np.nan, np.nan
+    x = np.maximum(x, 0)
+    m = np.median(x)
+    if m == 0:
+        m = 1
+    x = np.maximum(x, 1e-5 * m)
+    e = np.log(x) - special.digamma(df1 / 2) + np.log(df1 / 2)
+    emean = e.mean()
+    evar = ((e - emean) ** 2).sum() / (n - 1) if n > 1 else np.nan
+    evar -= special.polygamma(1, df1 / 2).mean()
+    if evar > 0:
+        df2 = 2 * _trigamma_inverse(evar)
+        s20 = np.exp(emean + special.digamma(df2 / 2) - np.log(df2 / 2))
+    else:
+        df2 = np.inf
+        s20 = np.exp(emean)
+    return s20, df2
+
+
+def _trigamma_inverse(x):
+    # Newton iteration of limma::trigammaInverse for a scalar
+    if x > 1e7:
+        return 1 / np.sqrt(x)
+    if x < 1e-6:
+        return 1 / x
+    y = 0.5 + 1 / x
+    for i in range(50):
+        tri = special.polygamma(1, y)
+        dif = tri * (1 - tri / x) / special.polygamma(2, y)
+        y += dif
+        if -dif / y < 1e-8:
+            break
+    return y
+
+
+def _tmixture(tstat, stdev_unscaled, df, proportion, v0_lim):
+    # limma::tmixture.vector: prior variance of the non-null coefficients
+    ok = ~np.isnan(tstat)
+    tstat, stdev_unscaled, df = np.abs(tstat[ok]), stdev_unscaled[ok], df[ok]
+    ngenes = len(tstat)
+    ntarget = int(np.ceil(proportion / 2 * ngenes))
+    if ntarget < 1:
+        return np.nan
+    p = max(float(ntarget) / ngenes, proportion)
+    maxdf = df.max()
+    i = df < maxdf
+    if i.any():
+        tailp = stats.t.logsf(tstat[i], df[i])
+        tstat[i] = stats.t.isf(np.exp(tailp), maxdf)
+        df[i] = maxdf
+    o = np.argsort(-tstat, kind='mergesort')[:ntarget]
+    tstat = tstat[o]
+    v1 = stdev_unscaled[o] ** 2
+    r = ntarget - stats.rankdata(tstat) + 1
+    p0 = 2 * stats.t.sf(tstat, maxdf)
+    ptarget = ((r - 0.5) / ngenes - (1 - p) * p0) / p
+    v0 = np.zeros(ntarget)
+    pos = ptarget > p0
+    if pos.any():
+        qtarget = -stats.t.ppf(ptarget[pos] / 2, maxdf)
+        v0[pos] = v1[pos] * ((tstat[pos] / qtarget) ** 2 - 1)
+    v0 = np.minimum(np.maximum(v0, v0_lim[0]), v0_lim[1])
+    return v0.mean()
+
+
+def _unique(x):
+    # unique values in order of first appearance, like R's unique()
+    seen, out = set(), []
+    for v in x:
+        if v not in seen:
+            seen.add(v)
+            out.append(v)
+    return out
+
+
+def _unique_rows(mask):
+    # distinct rows of a boolean matrix and the pattern index of every row
+    if mask.shape[0] == 0:
+        return mask[:0], np.zeros(0, dtype=int)
+    packed = np.packbits(mask, axis=1)
+    keys = [row.tostring() for row in packed]
+    index, patterns, pidx = {}, [], np.empty(len(keys), dtype=int)
+    for i, key in enumerate(keys):
+        if key not in index:
+            index[key] = len(patterns)
+            patterns.append(mask[i])
+        pidx[i] = index[key]
+    return patterns, pidx
+
+
+def _format_number(x):
+    # as R's paste() prints a number
+    return str(int(x)) if float(x).is_integer() else repr(float(x))
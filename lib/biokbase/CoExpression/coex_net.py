@@ -0,0 +1,316 @@
+"""
+Native (in-process) counterpart of the coex_net R tool.
+
+Gene-gene correlation is computed tile by tile from row-standardized
+expression values with matrix products, and only the pairs above the edge
+cut-off are kept in a sparse matrix, so peak memory is bounded by the tile
+size instead of genes x genes.
+
+The correlation kernel (Pearson, Spearman or biweight midcorrelation) only
+changes how the rows are transformed before the products, so every kernel
+runs at matrix-product speed, in float64 or float32.
+"""
+import numpy as np
+from scipy import sparse
+
+DEFAULT_CUT_OFF = 0.75  # coex_net default corr_thld
+DEFAULT_BLOCK_SIZE = 2048  # genes per tile side
+
+# coex_net / coex_cluster2 defaults for the WGCNA soft threshold
+DEFAULT_MIN_RSQ = 0.8
+DEFAULT_MAX_MEDIAN_K = 40
+DEFAULT_MAX_POWER = 50
+SFT_COLUMNS = ['Power', 'SFT.R.sq', 'slope', 'truncated.R.sq', 'mean.k.', 'median.k.', 'max.k.']
+
+# net_method -> (network, correlation kernel)
+NET_METHODS = {'simple': ('simple', 'pearson'), 's': ('simple', 'pearson'),
+               'spearman': ('simple', 'spearman'), 'bicor': ('simple', 'bicor'),
+               'WGCNA': ('WGCNA', 'pearson'), 'w': ('WGCNA', 'pearson'),
+               'WGCNA-spearman': ('WGCNA', 'spearman'), 'WGCNA-bicor': ('WGCNA', 'bicor')}
+PRECISIONS = {'float64': np.float64, 'float32': np.float32}
+
+
+def standardize(values, dtype=np.float64):
+    """
+    Center every row and scale it to unit length so that the dot product of
+    two rows is their Pearson correlation.  Missing values are set to the row
+    mean and constant rows become all zeros (correlation 0 with every gene).
+    """
+    z = np.array(values, dtype=dtype)
+    mask = np.isnan(z)
+    if mask.any():
+        n = (~mask).sum(axis=1)
+        means = np.where(mask, 0, z).sum(axis=1) / np.maximum(n, 1)
+        z[mask] = np.take(means, np.nonzero(mask)[0])
+    z -= z.mean(axis=1)[:, None]
+    norms = np.sqrt((z * z).sum(axis=1))
+    norms[norms == 0] = 1
+    z /= norms[:, None]
+    return z
+
+
+def rank_rows(values):
+    """
+    Average ranks of every row (ties share their mean rank), with missing
+    values left missing.
+    """
+    x = np.array(values, dtype=np.float64)
+    if x.size == 0:
+        return x
+    nrow, ncol = x.shape
+    # missing values sort last, so the present values get ranks 1..n
+    order = np.argsort(x, axis=1, kind='mergesort')
+    rows = np.arange(nrow)[:, None]
+    sx = x[rows, order]
+    starts = np.ones(x.shape, dtype=bool)
+    starts[:, 1:] = sx[:, 1:] != sx[:, :-1]
+    # runs of equal values over all rows at once (every row starts a run)
+    run = np.cumsum(starts.ravel()) - 1
+    first = np.tile(np.arange(ncol), nrow)[starts.ravel()]
+    mean_rank = first + (np.bincount(run) - 1) / 2.0 + 1
+    ranks = np.empty(x.shape)
+    ranks[rows, order] = mean_rank[run].reshape(x.shape)
+    ranks[np.isnan(x)] = np.nan
+    return ranks
+
+
+def biweight_rows(values, dtype=np.float64):
+    """
+    Rows weighted and scaled so that the dot product of two rows is their
+    biweight midcorrelation: u = (x - median) / (9 mad) and
+    w = (1 - u^2)^2 for |u| < 1.  Rows with zero mad fall back to Pearson,
+    and missing values contribute nothing.
+    """
+    x = np.array(values, dtype=dtype)
+    med = _nanmedian(x)
+    dev = x - med[:, None]
+    mad = _nanmedian(np.abs(dev))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        u = dev / (9 * mad[:, None])
+        w = np.where(np.abs(u) < 1, (1 - u * u) ** 2, 0)
+    z = np.where(np.isnan(x), 0, dev * w).astype(dtype)
+    fallback = mad == 0
+    if fallback.any():
+        z[fallback] = standardize(x[fallback], dtype)
+    norms = np.sqrt((z * z).sum(axis=1))
+    norms[norms == 0] = 1
+    z /= norms[:, None]
+    return z
+
+
+def kernel_rows(values, kernel='pearson', dtype=np.float64):
+    """
+    Transform the rows of a (genes x samples) matrix for a correlation
+    kernel ('pearson', 'spearman' or 'bicor') so that z z' is the
+    correlation matrix.
+    """
+    if kernel == 'pearson':
+        return standardize(values, dtype)
+    elif kernel == 'spearman':
+        return standardize(rank_rows(values), dtype)
+    elif kernel == 'bicor':
+        return biweight_rows(values, dtype)
+    raise ValueError("Unknown correlation kernel '{0}'".format(kernel))
+
+
+def network_method(net_method):
+    """
+    Split a net_method into its network ('simple' or 'WGCNA') and correlation
+    kernel.  Raises ValueError for unknown methods.
+    """
+    if net_method not in NET_METHODS:
+        raise ValueError("Please indicate a correct method. See help")
+    return NET_METHODS[net_method]
+
+
+def precision_dtype(precision):
+    """numpy dtype of a precision name ('float64' by default or 'float32')."""
+    if precision is None:
+        return np.float64
+    if precision not in PRECISIONS:
+        raise ValueError("Unknown precision '{0}'".format(precision))
+    return PRECISIONS[precision]
+
+
+def iter_tiles(z, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Yield (i0, j0, tile) for the upper triangle of z z' in square tiles of
+    at most block_size x block_size, where tile = z[i0:i1] z[j0:j1]'.
+    """
+    ngenes = z.shape[0]
+    for i0 in range(0, ngenes, block_size):
+        zi = z[i0:i0 + block_size]
+        for j0 in range(i0, ngenes, block_size):
+            yield i0, j0, zi.dot(z[j0:j0 + block_size].T)
+
+
+def correlation_edges(values, cut_off=DEFAULT_CUT_OFF, block_size=DEFAULT_BLOCK_SIZE,
+                      kernel='pearson', dtype=np.float64):
+    """
+    Correlation network of the rows of a (genes x samples) matrix.
+
+    Returns a scipy.sparse.csr_matrix holding, for i < j, the correlation of
+    every gene pair with r > cut_off (the signed threshold coex_net applies
+    for the 'simple' method).  Self edges are not stored.
+    """
+    if cut_off is None:
+        cut_off = DEFAULT_CUT_OFF
+    cut_off = float(cut_off)
+    z = kernel_rows(values, kernel, dtype)
+    ngenes = z.shape[0]
+
+    rows, cols, data = [], [], []
+    for i0, j0, tile in iter_tiles(z, block_size):
+        keep = tile > cut_off
+        if i0 == j0:
+            keep &= np.triu(np.ones(tile.shape, dtype=bool), 1)
+        r, c = np.nonzero(keep)
+        rows.append(r + i0)
+        cols.append(c + j0)
+        data.append(tile[r, c])
+
+    if len(data) == 0:
+        return sparse.csr_matrix((ngenes, ngenes))
+    net = sparse.coo_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                            shape=(ngenes, ngenes))
+    return net.tocsr()
+
+
+def adjacency_base(r, network_type='signed'):
+    """
+    Transform correlations into the unpowered adjacency of a WGCNA network
+    type: (1 + r) / 2 for 'signed', |r| for 'unsigned' and r clipped at zero
+    for 'signed hybrid'.
+    """
+    if network_type == 'signed':
+        return (1 + r) / 2
+    elif network_type == 'unsigned':
+        return np.abs(r)
+    elif network_type == 'signed hybrid':
+        return np.maximum(r, 0)
+    raise ValueError("Unknown network type '{0}'".format(network_type))
+
+
+def connectivity(values, powers, network_type='signed', block_size=DEFAULT_BLOCK_SIZE,
+                 kernel='pearson', dtype=np.float64, z=None):
+    """
+    Whole-network connectivity of every gene for all candidate powers from a
+    single pass over the correlation tiles.
+
+    The adjacency of each tile is raised to successive powers incrementally
+    (a^p = a^(p-1) * a^(p - p_prev)), as pickSoftThreshold does.  Returns a
+    (genes x powers) array; self adjacency is excluded.  z, when given, is
+    kernel_rows(values, kernel, dtype) computed earlier.
+    """
+    powers = np.asarray(powers, dtype=float)
+    steps = np.diff(np.concatenate([[0], powers]))
+    if z is None:
+        z = kernel_rows(values, kernel, dtype)
+    k = np.zeros((z.shape[0], len(powers)))
+    for i0, j0, tile in iter_tiles(z, block_size):
+        a = adjacency_base(tile, network_type)
+        if i0 == j0:
+            np.fill_diagonal(a, 0)
+        step_powers = {}
+        cur = np.ones(a.shape, dtype=a.dtype)
+        for j, step in enumerate(steps):
+            if step not in step_powers:
+                step_powers[step] = a ** step
+            cur *= step_powers[step]
+            k[i0:i0 + a.shape[0], j] += cur.sum(axis=1)
+            if i0 != j0:
+                k[j0:j0 + a.shape[1], j] += cur.sum(axis=0)
+    return k
+
+
+def scale_free_fit(k, nbreaks=10):
+    """
+    WGCNA scaleFreeFitIndex for every column of a (genes x powers)
+    connectivity matrix at once.  Returns the R^2 and slope of the
+    log10(p(k)) ~ log10(k) fit and the adjusted R^2 of the truncated
+    exponential fit, each as a vector over the powers.
+    """
+    ngenes, npowers = k.shape
+    kmin, kmax = k.min(axis=0), k.max(axis=0)
+    dx = kmax - kmin
+
+    # cut(k, nbreaks): equal bins widened by dx/1000 at both ends, right closed
+    frac = np.linspace(0, 1, nbreaks + 1)
+    flat = dx == 0
+    pad = np.where(flat, np.where(kmin != 0, np.abs(kmin), 1), dx) / 1000
+    lo, hi = kmin - pad, kmax + pad
+    breaks = np.where(flat[:, None], lo[:, None] + frac[None, :] * (hi - lo)[:, None],
+                      kmin[:, None] + frac[None, :] * dx[:, None])
+    breaks[~flat, 0] = lo[~flat]
+    breaks[~flat, -1] = hi[~flat]
+    bins = np.empty(k.shape, dtype=int)
+    for j in range(npowers):
+        bins[:, j] = np.clip(np.searchsorted(breaks[j], k[:, j], side='left') - 1, 0, nbreaks - 1)
+
+    # per-bin mean connectivity and frequency
+    flat_bins = (bins + np.arange(npowers)[None, :] * nbreaks).ravel()
+    counts = np.bincount(flat_bins, minlength=npowers * nbreaks).reshape(npowers, nbreaks)
+    sums = np.bincount(flat_bins, weights=k.ravel(), minlength=npowers * nbreaks).reshape(npowers, nbreaks)
+    mids = kmin[:, None] + (frac[:-1] + frac[1:])[None, :] / 2 * dx[:, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        binned = sums / counts
+        binned = np.where((counts == 0) | (binned == 0), mids, binned)
+        xx = np.log10(binned)
+        yy = np.log10(counts / float(ngenes) + 1e-9)
+
+        # yy ~ xx
+        xc = xx - xx.mean(axis=1)[:, None]
+        yc = yy - yy.mean(axis=1)[:, None]
+        sxx, syy, sxy = (xc * xc).sum(axis=1), (yc * yc).sum(axis=1), (xc * yc).sum(axis=1)
+        slope = sxy / sxx
+        rsq = sxy * sxy / (sxx * syy)
+
+        # yy ~ xx + 10^xx
+        design = np.stack([np.ones(xx.shape), xx, binned], axis=2)
+        coef = np.matmul(np.linalg.pinv(design), yy[:, :, None])
+        resid = yy - np.matmul(design, coef)[:, :, 0]
+        rsq2 = 1 - (resid * resid).sum(axis=1) / syy
+        adj_rsq = 1 - (1 - rsq2) * (nbreaks - 1) / float(nbreaks - 3)
+    return rsq, slope, adj_rsq
+
+
+def pick_soft_threshold(values, max_power=DEFAULT_MAX_POWER, min_rsq=DEFAULT_MIN_RSQ,
+                        max_median_k=DEFAULT_MAX_MEDIAN_K, network_type='signed',
+                        block_size=DEFAULT_BLOCK_SIZE, kernel='pearson', dtype=np.float64, z=None):
+    """
+    Native pickSoftThreshold over the powers 1..max_power followed by the
+    selection rule of coex_net/coex_cluster2: the smallest power whose
+    scale-free R^2 exceeds min_rsq with a median connectivity of at most
+    max_median_k.
+
+    Returns (power, table) where table maps every SFT_COLUMNS name to a list
+    over the powers.  Raises ValueError when no power qualifies.
+    """
+    max_power = DEFAULT_MAX_POWER if max_power is None else int(float(max_power))
+    min_rsq = DEFAULT_MIN_RSQ if min_rsq is None else float(min_rsq)
+    max_median_k = DEFAULT_MAX_MEDIAN_K if max_median_k is None else float(max_median_k)
+    powers = np.arange(1, max_power + 1)
+
+    k = connectivity(values, powers, network_type, block_size, kernel, dtype, z)
+    rsq, slope, adj_rsq = scale_free_fit(k)
+    median_k = np.median(k, axis=0)
+    table = {'Power': powers.tolist(), 'SFT.R.sq': rsq.tolist(), 'slope': slope.tolist(),
+             'truncated.R.sq': adj_rsq.tolist(), 'mean.k.': k.mean(axis=0).tolist(),
+             'median.k.': median_k.tolist(), 'max.k.': k.max(axis=0).tolist()}
+
+    selected = np.nonzero((rsq > min_rsq) & (median_k <= max_median_k))[0]
+    if len(selected) == 0:
+        raise ValueError("No satisfied power found. Please decrease minRsq or increase maxpower.")
+    return int(powers[selected[0]]), table
+
+
+def _nanmedian(x):
+    # row medians ignoring missing values (0 for all-missing rows)
+    if not np.isnan(x).any():
+        return np.median(x, axis=1)
+    out = np.zeros(x.shape[0], dtype=x.dtype)
+    for i in range(x.shape[0]):
+        ok = x[i][~np.isnan(x[i])]
+        if len(ok) > 0:
+            out[i] = np.median(ok)
+    return out
@@ -0,0 +1,85 @@
+"""
+Size-bounded least recently used store of files in a local directory.
+
+The on-disk caches of CoExpression (fetched matrices, stored results,
+normalized rows) keep their entries as files named after an immutable key.
+A DiskLRU writes each entry under a temporary name and renames it into
+place, so readers never see partial files; marks an entry as recently
+used by touching its mtime when it is read; and after every write removes
+the least recently used entries until the directory fits max_bytes.
+
+An entry is the file ending with the store's suffix plus files with the
+same stem and one of its companion suffixes (e.g. the .npy values of a
+.json matrix entry), counted, aged and removed together.
+"""
+import os
+import uuid
+
+TMP_PREFIX = '.tmp_'
+
+
+class DiskLRU(object):
+    """
+    Files of cache_dir ending with suffix, evicted least recently used first
+    once they exceed max_bytes.  A max_bytes of 0 disables the store.
+    """
+
+    def __init__(self, cache_dir, max_bytes, suffix, companions=()):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_bytes)
+        self.suffix = suffix
+        self.companions = list(companions)
+
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def touch(self, path):
+        """Mark the entry of path (the file ending with suffix) as recently used."""
+        os.utime(path, None)
+
+    def write(self, files):
+        """
+        Store an entry: files is a list of (path, write) pairs, write(tmp)
+        saving a file to the temporary path tmp (same extension as path).
+        The files are renamed into place in order, so the last one should be
+        the file ending with suffix; then the store is evicted.
+        """
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError:
+            pass
+        stem = os.path.join(self.cache_dir, TMP_PREFIX + uuid.uuid4().hex)
+        tmps = []
+        for path, write in files:
+            tmp = stem + os.path.splitext(path)[1]
+            write(tmp)
+            tmps.append((tmp, path))
+        for tmp, path in tmps:
+            os.rename(tmp, path)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the store fits max_bytes."""
+        entries = []
+        total = 0
+        for fn in os.listdir(self.cache_dir):
+            if not fn.endswith(self.suffix) or fn.startswith(TMP_PREFIX):
+                continue
+            path = os.path.join(self.cache_dir, fn)
+            stem = path[:-len(self.suffix)]
+            paths = [path] + [stem + s for s in self.companions]
+            try:
+                size = sum(os.path.getsize(p) for p in paths)
+                entries.append((os.path.getmtime(path), paths, size))
+            except OSError:
+                continue
+            total += size
+        for mtime, paths, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for p in paths:
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+            total -= size
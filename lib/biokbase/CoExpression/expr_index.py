@@ -0,0 +1,89 @@
+"""
+Row-id index of a KBaseFeatureValues ExpressionMatrix.
+
+The row-id -> position map is built once per matrix and the value rows are
+held in a numpy object array of references (or used as is when the values
+are already a float array), so a sub-selection is a single fancy-indexing
+step that neither searches the id list nor copies the rows.
+"""
+import numpy as np
+
+
+class ExprIndex(object):
+    """
+    Position index over the row_ids (and optionally the values) of the
+    'data' part of an ExpressionMatrix.  Duplicated ids map to their first
+    row, as list.index does.
+    """
+
+    def __init__(self, row_ids, values=None):
+        self.row_ids = np.empty(len(row_ids), dtype=object)
+        self.row_ids[:] = row_ids
+        self.pos = {}
+        for i in range(len(row_ids) - 1, -1, -1):
+            self.pos[row_ids[i]] = i
+        self.rows = None
+        self.array = None
+        if isinstance(values, np.ndarray):
+            self.array = values
+        elif values is not None:
+            # element-wise so that numpy keeps each row list as one object
+            self.rows = np.empty(len(values), dtype=object)
+            for i, r in enumerate(values):
+                self.rows[i] = r
+
+    @classmethod
+    def from_matrix(cls, data):
+        """Index of the 'data' (FloatMatrix2D) part of an ExpressionMatrix."""
+        return cls(data['row_ids'], data['values'])
+
+    def __len__(self):
+        return len(self.row_ids)
+
+    def __contains__(self, row_id):
+        return row_id in self.pos
+
+    def position(self, row_id):
+        """Position of one row id; raises ValueError when it is missing."""
+        try:
+            return self.pos[row_id]
+        except KeyError:
+            raise ValueError("'{0}' is not in the expression matrix".format(row_id))
+
+    def positions(self, row_ids, skip_missing=False):
+        """
+        Positions of row_ids as an int array, in the given order.  Missing ids
+        raise ValueError unless skip_missing is set.
+        """
+        if skip_missing:
+            return np.array([self.pos[x] for x in row_ids if x in self.pos], dtype=int)
+        return np.array([self.position(x) for x in row_ids], dtype=int)
+
+    def take(self, positions):
+        """
+        row_ids and value rows at positions: the original row lists, or
+        lists built from a float array with NaN as None.
+        """
+        positions = np.asarray(positions, dtype=int)
+        row_ids = self.row_ids[positions].tolist()
+        if self.array is not None:
+            return row_ids, value_lists(self.array[positions])
+        if self.rows is None:
+            return row_ids, None
+        return row_ids, self.rows[positions].tolist()
+
+    def matrix(self, positions=None):
+        """Values as a float ndarray, optionally restricted to positions."""
+        if self.array is not None:
+            array = self.array if positions is None else self.array[np.asarray(positions, dtype=int)]
+            return np.asarray(array, dtype=float)
+        rows = self.rows if positions is None else self.rows[np.asarray(positions, dtype=int)]
+        return np.array(rows.tolist(), dtype=float).reshape(len(rows), -1)
+
+
+def value_lists(values):
+    """Rows of a float array as the workspace stores them: missing values as None."""
+    rows = np.asarray(values).tolist()
+    if np.isnan(values).any():
+        rows = [[None if x != x else x for x in row] for row in rows]
+    return rows
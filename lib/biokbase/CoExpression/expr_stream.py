@@ -0,0 +1,174 @@
+"""
+Streaming decoder for ExpressionMatrix objects fetched from the workspace.
+
+The JSON-RPC response of Workspace.get_objects is read in chunks.  The
+numeric data.values array is parsed block by block straight into a
+preallocated float64 array (null becomes NaN), and only the rest of the
+object, with values emptied, goes through json.loads.  Peak memory is
+therefore close to the final array instead of millions of boxed floats.
+"""
+import re
+import json
+import string
+import random
+
+import numpy as np
+import requests
+
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+_VALUES_KEY = re.compile(r'(?<!\\)"values"\s*:\s*\[')
+_ROW_IDS_KEY = re.compile(r'(?<!\\)"row_ids"\s*:\s*')
+_VALUES_END = re.compile(r'\]\s*\]')
+_ROW_CHARS = string.maketrans('[],', '   ')
+
+
+class ValuesDecoder(object):
+    """
+    Incremental decoder: feed() the response text chunk by chunk, then
+    result() returns the JSON text with an empty values array and the
+    values as a (rows x columns) float64 array.
+    """
+
+    def __init__(self):
+        self.head = []
+        self.pending = ''
+        self.in_values = False
+        self.done = False
+        self.array = None
+        self.nrows = 0
+        self.ncols = None
+        self.expected_rows = None
+
+    def feed(self, chunk):
+        if self.done:
+            self.head.append(chunk)
+            return
+        self.pending += chunk
+        if not self.in_values:
+            m = _VALUES_KEY.search(self.pending)
+            if m is None:
+                # keep a tail long enough to hold a split key
+                cut = max(0, len(self.pending) - 32)
+                self.head.append(self.pending[:cut])
+                self.pending = self.pending[cut:]
+                return
+            self.head.append(self.pending[:m.end()])
+            self.pending = self.pending[m.end():]
+            self.in_values = True
+            self.expected_rows = self._row_count()
+        self._parse_rows()
+
+    def result(self):
+        if self.in_values and not self.done:
+            raise ValueError("Truncated ExpressionMatrix values")
+        if not self.done:
+            self.head.append(self.pending)
+            self.pending = ''
+        ncols = self.ncols or 0
+        if self.array is None:
+            values = np.zeros((0, ncols))
+        else:
+            values = self.array[:self.nrows * ncols].reshape(self.nrows, ncols)
+        return ''.join(self.head), values
+
+    def _parse_rows(self):
+        text = self.pending
+        stripped = text.lstrip()
+        if stripped.startswith(']'):
+            # values closed right after a complete row (or empty values)
+            self._finish(stripped[1:])
+            return
+        # rows hold no brackets, so the first "] ]" closes the last row and values
+        m = _VALUES_END.search(text)
+        if m is not None:
+            self._append(text[:m.start() + 1])
+            self._finish(text[m.end():])
+            return
+        cut = text.rfind(']')
+        if cut >= 0:
+            self._append(text[:cut + 1])
+            self.pending = text[cut + 1:]
+
+    def _finish(self, rest):
+        self.head.append(']')
+        self.head.append(rest)
+        self.pending = ''
+        self.in_values = False
+        self.done = True
+
+    def _append(self, block):
+        if len(block.strip()) == 0:
+            return
+        if self.ncols is None:
+            first = block[block.index('[') + 1:block.index(']')]
+            self.ncols = len(first.split(',')) if first.strip() else 0
+        if 'null' in block:
+            block = block.replace('null', 'nan')
+        flat = np.fromstring(block.translate(_ROW_CHARS), dtype=np.float64, sep=' ')
+        self._reserve(self.nrows * self.ncols + len(flat))
+        self.array[self.nrows * self.ncols:self.nrows * self.ncols + len(flat)] = flat
+        if self.ncols > 0:
+            self.nrows += len(flat) // self.ncols
+        else:
+            self.nrows += block.count(']')
+
+    def _reserve(self, size):
+        if self.array is None:
+            rows = self.expected_rows if self.expected_rows else 1024
+            self.array = np.empty(max(size, rows * max(self.ncols, 1)))
+        elif size > len(self.array):
+            # row count unknown: grow geometrically
+            grown = np.empty(max(size, 2 * len(self.array)))
+            grown[:len(self.array)] = self.array
+            self.array = grown
+
+    def _row_count(self):
+        # preallocate exactly when row_ids precede values in the response
+        text = ''.join(self.head)
+        m = None
+        for m in _ROW_IDS_KEY.finditer(text):
+            pass
+        if m is None:
+            return None
+        try:
+            row_ids, end = json.JSONDecoder().raw_decode(text, m.end())
+        except ValueError:
+            return None
+        return len(row_ids) if isinstance(row_ids, list) else None
+
+
+def decode_object(chunks):
+    """
+    Decode a Workspace.get_objects JSON-RPC response given as text chunks
+    and return the first object's data with data.values as a float64 array.
+    """
+    decoder = ValuesDecoder()
+    for chunk in chunks:
+        decoder.feed(chunk)
+    text, values = decoder.result()
+    response = json.loads(text)
+    if 'error' in response and response['error'] is not None:
+        raise Exception(response['error'].get('message', 'Workspace error'))
+    data = response['result'][0][0]['data']
+    data['data']['values'] = values
+    return data
+
+
+def get_expression(ws_url, token, ref, chunk_size=DEFAULT_CHUNK_SIZE, timeout=1800, session=None):
+    """
+    Fetch the ExpressionMatrix ref from the workspace and decode it while it
+    streams in.  Returns the object data like get_objects()[0]['data'] but
+    with data.values as a float64 array.  session (e.g. the one of a
+    ws_pool.WorkspacePool) reuses its kept-alive connections.
+    """
+    body = {'method': 'Workspace.get_objects', 'params': [[{'ref': ref}]], 'version': '1.1',
+            'id': str(random.random())[2:]}
+    headers = {'AUTHORIZATION': token} if token else {}
+    resp = (session or requests).post(ws_url, data=json.dumps(body), headers=headers, stream=True, timeout=timeout)
+    try:
+        if resp.status_code not in (200, 500):
+            resp.raise_for_status()
+        return decode_object(resp.iter_content(chunk_size))
+    finally:
+        resp.close()
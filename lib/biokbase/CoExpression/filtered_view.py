@@ -0,0 +1,77 @@
+"""
+Filtered ExpressionMatrix stored as a row selection of its source.
+
+A CoExpression.FilteredExpressionMatrix holds the versioned reference of the
+source ExpressionMatrix and the positions of the selected rows instead of a
+copy of their values.  FilteredView materializes the filtered matrix from
+the source only when it is first used.
+
+The type is internal to CoExpression: only its own methods
+(filter_genes, const_coex_net_clust and, through the clusters' source
+matrix, view_heatmap) read it; other apps, the narrative methods and the
+coex-filter-genes script expect an ExpressionMatrix and cannot use it.
+filter_genes therefore only writes one when the deployment enables
+index_output.  Outputs that refer to an input matrix (FeatureClusters'
+original_data, a further filtered view) point at the source matrix
+version, with row positions in the source.
+"""
+import copy
+
+import numpy as np
+
+VIEW_TYPE = 'CoExpression.FilteredExpressionMatrix'
+
+
+def is_view_type(ws_type):
+    """True for a (versioned) workspace type string of a filtered view."""
+    return ws_type.split('-')[0] == VIEW_TYPE
+
+
+def view_object(source_ref, positions, description=None):
+    """FilteredExpressionMatrix data selecting positions of source_ref (wsid/objid/ver)."""
+    if len(source_ref.split('/')) != 3:
+        raise ValueError("'{0}' is not a versioned wsid/objid/ver reference".format(source_ref))
+    view = {'source_matrix_ref': source_ref, 'row_index': [int(i) for i in positions]}
+    if description is not None:
+        view['description'] = description
+    return view
+
+
+class FilteredView(object):
+    """
+    Lazy reader of a FilteredExpressionMatrix.  load(ref) returns the
+    ExpressionMatrix data of the source with data.values as a float array,
+    and is only called by expression_matrix().
+    """
+
+    def __init__(self, view, load):
+        self.view = view
+        self.load = load
+        self.expr = None
+
+    def __len__(self):
+        return len(self.view['row_index'])
+
+    def source_ref(self):
+        return self.view['source_matrix_ref']
+
+    def source_rows(self, positions):
+        """Positions in the source matrix of the rows at positions of the view."""
+        return [self.view['row_index'][i] for i in positions]
+
+    def expression_matrix(self):
+        """The filtered ExpressionMatrix data, data.values as a float array."""
+        if self.expr is None:
+            source = self.load(self.source_ref())
+            positions = np.asarray(self.view['row_index'], dtype=int)
+            expr = dict((k, v) for k, v in source.items() if k != 'data')
+            expr = copy.deepcopy(expr)
+            expr['data'] = dict((k, v) for k, v in source['data'].items() if k not in ('row_ids', 'values'))
+            expr['data']['col_ids'] = list(source['data']['col_ids'])
+            expr['data']['row_ids'] = [source['data']['row_ids'][i] for i in positions]
+            values = np.asarray(source['data']['values'], dtype=float).reshape(-1, len(source['data']['col_ids']))
+            expr['data']['values'] = values[positions]
+            if 'description' in self.view:
+                expr['description'] = self.view['description']
+            self.expr = expr
+        return self.expr
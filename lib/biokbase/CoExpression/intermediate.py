@@ -0,0 +1,45 @@
+"""
+Optionally compressed intermediate files of the scratch directories.
+
+Files written with open_file() use the configured codec and carry its suffix
+(see path()); reading detects gzip by its magic bytes, so the parsing code
+handles plain and compressed intermediates alike.  The R tools pick the
+codec up from the '.gz' suffix of the paths they are given.
+"""
+import gzip
+
+GZIP_LEVEL = 1
+CODECS = {'none': '', 'gzip': '.gz'}
+_GZIP_MAGIC = '\x1f\x8b'
+
+
+def check_codec(codec):
+    if codec not in CODECS:
+        raise ValueError("Intermediate codec '{0}' is not supported (expect one of {1})".format(
+            codec, ", ".join(sorted(CODECS))))
+    return codec
+
+
+def path(fn, codec='none'):
+    """File name of the intermediate fn written with codec."""
+    return fn + CODECS[check_codec(codec)]
+
+
+def is_compressed(fn):
+    with open(fn, 'rb') as fh:
+        return fh.read(2) == _GZIP_MAGIC
+
+
+def open_file(fn, mode='r', codec='none'):
+    """
+    Open an intermediate.  Writes compress with codec (gzip at level 1 by
+    default, cheap enough for scratch data); reads decompress whenever fn
+    is gzip data.
+    """
+    if 'r' in mode:
+        if is_compressed(fn):
+            return gzip.open(fn, mode.replace('t', ''))
+        return open(fn, mode)
+    if check_codec(codec) == 'gzip':
+        return gzip.open(fn, mode.replace('t', ''), GZIP_LEVEL)
+    return open(fn, mode)
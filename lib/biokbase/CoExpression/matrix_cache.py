@@ -0,0 +1,72 @@
+"""
+Local on-disk cache of ExpressionMatrix objects.
+
+Every matrix is stored under its immutable workspace reference
+(wsid/objid/ver) as a .npy block of the values, opened memory-mapped, and a
+JSON file with the row/column ids and the rest of the object.  The cache is
+a DiskLRU: bounded in size, it evicts the least recently used matrices first.
+"""
+import os
+import json
+
+import numpy as np
+
+from biokbase.CoExpression.disk_lru import DiskLRU
+
+DEFAULT_CACHE_DIR = 'matrix_cache'
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+
+class MatrixCache(DiskLRU):
+    """
+    Size-bounded LRU cache of ExpressionMatrix data keyed by workspace
+    reference.  A max_bytes of 0 disables the cache.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        DiskLRU.__init__(self, cache_dir, max_bytes, '.json', ['.npy'])
+
+    def key(self, ref):
+        """File name stem of a 'wsid/objid/ver' reference."""
+        parts = ref.split('/')
+        if len(parts) != 3 or not all(p.isdigit() for p in parts):
+            raise ValueError("'{0}' is not a versioned wsid/objid/ver reference".format(ref))
+        return '_'.join(parts)
+
+    def paths(self, ref):
+        stem = os.path.join(self.cache_dir, self.key(ref))
+        return stem + '.npy', stem + '.json'
+
+    def get(self, ref):
+        """
+        The cached ExpressionMatrix data of ref, or None.  data.values is the
+        read-only memory-mapped float64 block (NaN for missing values) and the
+        entry is marked as recently used.
+        """
+        if not self.enabled():
+            return None
+        npy_fn, json_fn = self.paths(ref)
+        try:
+            with open(json_fn, 'r') as jf:
+                expr = json.load(jf)
+            values = np.load(npy_fn, mmap_mode='r')
+            self.touch(json_fn)
+        except (IOError, OSError, ValueError):
+            return None
+        expr['data']['values'] = values
+        return expr
+
+    def put(self, ref, expr):
+        """Store the ExpressionMatrix data expr under ref and evict if needed."""
+        if not self.enabled():
+            return
+        npy_fn, json_fn = self.paths(ref)
+        meta = dict(expr)
+        meta['data'] = dict((k, v) for k, v in expr['data'].items() if k != 'values')
+        values = np.asarray(expr['data']['values'], dtype=np.float64).reshape(-1, len(expr['data']['col_ids']))
+
+        def write_json(tmp):
+            with open(tmp, 'w') as jf:
+                json.dump(meta, jf)
+        # the values first, so that a listed .json entry always has its .npy
+        self.write([(npy_fn, lambda tmp: np.save(tmp, values)), (json_fn, write_json)])
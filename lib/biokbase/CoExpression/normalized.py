@@ -0,0 +1,137 @@
+"""
+Persisted normalized forms of an ExpressionMatrix.
+
+Correlation needs the gene rows transformed so that the dot product of two
+rows is their correlation (coex_net.kernel_rows), and view_heatmap orders
+genes on rows scaled to unit length.  A NormalizedStore keeps these per
+matrix version (wsid/objid/ver), kind and precision as .npy files opened
+memory-mapped, so later stages and calls load them instead of recomputing
+and a stage can read only the rows of one cluster.  The file names carry
+FORMAT_VERSION, which is bumped whenever a transform changes so that stale
+files are not read.  The store is a DiskLRU: bounded in size, it evicts
+the least recently used files first.
+"""
+import os
+
+import numpy as np
+
+import biokbase.CoExpression.coex_net as coex_net
+from biokbase.CoExpression.disk_lru import DiskLRU
+
+DEFAULT_CACHE_DIR = 'normalized_cache'
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+FORMAT_VERSION = 1
+
+# correlation kernels of coex_net, and 'l2' for rows scaled to unit length
+KINDS = ['pearson', 'spearman', 'bicor', 'l2']
+
+
+def l2_rows(values, dtype=np.float64):
+    """
+    Rows divided by their length over the present values, as
+    df.div(df.pow(2).sum(axis=1).pow(0.5), axis=0) does: missing values stay
+    missing and all-zero rows become missing.
+    """
+    x = np.array(values, dtype=dtype)
+    norms = np.sqrt(np.nansum(x * x, axis=1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x /= norms[:, None]
+    return x
+
+
+def transform(values, kind, dtype=np.float64):
+    """Normalized rows of a (genes x samples) matrix for one of KINDS."""
+    if kind == 'l2':
+        return l2_rows(values, dtype)
+    return coex_net.kernel_rows(values, kind, dtype)
+
+
+class NormalizedMatrix(object):
+    """
+    Normalized rows z of a matrix, in its row order.  For a correlation
+    kernel z z' is the gene-gene correlation matrix.
+    """
+
+    def __init__(self, z, kind):
+        self.z = z
+        self.kind = kind
+
+    def __len__(self):
+        return self.z.shape[0]
+
+    def rows(self, positions=None):
+        """Rows at positions as an array; only those rows are read from the file."""
+        if positions is None:
+            return self.z
+        return np.asarray(self.z[np.asarray(positions, dtype=int)])
+
+    def correlation(self, positions, other=None):
+        """Correlations between the rows at positions and those at other (default positions)."""
+        self._check_kernel()
+        zi = self.rows(positions)
+        zj = zi if other is None else self.rows(other)
+        return zi.dot(zj.T)
+
+    def mean_correlation(self, positions):
+        """
+        Mean correlation within the rows at positions, self correlations
+        counted as 1 (the 'simple' network mcor of coex_cluster2), without
+        forming the correlation block.
+        """
+        self._check_kernel()
+        n = len(positions)
+        if n == 0:
+            return float('nan')
+        zi = self.rows(positions).astype(np.float64)
+        s = zi.sum(axis=0)
+        return float((s.dot(s) - (zi * zi).sum() + n) / (n * n))
+
+    def _check_kernel(self):
+        if self.kind == 'l2':
+            raise ValueError("Rows scaled to unit length do not give correlations")
+
+
+class NormalizedStore(DiskLRU):
+    """
+    Size-bounded LRU store of normalized matrices keyed by workspace
+    reference, kind and precision.  A max_bytes of 0 disables it, in which
+    case load() computes in memory every time.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        DiskLRU.__init__(self, cache_dir, max_bytes, '.npy')
+
+    def path(self, ref, kind, dtype=np.float64):
+        parts = ref.split('/')
+        if len(parts) != 3 or not all(p.isdigit() for p in parts):
+            raise ValueError("'{0}' is not a versioned wsid/objid/ver reference".format(ref))
+        if kind not in KINDS:
+            raise ValueError("Unknown normalization '{0}'".format(kind))
+        fn = "{0}_{1}_{2}.v{3}.npy".format('_'.join(parts), kind, np.dtype(dtype).name, FORMAT_VERSION)
+        return os.path.join(self.cache_dir, fn)
+
+    def get(self, ref, kind, dtype=np.float64):
+        """The stored NormalizedMatrix (read-only memmap), or None; marked as recently used."""
+        if not self.enabled():
+            return None
+        fn = self.path(ref, kind, dtype)
+        try:
+            z = np.load(fn, mmap_mode='r')
+            self.touch(fn)
+        except (IOError, OSError, ValueError):
+            return None
+        return NormalizedMatrix(z, kind)
+
+    def put(self, ref, kind, z):
+        """Store the normalized rows z of ref and evict if needed; returns the NormalizedMatrix."""
+        if not self.enabled():
+            return NormalizedMatrix(z, kind)
+        self.write([(self.path(ref, kind, z.dtype), lambda tmp: np.save(tmp, z))])
+        return NormalizedMatrix(z, kind)
+
+    def load(self, ref, kind, values, dtype=np.float64):
+        """The normalized matrix of ref, computed from its values and stored on first use."""
+        nm = self.get(ref, kind, dtype)
+        if nm is None:
+            nm = self.put(ref, kind, transform(values, kind, dtype))
+        return nm
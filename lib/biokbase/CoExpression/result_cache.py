@@ -0,0 +1,80 @@
+"""
+Local on-disk cache of method results.
+
+Results are stored as JSON under a content address: the SHA-256 digest of
+the immutable input reference (wsid/objid/ver), the method name, the
+normalized parameters that affect the result and ENGINE_VERSION.  A
+repeated call with the same inputs reads the stored gene lists, cluster
+assignments or heatmap tables instead of recomputing them.  ENGINE_VERSION
+is bumped whenever a filter, network or clustering engine (native or R) or
+the layout of a stored result changes, so results of an older engine are
+not reused.  The cache is a DiskLRU: bounded in size, it evicts the least
+recently used results first.
+"""
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from biokbase.CoExpression.disk_lru import DiskLRU
+
+DEFAULT_CACHE_DIR = 'result_cache'
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+# 2: coex_filter's num_features selection, the mean height tree cut and the kernel of coex_cluster2
+# 3: cutreeDynamic on the native WGCNA tree, built from a float64 TOM
+ENGINE_VERSION = 3
+
+
+def _jsonable(obj):
+    # numpy scalars and arrays produced by the native engine
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError("{0!r} is not JSON serializable".format(obj))
+
+
+def normalize(param):
+    """Parameters as compared for the cache: scalar values as strings, so 5 and '5' match."""
+    return dict((k, v if isinstance(v, (dict, list)) else unicode(v)) for k, v in param.items())
+
+
+class ResultCache(DiskLRU):
+    """
+    Size-bounded LRU cache of JSON results keyed by content address.  A
+    max_bytes of 0 disables the cache.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        DiskLRU.__init__(self, cache_dir, max_bytes, '.json')
+
+    def key(self, ref, method, param):
+        """Content address of method on the input version ref with param."""
+        text = json.dumps([ref, method, normalize(param), ENGINE_VERSION], sort_keys=True, default=_jsonable)
+        return hashlib.sha256(text).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, key):
+        """The stored result of key, or None; the entry is marked as recently used."""
+        if not self.enabled():
+            return None
+        fn = self.path(key)
+        try:
+            with open(fn, 'r') as fh:
+                value = json.load(fh)
+            self.touch(fn)
+        except (IOError, OSError, ValueError):
+            return None
+        return value
+
+    def put(self, key, value):
+        """Store the JSON-serializable result value under key and evict if needed."""
+        if not self.enabled():
+            return
+        def write(tmp):
+            with open(tmp, 'w') as fh:
+                json.dump(value, fh, default=_jsonable)
+        self.write([(self.path(key), write)])
@@ -0,0 +1,43 @@
+"""
+Per-call scratch directories.
+
+Every method call gets its own directory under a configurable root (a tmpfs
+mount such as /dev/shm works well for the small intermediates) holding the
+raw_dir, fltr_dir, ... subdirectories, so concurrent calls in one service
+never share file names.  All paths handed out are absolute, and the whole
+tree is removed by cleanup().
+"""
+import os
+import shutil
+import tempfile
+
+DEFAULT_ROOT = 'scratch'
+
+
+class Scratch(object):
+    """Isolated scratch directory of one call with the given subdirectories."""
+
+    def __init__(self, root=DEFAULT_ROOT, subdirs=(), prefix='coex_'):
+        root = os.path.abspath(root or DEFAULT_ROOT)
+        try:
+            os.makedirs(root)
+        except OSError:
+            if not os.path.isdir(root):
+                raise
+        self.root = tempfile.mkdtemp(prefix=prefix, dir=root)
+        for d in subdirs:
+            os.makedirs(self.dir(d))
+
+    def dir(self, name):
+        """Absolute path of the subdirectory name."""
+        return os.path.join(self.root, name)
+
+    def cleanup(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.cleanup()
+        return False
@@ -0,0 +1,127 @@
+"""
+Helpers shared by the ExpressionSeries command line scripts
+(coex-filter-genes, coex-net-clust) to fetch expression samples into a
+genes x samples matrix and write it for the R tools.
+"""
+import sys
+import Queue
+import threading
+from itertools import islice
+from operator import itemgetter
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+
+DEFAULT_CHUNK_SIZE = 20
+DEFAULT_THREADS = 4
+
+
+class SampleMatrix(object):
+    """
+    Genes x samples float matrix of KBaseExpression.ExpressionSample objects
+    over the genes measured in every sample, filled one sample at a time in
+    any order.  The gene index is built once from the first sample added;
+    each column is then filled with a single C-level lookup of all genes,
+    and genes missing from a later sample drop out in result().
+    """
+
+    def __init__(self, nsamples):
+        self.nsamples = nsamples
+        self.samples = [None] * nsamples
+        self.gids = None
+        self.values = None
+        self.missing = None
+
+    def add(self, j, sample):
+        """Fill column j; the sample is kept without its expression_levels."""
+        levels = sample['data'].pop('expression_levels')
+        self.samples[j] = sample
+        if self.gids is None:
+            self.gids = sorted(levels)
+            self.values = np.empty((len(self.gids), self.nsamples))
+            self.missing = np.zeros(len(self.gids), dtype=bool)
+            self.getter = itemgetter(*self.gids) if len(self.gids) > 0 else None
+        if self.getter is None:
+            return
+        try:
+            self.values[:, j] = self.getter(levels)
+        except KeyError:
+            col = [levels.get(g) for g in self.gids]
+            self.missing |= np.array([x is None for x in col], dtype=bool)
+            self.values[:, j] = [np.nan if x is None else x for x in col]
+
+    def result(self):
+        """The samples, the sorted common gene ids and the matrix."""
+        if self.gids is None:
+            return self.samples, [], np.zeros((0, self.nsamples))
+        if not self.missing.any():
+            return self.samples, self.gids, self.values
+        keep = np.flatnonzero(~self.missing)
+        return self.samples, [self.gids[i] for i in keep], self.values[keep]
+
+
+def fetch_sample_matrix(new_client, refs, chunk_size=DEFAULT_CHUNK_SIZE, threads=DEFAULT_THREADS):
+    """
+    Fetch the ExpressionSamples refs (object identities) in chunks of
+    chunk_size on at most threads threads, each calling get_objects on its
+    own workspace client made by new_client(), and fill the matrix as each
+    chunk arrives.  A chunk is requested only when fewer than threads
+    chunks are being fetched or waiting to be added, so at most threads
+    chunks of expression levels are held at once.  Returns the samples (in
+    refs order, without expression_levels), the common gene ids and the
+    matrix.
+    """
+    chunk_size = max(1, int(chunk_size))
+    matrix = SampleMatrix(len(refs))
+    starts = iter(range(0, len(refs), chunk_size))
+    nthreads = max(1, min(int(threads), (len(refs) + chunk_size - 1) // chunk_size))
+    local = threading.local()
+    done = Queue.Queue()
+
+    def fetch(start):
+        try:
+            if not hasattr(local, 'client'):
+                local.client = new_client()
+            done.put((start, local.client.get_objects(refs[start:start + chunk_size]), None))
+        except Exception:
+            done.put((start, None, sys.exc_info()))
+
+    pool = ThreadPool(nthreads)
+    try:
+        in_flight = 0
+        for start in islice(starts, nthreads):
+            pool.apply_async(fetch, (start,))
+            in_flight += 1
+        while in_flight > 0:
+            start, chunk, error = done.get()
+            in_flight -= 1
+            if error is not None:
+                raise error[0], error[1], error[2]
+            for k, sample in enumerate(chunk):
+                matrix.add(start + k, sample)
+            chunk = None
+            for start in islice(starts, 1):
+                pool.apply_async(fetch, (start,))
+                in_flight += 1
+    finally:
+        pool.terminate()
+        pool.join()
+    return matrix.result()
+
+
+def write_matrix_csv(fn, col_ids, row_ids, values, quote=False):
+    """
+    Write a matrix as CSV with a header of column ids and the row id in the
+    first column, in one bulk np.savetxt pass.  Values are printed with
+    str() like the scripts always did; quote wraps the ids in double quotes
+    the way R's write.csv does.
+    """
+    q = '"' if quote else ''
+    with open(fn, 'w') as fh:
+        fh.write((q + q + ',' if quote else '') + ",".join([q + c + q for c in col_ids]) + "\n")
+        if len(row_ids) == 0:
+            return
+        ids = np.array([q + r + q for r in row_ids], dtype=object)
+        body = np.column_stack([ids, np.asarray(values, dtype=float).astype(object)])
+        np.savetxt(fh, body, fmt='%s', delimiter=',')
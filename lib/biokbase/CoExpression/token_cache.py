@@ -0,0 +1,76 @@
+"""
+Thread-safe cache of values resolved from auth tokens (such as the user id
+of a token).
+
+Entries expire after a fixed time to live and the cache holds at most a
+fixed number of them, dropping the least recently used first.  Tokens are
+never stored: entries are keyed by the SHA-256 digest of the token.  Hits
+and misses are counted for monitoring.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_TTL = 300
+DEFAULT_MAX_SIZE = 1000
+
+
+class TokenCache(object):
+    """TTL and size bounded token -> value cache; a ttl of 0 disables it."""
+
+    def __init__(self, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE):
+        self.ttl = float(ttl)
+        self.max_size = int(max_size)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def enabled(self):
+        return self.ttl > 0 and self.max_size > 0
+
+    def key(self, token):
+        if isinstance(token, unicode):
+            token = token.encode('utf-8')
+        return hashlib.sha256(token).hexdigest()
+
+    def get(self, token):
+        """The cached value of token, or None when missing or expired."""
+        if not self.enabled() or token is None:
+            return None
+        key = self.key(token)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] <= time.time():
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries[key] = entry  # most recently used last
+            return entry[1]
+
+    def put(self, token, value):
+        if not self.enabled() or token is None:
+            return
+        key = self.key(token)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, token):
+        if token is None:
+            return
+        key = self.key(token)
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Hit and miss counts and the current number of entries."""
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
@@ -0,0 +1,74 @@
+"""
+Batched saving of the workspace objects a method produces.
+
+Outputs are collected first and saved with one save_objects call per
+dependency level instead of one call per object: everything that does not
+refer to another output goes in the first call, and objects that need the
+references of earlier outputs (a report listing what was created, figure
+properties pointing at their data table) are built from those references
+and saved in the next call.
+"""
+
+
+def info2ref(info):
+    """'wsid/objid/ver' reference of a workspace object_info tuple."""
+    return "{0}/{1}/{2}".format(info[6], info[0], info[4])
+
+
+class OutputBatch(object):
+    """
+    Workspace outputs of one call.  add() queues ObjectSaveData dicts, or
+    functions building one from the references of the outputs they depend
+    on; save() stores them level by level.
+    """
+
+    def __init__(self, ws, workspace):
+        self.ws = ws
+        self.workspace = workspace
+        self.entries = []
+        self.infos = {}
+
+    def add(self, key, obj, depends=()):
+        """
+        Queue obj under key.  With depends (keys of earlier outputs), obj is
+        called with a {key: ref} dict of those outputs once they are saved
+        and must return the ObjectSaveData to store.
+        """
+        known = set(e[0] for e in self.entries) | set(self.infos)
+        if key in known:
+            raise ValueError("Output '{0}' is already queued".format(key))
+        missing = [d for d in depends if d not in known]
+        if len(missing) > 0:
+            raise ValueError("Output '{0}' depends on unknown outputs {1}".format(key, missing))
+        self.entries.append((key, obj, tuple(depends)))
+        return key
+
+    def save(self):
+        """Save all queued outputs; returns the object_info of every key."""
+        level = {}
+        for key, obj, depends in self.entries:
+            level[key] = 1 + max([level.get(d, -1) for d in depends]) if len(depends) > 0 else 0
+        for lv in range(max(level.values()) + 1 if len(level) > 0 else 0):
+            keys, objects = [], []
+            for key, obj, depends in self.entries:
+                if level[key] != lv:
+                    continue
+                if len(depends) > 0:
+                    obj = obj(dict((d, self.ref(d)) for d in depends))
+                keys.append(key)
+                objects.append(obj)
+            params = {'objects': objects}
+            if isinstance(self.workspace, (int, long)):
+                params['id'] = self.workspace
+            else:
+                params['workspace'] = self.workspace
+            for key, info in zip(keys, self.ws.save_objects(params)):
+                self.infos[key] = info
+        self.entries = []
+        return self.infos
+
+    def info(self, key):
+        return self.infos[key]
+
+    def ref(self, key):
+        return info2ref(self.infos[key])
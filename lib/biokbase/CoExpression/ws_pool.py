@@ -0,0 +1,114 @@
+"""
+Pooled, keep-alive sessions for the generated Workspace client.
+
+A WorkspacePool holds one HTTP session per process and workspace url whose
+connections stay open between calls, so the several workspace calls of a
+job (and of concurrent jobs) reuse TCP/TLS connections instead of setting
+one up per call.  client(token) returns a PooledWorkspace, the generated
+biokbase.workspace.client.Workspace posting its calls on the pool's
+session, so the API and its ServerError are unchanged and the generated
+module itself is left as it is.
+
+A client can be given an on_auth_error(token) callback, called when the
+workspace rejects its token (see is_auth_error()), so that caches of the
+token, e.g. of its user id, drop a revoked token at once.
+"""
+import re
+import json
+import random
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import biokbase.workspace.client as ws_client
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 1800
+
+_CT = 'content-type'
+_AJ = 'application/json'
+# messages of the workspace's JSON-RPC errors for a token it does not accept
+_AUTH_ERROR = re.compile(r'Token validation failed|Invalid token|Login failed|Unauthorized', re.IGNORECASE)
+
+
+def is_auth_error(error):
+    """True when error of a workspace call means the token was rejected."""
+    if isinstance(error, requests.HTTPError):
+        return getattr(error.response, 'status_code', None) == requests.codes.unauthorized
+    return isinstance(error, ws_client.ServerError) and _AUTH_ERROR.search(error.message or '') is not None
+
+
+class PooledWorkspace(ws_client.Workspace):
+    """Generated Workspace client whose JSON-RPC calls go through a requests session."""
+
+    def __init__(self, session, *args, **kwargs):
+        self.on_auth_error = kwargs.pop('on_auth_error', None)
+        ws_client.Workspace.__init__(self, *args, **kwargs)
+        self.session = session
+
+    def _call(self, method, params, json_rpc_context=None):
+        try:
+            return self._post(method, params, json_rpc_context)
+        except (ws_client.ServerError, requests.HTTPError) as e:
+            if self.on_auth_error is not None and is_auth_error(e):
+                self.on_auth_error(self._headers.get('AUTHORIZATION'))
+            raise
+
+    def _post(self, method, params, json_rpc_context):
+        # the generated _call, posting on self.session
+        arg_hash = {'method': method,
+                    'params': params,
+                    'version': '1.1',
+                    'id': str(random.random())[2:]
+                    }
+        if json_rpc_context:
+            arg_hash['context'] = json_rpc_context
+
+        body = json.dumps(arg_hash, cls=ws_client._JSONObjectEncoder)
+        ret = self.session.post(self.url, data=body, headers=self._headers, timeout=self.timeout,
+                                verify=not self.trust_all_ssl_certificates)
+        if ret.status_code == requests.codes.server_error:
+            if _CT in ret.headers and ret.headers[_CT] == _AJ:
+                err = json.loads(ret.text)
+                if 'error' in err:
+                    raise ws_client.ServerError(**err['error'])
+                else:
+                    raise ws_client.ServerError('Unknown', 0, ret.text)
+            else:
+                raise ws_client.ServerError('Unknown', 0, ret.text)
+        if ret.status_code != requests.codes.OK:
+            ret.raise_for_status()
+        ret.encoding = 'utf-8'
+        resp = json.loads(ret.text)
+        if 'result' not in resp:
+            raise ws_client.ServerError('Unknown', 0, 'An unknown server error occurred')
+        return resp['result']
+
+
+class WorkspacePool(object):
+    """Process-wide pooled session to one workspace service url."""
+
+    def __init__(self, url, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=int(pool_size))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def client(self, token=None, on_auth_error=None):
+        """Workspace client sending token, sharing this pool's connections."""
+        return PooledWorkspace(self.session, self.url, timeout=self.timeout, token=token, on_auth_error=on_auth_error)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(url, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+    """The process-wide pool of url, created on first use."""
+    with _pools_lock:
+        if url not in _pools:
+            _pools[url] = WorkspacePool(url, pool_size, timeout)
+        return _pools[url]
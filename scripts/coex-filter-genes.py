@@ -10,7 +10,10 @@ import subprocess
 from subprocess import Popen, PIPE
 import os
 from optparse import OptionParser
-from biokbase.workspace.client import Workspace
+import biokbase.CoExpression.ws_pool as ws_pool
+import biokbase.CoExpression.coex_filter as native_filter
+import biokbase.CoExpression.series as series
+from biokbase.CoExpression.ws_output import OutputBatch
 
 desc1 = '''
 NAME
@@ -38,6 +41,9 @@ EXAMPLES
       > coex-filter-genes --ws_url 'https://kbase.us/services/ws' --ws_id KBasePublicExpression  --in_id 'my_series' -out_id 'filtered_series' --filter_method lor --p_value 0.01 
       > coex-filter-genes -u 'https://kbase.us/services/ws' -w KBasePublicExpression  -i 'my_series' -o 'filtered_series' -m lor -p 0.01
 
+      Filter genes with LOR without starting R
+      > coex-filter-genes -u 'https://kbase.us/services/ws' -w KBasePublicExpression  -i 'my_series' -o 'filtered_series' -m lor -p 0.01 -g native
+
 
 SEE ALSO
       coex_filter
@@ -50,7 +56,9 @@ Shinjae Yoo, Gang Fang, Fei He, Daifeng Wang.
 def filter_expression (args) :
     ###
     # download ws object and convert them to csv
-    wsd = Workspace(url=args.ws_url, token=os.environ.get('KB_AUTH_TOKEN'))
+    # one kept-alive pool for all calls, sized for the parallel sample fetches
+    pool = ws_pool.get_pool(args.ws_url, max(ws_pool.DEFAULT_POOL_SIZE, args.threads))
+    wsd = pool.client(os.environ.get('KB_AUTH_TOKEN'))
     lseries = wsd.get_object({'id' : args.inobj_id,
                   'type' : 'KBaseExpression.ExpressionSeries', 
                   'workspace' : args.ws_id})['data']
@@ -58,28 +66,18 @@ def filter_expression (args) :
     if lseries is None:
         raise COEXException("Object {} not found in workspace {}".format(args.inobj_id, args.ws_id))
 
-    samples, sids, genome_id = {}, [], ""
+    sids, genome_id = [], ""
     # assume only one genome id
     for gid in sorted(lseries['genome_expression_sample_ids_map'].keys()):
         genome_id = gid
         for samid in lseries['genome_expression_sample_ids_map'][gid]:
             sids.append({'ref': samid})
-        samples = wsd.get_objects(sids)
         break
 
-    cif = open(args.exp_fn, 'w')
-    header = ",".join([s['data']['source_id'] for s in samples])
-    cif.write(header + "\n")
-
-    # find common gene list
-    gids = set(samples[0]['data']['expression_levels'].keys())  # each sample has same gids
-    for s in samples:
-        gids = gids.intersection(set(s['data']['expression_levels'].keys()))
-    for gid in sorted(gids):
-        line = gid + ","
-        line += ",".join([str(s['data']['expression_levels'][gid]) for s in samples])
-        cif.write(line + "\n")
-    cif.close()
+    # samples fetched in parallel chunks, one client per thread, into the common gene list x samples matrix, written in one pass
+    samples, gids, values = series.fetch_sample_matrix(lambda: pool.client(os.environ.get('KB_AUTH_TOKEN')), sids, args.chunk_size, args.threads)
+    source_ids = [s['data']['source_id'] for s in samples]
+    series.write_matrix_csv(args.exp_fn, source_ids, gids, values)
 
     sif = open(args.rp_smp_fn, 'w')
     sample = ",".join(map(str, range(len(samples))))
@@ -105,12 +103,24 @@ def filter_expression (args) :
         flt_cmd_lst.append('-s')
         flt_cmd_lst.append(args.rp_smp_fn)
 
-    p1 = Popen(flt_cmd_lst, stdout=PIPE)
-    out_str = p1.communicate()
-    # print output message for error tracking
-    if out_str[0] is not None : print out_str[0]
-    if out_str[1] is not None : print >> sys.stderr, out_str[1]
-    flt_cmd = " ".join(flt_cmd_lst)
+    if args.engine == 'native':
+        # same selection as coex_filter, computed in process
+        if args.method in ['anova', 'a']:
+            stat, pvalues = native_filter.anova_pvalues(values, correction=args.correction or 'none')
+            order = None
+        else:
+            pvalues, order = native_filter.lor_pvalues(values, correction=args.correction or 'BH')
+        selected = native_filter.select_genes(pvalues, args.p_value, args.num_genes, order, args.selection)
+        series.write_matrix_csv(args.flt_out_fn, source_ids, [gids[i] for i in selected], values[selected], quote=True)
+        print "{0} highly differentially expressed genes are selected.".format(len(selected))
+        flt_cmd = " ".join(flt_cmd_lst) + " (native engine)"
+    else:
+        p1 = Popen(flt_cmd_lst, stdout=PIPE)
+        out_str = p1.communicate()
+        # print output message for error tracking
+        if out_str[0] is not None : print out_str[0]
+        if out_str[1] is not None : print >> sys.stderr, out_str[1]
+        flt_cmd = " ".join(flt_cmd_lst)
    
     ###
     # put it back to workspace
@@ -127,8 +137,7 @@ def filter_expression (args) :
         gene_id = values[0].replace("\"", "")
         for i in range(nsamples): elm[i][gene_id] = float(values[i + 1])
  
-    data_list = [];
-    sid_list =[];
+    outputs = OutputBatch(wsd, args.ws_id)
     for i in range(nsamples) :
         samples[i]['data']['expression_levels'] = elm[i]
         if samples[i]['data']['title'] is None: samples[i]['data']['title'] = " Filtered by coex-filter-genes" 
@@ -137,18 +146,17 @@ def filter_expression (args) :
         else : samples[i]['data']['description'] += " Generated by " + flt_cmd
         samples[i]['data']['id']+=".filtered";
         samples[i]['data']['source_id']+=".filtered";
-        data_list.append({'type' : 'KBaseExpression.ExpressionSample', 'data' : samples[i]['data'], 'name' : samples[i]['data']['id']})
-    sv_rst = wsd.save_objects({'workspace' : args.ws_id, 'objects' : data_list})
-    for i in range(nsamples):sid_list.append(str(sv_rst[i][6]) + "/" + str(sv_rst[i][0]) + "/" + str(sv_rst[i][4]))
+        outputs.add(i, {'type' : 'KBaseExpression.ExpressionSample', 'data' : samples[i]['data'], 'name' : samples[i]['data']['id']})
  
-    data_list = [];
-    # assume only one genome id
-    lseries['genome_expression_sample_ids_map'][genome_id] = sid_list
-    lseries['title'] += " filtered by coex_filter for " + genome_id
-    lseries['source_id'] += ".filtered"
-    lseries['id'] = args.outobj_id
-    data_list.append({'type' : 'KBaseExpression.ExpressionSeries', 'data' : lseries, 'name' : lseries['id'], 'meta' : {'org.series' : args.inobj_id}})
-    wsd.save_objects({'workspace' : args.ws_id, 'objects' : data_list})
+    def filtered_series(refs):
+        # assume only one genome id
+        lseries['genome_expression_sample_ids_map'][genome_id] = [refs[i] for i in range(nsamples)]
+        lseries['title'] += " filtered by coex_filter for " + genome_id
+        lseries['source_id'] += ".filtered"
+        lseries['id'] = args.outobj_id
+        return {'type' : 'KBaseExpression.ExpressionSeries', 'data' : lseries, 'name' : lseries['id'], 'meta' : {'org.series' : args.inobj_id}}
+    outputs.add('series', filtered_series, range(nsamples))
+    outputs.save()
 
     if(args.del_tmps is "true") :
         os.remove(args.exp_fn)
@@ -170,6 +178,11 @@ if __name__ == "__main__":
     parser.add_argument('-r', '--replicate_sample_id_fn', help='Replicate sample id file name (temporary file)', action='store', dest='rp_smp_fn', default='sample.csv')
     parser.add_argument('-f', '--filter_out_fn', help='Filtering output file name (temporary file)', action='store', dest='flt_out_fn', default='filtered.csv')
     parser.add_argument('-d', '--del_tmp_files', help='Delete temporary files', action='store', dest='del_tmps', default='true')
+    parser.add_argument('-g', '--engine', help='Filtering engine (\'R\' to run coex_filter or \'native\' to compute in process)', action='store', dest='engine', default='R')
+    parser.add_argument('--selection', help='num_genes rule of the native engine (\'coex_filter\' to pick the genes coex_filter picks, \'top\' for the smallest p-values)', action='store', dest='selection', default='coex_filter')
+    parser.add_argument('-c', '--correction', help='Multiple testing correction of the native engine (\'BH\', \'bonferroni\' or \'none\'; by default none for anova and BH for lor)', action='store', dest='correction', default=None)
+    parser.add_argument('--chunk_size', help='Number of samples fetched per workspace call', action='store', dest='chunk_size', type=int, default=series.DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--threads', help='Number of concurrent sample fetches', action='store', dest='threads', type=int, default=series.DEFAULT_THREADS)
     usage = parser.format_usage()
     parser.description = desc1 + '      ' + usage + desc2
     parser.usage = argparse.SUPPRESS
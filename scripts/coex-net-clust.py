@@ -6,11 +6,14 @@ import time
 import traceback
 import sys
 import ctypes
+from array import array
 import subprocess
 from subprocess import Popen, PIPE
 import os
 from optparse import OptionParser
-from biokbase.workspace.client import Workspace
+import biokbase.CoExpression.ws_pool as ws_pool
+import biokbase.CoExpression.coex_net as native_net
+import biokbase.CoExpression.series as series
 
 desc1 = '''
 NAME
@@ -46,93 +49,114 @@ Shinjae Yoo, Gang Fang, Fei He, Daifeng Wang.
       
 '''
 class Node:
-    nodes = []
-    edges = []
-    ugids = {}
-    igids = {}
-    gid2nt = {}
-    clst2genes = {}
+    """
+    Columnar network builder.  Nodes are interned to integer codes and edges
+    are kept as parallel arrays of (node1, node2, strength, confidence,
+    dataset); the KBaseNetworks.Network node and edge dicts are only built
+    by to_nodes()/to_edges() when the object is saved.
+    """
+
+    def __init__(self):
+      self.codes = {}
+      self.names = []
+      self.types = []
+      self.ds_codes = {}
+      self.ds_ids = []
+      self.node1 = array('l')
+      self.node2 = array('l')
+      self.strength = array('d')
+      self.confidence = array('d')
+      self.dataset = array('l')
+
+    def node_code(self, node, nt = "GENE"):
+      code = self.codes.get(node)
+      if code is None:
+          code = len(self.names)
+          self.codes[node] = code
+          self.names.append(node)
+          self.types.append(nt)
+      return code
 
-    def __init__(self, unodes = [], uedges=[]):
-      self._register_nodes(unodes)
-      self._register_edges(uedges)
-  
     def get_node_id(self, node, nt = "GENE"):
-      if not node in self.ugids.keys() :
-          #print node + ":" + nt
-          self.ugids[node] = len(self.ugids)
-          self.nodes.append( {
+      return "kb|netnode." + `self.node_code(node, nt)`
+
+    def _dataset_code(self, ds_id):
+      if ds_id not in self.ds_codes:
+          self.ds_codes[ds_id] = len(self.ds_ids)
+          self.ds_ids.append(ds_id)
+      return self.ds_codes[ds_id]
+
+    def add_edge(self, strength, ds_id, node1, nt1, node2, nt2, confidence):
+      self.add_edges([strength], ds_id, [node1], nt1, [node2], nt2, confidence)
+
+    def add_edges(self, strengths, ds_id, nodes1, nt1, nodes2, nt2, confidence):
+      """Append one edge per (strengths[i], nodes1[i], nodes2[i]) of a dataset."""
+      code = self.node_code
+      # node codes are assigned in node1, node2 order per edge, as edges are listed
+      c1, c2 = array('l'), array('l')
+      for n1, n2 in zip(nodes1, nodes2):
+          c1.append(code(n1, nt1))
+          c2.append(code(n2, nt2))
+      self.node1.extend(c1)
+      self.node2.extend(c2)
+      self.strength.extend(array('d', [float(s) for s in strengths]))
+      self.confidence.extend(array('d', [float(confidence)]) * len(c1))
+      self.dataset.extend(array('l', [self._dataset_code(ds_id)]) * len(c1))
+
+    def get_gene_list(self, cnode):
+      code = self.codes.get(cnode)
+      if code is None or self.types[code] != 'CLUSTER': return []
+      genes = {}
+      for n1, n2 in zip(self.node1, self.node2):
+        if n1 == code and self.types[n2] == 'GENE': genes[self.names[n2]] = 1
+        elif n2 == code and self.types[n1] == 'GENE': genes[self.names[n1]] = 1
+      return genes.keys()
+
+    def to_nodes(self):
+      return [{
             'entity_id' : node,
             'name' : node,
             'user_annotations' : {},
             'type' : nt,
-            'id' : 'kb|netnode.' + `self.ugids[node]`,
+            'id' : 'kb|netnode.' + `code`,
             'properties' : {}
-          } )
-          self.igids['kb|netnode.' + `self.ugids[node]`] = node
-          self.gid2nt[node] = nt
-      return "kb|netnode." + `self.ugids[node]`
+          } for code, (node, nt) in enumerate(zip(self.names, self.types))]
 
-    def add_edge(self, strength, ds_id, node1, nt1, node2, nt2, confidence):
-      #print node1 + "<->" + node2
-      self.edges.append( {
+    def to_edges(self):
+      nids = ['kb|netnode.' + `code` for code in range(len(self.names))]
+      return [{
           'name' : 'interacting gene pair',
           'properties' : {},
-          'strength' : float(strength),
-          'dataset_id' : ds_id,
+          'strength' : strength,
+          'dataset_id' : self.ds_ids[ds],
           'directed' : 'false',
           'user_annotations' : {},
-          'id' : 'kb|netedge.'+`len(self.edges)`,
-          'node_id1' : self.get_node_id(node1, nt1),
-          'node_id2' : self.get_node_id(node2, nt2),
-          'confidence' : float(confidence)
-      })
-      if(nt1 == 'CLUSTER'):
-        if not node1 in self.clstr2genes.keys() : self.clst2genes[node1] = {}
-        if(nt2 == 'GENE'):
-          self.clst2gene[node1][node2] = 1
-      else:
-        if(nt2 == 'CLUSTER'):
-          if not node2 in self.clst2genes.keys() : self.clst2genes[node2] = {}
-          self.clst2genes[node2][node1] = 1
-   
-    def _register_nodes(self, unodes):
-      self.nodes = unodes
-      self.ugids = {}
-      for node in self.nodes:
-        nnid = node['id']
-        nnid = nnid.replace("kb|netnode.","");
-        self.ugids[node['entity_id']] = nnid
-        self.igids[node['id']] = node['entity_id']
-        self.gid2nt[node['entity_id']] = node['type']
+          'id' : 'kb|netedge.' + `eid`,
+          'node_id1' : nids[n1],
+          'node_id2' : nids[n2],
+          'confidence' : confidence
+      } for eid, (n1, n2, strength, confidence, ds) in
+          enumerate(zip(self.node1, self.node2, self.strength, self.confidence, self.dataset))]
 
-    def _register_edges(self, uedges):
-      self.edges = uedges
-      for edge in self.edges:
-        node1 = self.igids[edge['node_id1']];
-        nt1  = self.gid2nt[node1];
-        node2 = self.igids[edge['node_id2']];
-        nt2  = self.gid2nt[node2];
-        if(nt1 == 'CLUSTER'):
-          if not node1 in self.clstr2genes.keys() : self.clst2genes[node1] = {}
-          if(nt2 == 'GENE'):
-            self.clst2genes[node1][node2] = 1
-        else:
-          if(nt2 == 'CLUSTER'):
-            if not node2 in self.clst2genes.keys() : self.clst2genes[node2] = {}
-            self.clst2genes[node2][node1] = 1
-        
 
-    def get_gene_list(self, cnode):
-      if(cnode in self.clst2genes.keys()) : return self.clst2genes[cnode].keys()
-      return []
-     
+def read_columns(fn, ncols):
+    """
+    First ncols columns of a csv written by the R tools (header skipped,
+    quotes dropped) as one list per column, parsed in bulk.
+    """
+    with open(fn, 'r') as cnf:
+      cnf.readline() # skip header
+      rows = [line.split(',') for line in cnf.read().replace('"', '').splitlines() if line.strip()]
+    if len(rows) == 0: return [[] for i in range(ncols)]
+    return [list(col) for col in zip(*rows)[:ncols]]
 
 
 def net_clust (args) :
     ###
     # download ws object and convert them to csv
-    wsd = Workspace(url=args.ws_url, token=os.environ.get('KB_AUTH_TOKEN'))
+    # one kept-alive pool for all calls, sized for the parallel sample fetches
+    pool = ws_pool.get_pool(args.ws_url, max(ws_pool.DEFAULT_POOL_SIZE, args.threads))
+    wsd = pool.client(os.environ.get('KB_AUTH_TOKEN'))
     lseries = wsd.get_object({'id' : args.inobj_id,
                   'type' : 'KBaseExpression.ExpressionSeries', 
                   'workspace' : args.ws_id})['data']
@@ -140,28 +164,22 @@ def net_clust (args) :
     if lseries is None:
         raise COEXException("Object {} not found in workspace {}".format(args.inobj_id, args.ws_id))
 
-    samples, sids, genome_id = {}, [], ""
+    sids, genome_id = [], ""
     # assume only one genome id
     for gid in sorted(lseries['genome_expression_sample_ids_map'].keys()):
         genome_id = gid
         for samid in lseries['genome_expression_sample_ids_map'][gid]:
             sids.append({'ref': samid})
-        samples = wsd.get_objects(sids)
         break
 
-    cif = open(args.exp_fn, 'w')
-    header = ",".join([s['data']['source_id'] for s in samples])
-    cif.write(header + "\n")
-    gids = samples[0]['data']['expression_levels'].keys()  # each sample has same gids
-    for gid in sorted(gids):
-        line = gid + ","
-        line += ",".join([str(s['data']['expression_levels'][gid]) for s in samples])
-        cif.write(line + "\n")
-    cif.close()
+    # samples fetched in parallel chunks, one client per thread, into the genes x samples matrix, written in one pass
+    samples, gids, values = series.fetch_sample_matrix(lambda: pool.client(os.environ.get('KB_AUTH_TOKEN')), sids, args.chunk_size, args.threads)
+    series.write_matrix_csv(args.exp_fn, [s['data']['source_id'] for s in samples], gids, values)
 
 
     ###
     # generate network and cluster
+    native = args.engine == 'native' and args.nmethod in native_net.NET_METHODS and native_net.network_method(args.nmethod)[0] == 'simple'
     net_cmd_lst = ['coex_net', '-i', args.exp_fn]
     if (args.nmethod    is not None): 
         net_cmd_lst.append("-m")
@@ -172,11 +190,18 @@ def net_clust (args) :
     if (args.net_fn     is not None):
         net_cmd_lst.append("-o")
         net_cmd_lst.append(args.net_fn)
-    p1 = Popen(net_cmd_lst, stdout=PIPE)
-    out_str = p1.communicate()
-    if out_str[0] is not None : print out_str[0]
-    if out_str[1] is not None : print >> sys.stderr, out_str[1]
-    net_cmd = " ".join(net_cmd_lst)
+    if native:
+        # sparse correlation network computed in process, no edge csv
+        kernel = native_net.network_method(args.nmethod)[1]
+        net = native_net.correlation_edges(values, args.cut_off, kernel=kernel,
+                                           dtype=native_net.precision_dtype(args.precision)).tocoo()
+        net_cmd = " ".join(net_cmd_lst) + " (native engine)"
+    else:
+        p1 = Popen(net_cmd_lst, stdout=PIPE)
+        out_str = p1.communicate()
+        if out_str[0] is not None : print out_str[0]
+        if out_str[1] is not None : print >> sys.stderr, out_str[1]
+        net_cmd = " ".join(net_cmd_lst)
    
    
     clust_cmd_lst = ['coex_cluster2', '-i', args.exp_fn]
@@ -184,8 +209,13 @@ def net_clust (args) :
         clust_cmd_lst.append("-c")
         clust_cmd_lst.append(args.cmethod)
     if (args.nmethod    is not None):
+        # coex_cluster2 takes the network type and the correlation kernel separately
         clust_cmd_lst.append("-n")
-        clust_cmd_lst.append(args.nmethod)
+        if args.nmethod in native_net.NET_METHODS:
+            network, kernel = native_net.network_method(args.nmethod)
+            clust_cmd_lst.extend([network, "-e", kernel])
+        else:
+            clust_cmd_lst.append(args.nmethod)
     if (args.k          is not None):
         clust_cmd_lst.append("-s")
         clust_cmd_lst.append(args.k)
@@ -240,29 +270,24 @@ def net_clust (args) :
     # process coex network file
     nc = Node()
  
-    cnf = open(args.net_fn,'r');
-    cnf.readline(); # skip header
-    for line in cnf :
-        line.strip();
-        line = line.replace('"','')
-        values = line.split(',')
-        if values[0] != values[1] : nc.add_edge(float(values[2]), net_ds_id, values[0], 'GENE', values[1], 'GENE', 0.0) #we add edges meaningful
+    if native:
+        # same edge orientation as the lower-triangle listing of coex_net
+        nc.add_edges(net.data.tolist(), net_ds_id, [gids[j] for j in net.col], 'GENE', [gids[i] for i in net.row], 'GENE', 0.0)
+    else:
+        node1, node2, strength = read_columns(args.net_fn, 3)
+        keep = [k for k in range(len(node1)) if node1[k] != node2[k]] #we add edges meaningful
+        nc.add_edges([strength[k] for k in keep], net_ds_id, [node1[k] for k in keep], 'GENE', [node2[k] for k in keep], 'GENE', 0.0)
  
  
     # process coex cluster file
-    cnf = open(args.clust_fn,'r')
-    cnf.readline(); # skip header
-    for line in cnf :
-        line = line.strip();
-        line = line.replace('"','')
-        values = line.split(',')
-        nc.add_edge(1.0, clt_ds_id, values[0], 'GENE', "cluster." + values[1], 'CLUSTER', 0.0)
+    genes, clusters = read_columns(args.clust_fn, 2)
+    nc.add_edges([1.0] * len(genes), clt_ds_id, genes, 'GENE', ["cluster." + c for c in clusters], 'CLUSTER', 0.0)
  
     # generate Networks object
     net_object = {
       'datasets' : datasets,
-      'nodes' : nc.nodes,
-      'edges' : nc.edges,
+      'nodes' : nc.to_nodes(),
+      'edges' : nc.to_edges(),
       'user_annotations' : {},
       'name' : 'Coexpression Network',
       'id' : args.outobj_id,
@@ -276,7 +301,7 @@ def net_clust (args) :
  
     if(args.del_tmps is "true") :
         os.remove(args.exp_fn)
-        os.remove(args.net_fn)
+        if not native: os.remove(args.net_fn)
         os.remove(args.clust_fn)
  
 
@@ -288,17 +313,27 @@ if __name__ == "__main__":
     parser.add_argument('-i', '--in_id', help='Input Series object id', action='store', dest='inobj_id', default=None, required=True)
     parser.add_argument('-o', '--out_id', help='Output network object id', action='store', dest='outobj_id', default=None, required=True)
     parser.add_argument('-m', '--clust_method', help='Clustering method (\'hclust\' for hierachical clustering or \'WGCNA\' for WGCNA method', action='store', dest='cmethod', default='hclust')
-    parser.add_argument('-n', '--net_method', help='Network construction method (\'simple\' for PCC or \'WGCNA\' for WGCNA method', action='store', dest='nmethod', default='simple')
+    parser.add_argument('-n', '--net_method', help='Network construction method (\'simple\' for PCC or \'WGCNA\' for WGCNA method; \'spearman\' or \'bicor\' only with \'--engine native\')', action='store', dest='nmethod', default='simple')
     parser.add_argument('-c', '--cut_off', help='The edge cut-off value', action='store', dest='cut_off', default=None)
     parser.add_argument('-k', '--num_module', help='The number of module to be generated', action='store', dest='k', default=None, required=True)
     parser.add_argument('-e', '--expression_fn', help='Expression file name (temporary file)', action='store', dest='exp_fn', default='expression.csv')
     parser.add_argument('-t', '--net_out_fn', help='Network output file name (temporary file)', action='store', dest='net_fn', default='net.csv')
     parser.add_argument('-l', '--clust_out_fn', help='Cluster output file name (temporary file)', action='store', dest='clust_fn', default='clust.csv')
     parser.add_argument('-d', '--del_tmp_files', help='Delete temporary files', action='store', dest='del_tmps', default='true')
+    parser.add_argument('-g', '--engine', help='Network engine for the \'simple\' method (\'R\' to run coex_net or \'native\' to compute in process)', action='store', dest='engine', default='R')
+    parser.add_argument('-x', '--precision', help='Arithmetic of the native engine (\'float64\' or \'float32\')', action='store', dest='precision', default='float64')
+    parser.add_argument('--chunk_size', help='Number of samples fetched per workspace call', action='store', dest='chunk_size', type=int, default=series.DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--threads', help='Number of concurrent sample fetches', action='store', dest='threads', type=int, default=series.DEFAULT_THREADS)
     usage = parser.format_usage()
     parser.description = desc1 + '      ' + usage + desc2
     parser.usage = argparse.SUPPRESS
     args = parser.parse_args()
+    if args.nmethod in native_net.NET_METHODS:
+        network, kernel = native_net.network_method(args.nmethod)
+        # coex_net only builds Pearson networks; the other kernels are computed by the native engine
+        if kernel != 'pearson' and not (args.engine == 'native' and network == 'simple'):
+            parser.error("--net_method {0} needs the native engine ('--engine native') and a 'simple' network; "
+                         "coex_net only builds Pearson correlation networks".format(args.nmethod))
 
     # main loop
     net_clust(args)
@@ -20,6 +20,9 @@ import requests
 
 # KBase imports
 import biokbase.workspace.client 
+import biokbase.CoExpression.ws_pool as ws_pool
+import biokbase.CoExpression.intermediate as intermediate
+import biokbase.CoExpression.scratch as scratch
 import biokbase.Transform.script_utils as script_utils 
 
 
@@ -37,6 +40,8 @@ FLTRD_FN = 'filtered.tsv'
 CLSTR_FN = 'clusters.tsv'
 FINAL_FN = 'filtered.json'
 GENELST_FN = 'selected.tsv'
+# the job's working directory holds the per-run scratch directories
+SCRATCH_ROOT = '.'
 
 
 def empty_results(err_msg, expr, workspace_service_url, param, logger, ws):
@@ -70,7 +75,8 @@ def empty_cluster_results(err_msg, expr, workspace_service_url, param, logger, w
                                                                           'data' : clrst,
                                                                           'name' : (param['out_object_name'])}]})
 
-def run_coex_cluster(workspace_service_url=None, param_file = None, level=logging.INFO, logger = None):
+def run_coex_cluster(workspace_service_url=None, param_file = None, level=logging.INFO, logger = None,
+                     codec='none', scratch_root=SCRATCH_ROOT):
     """
     Narrative Job Wrapper script to execute coex_cluster2
     
@@ -79,6 +85,8 @@ def run_coex_cluster(workspace_service_url=None, param_file = None, level=loggin
         param_file: parameter file
         object_name: Name of the object in the workspace 
         level: Logging level, defaults to logging.INFO.
+        codec: codec of the intermediates ('none' or 'gzip')
+        scratch_root: directory of the per-run scratch directory
     
     Returns:
         Output is written back in WS
@@ -88,19 +96,13 @@ def run_coex_cluster(workspace_service_url=None, param_file = None, level=loggin
     
     """ 
 
+    scr = scratch.Scratch(scratch_root, [RAWEXPR_DIR, CLSTR_DIR], prefix='njs_')
     try:
-        os.makedirs(RAWEXPR_DIR)
-    except:
-        pass
-    try:
-        os.makedirs(CLSTR_DIR)
-    except:
-        pass
-    try:
-        os.makedirs(FINAL_DIR)
-    except:
-        pass
+        return _coex_cluster(scr, workspace_service_url, param_file, logger, codec)
+    finally:
+        scr.cleanup()
 
+def _coex_cluster(scr, workspace_service_url, param_file, logger, codec):
     if logger is None:
         logger = script_utils.stderrlogger(__file__)
     
@@ -111,15 +113,14 @@ def run_coex_cluster(workspace_service_url=None, param_file = None, level=loggin
       param = json.load(paramh)
 
 
-    from biokbase.workspace.client import Workspace
-    ws = Workspace(url=workspace_service_url, token=os.environ['KB_AUTH_TOKEN'])
+    ws = ws_pool.get_pool(workspace_service_url).client(os.environ['KB_AUTH_TOKEN'])
     expr = ws.get_objects([{'workspace': param['workspace_name'], 'name' : param['object_name']}])[0]['data']
 
 
     cmd_dowload_cvt_tsv = [FVE_2_TSV, '--workspace_service_url', workspace_service_url, 
                                       '--workspace_name', param['workspace_name'],
                                       '--object_name', param['object_name'],
-                                      '--working_directory', RAWEXPR_DIR,
+                                      '--working_directory', scr.dir(RAWEXPR_DIR),
                                       '--output_file_name', EXPRESS_FN
                           ]
 
@@ -139,11 +140,14 @@ def run_coex_cluster(workspace_service_url=None, param_file = None, level=loggin
 
     ## Prepare sample file
     # detect num of columns
-    with open("{0}/{1}".format(RAWEXPR_DIR, EXPRESS_FN), 'r') as f:
+    # written by the transform script, read whether or not it is compressed
+    expr_fn = "{0}/{1}".format(scr.dir(RAWEXPR_DIR), EXPRESS_FN)
+    with intermediate.open_file(expr_fn, 'r') as f:
       fl = f.readline()
     ncol = len(fl.split('\t'))
     
-    with open("{0}/{1}".format(RAWEXPR_DIR, SAMPLE_FN), 'wt') as s:
+    sample_fn = intermediate.path("{0}/{1}".format(scr.dir(RAWEXPR_DIR), SAMPLE_FN), codec)
+    with intermediate.open_file(sample_fn, 'wt', codec) as s:
       s.write("0")
       for j in range(1,ncol-1):
         s.write("\t{0}".format(j))
@@ -151,9 +155,10 @@ def run_coex_cluster(workspace_service_url=None, param_file = None, level=loggin
 
 
     ## Run coex_cluster
+    clstr_fn = intermediate.path("{0}/{1}".format(scr.dir(CLSTR_DIR), CLSTR_FN), codec)
     cmd_coex_cluster = [COEX_CLUSTER, '-t', 'y',
-                       '-i', "{0}/{1}".format(RAWEXPR_DIR, EXPRESS_FN), 
-                       '-o', "{0}/{1}".format(CLSTR_DIR, CLSTR_FN)]
+                       '-i', expr_fn, 
+                       '-o', clstr_fn]
 
     for p in ['net_method', 'minRsq', 'maxmediank', 'maxpower', 'clust_method', 'minModuleSize', 'detectCutHeight']:
        if p in param:
@@ -167,7 +172,7 @@ def run_coex_cluster(workspace_service_url=None, param_file = None, level=loggin
     #  logger.error("Both of p_value and num_features cannot be defined together");
     #  sys.exit(3)
 
-    tool_process = subprocess.Popen(cmd_coex_cluster, stderr=subprocess.PIPE)
+    tool_process = subprocess.Popen(cmd_coex_cluster, stderr=subprocess.PIPE, cwd=scr.root)
     stdout, stderr = tool_process.communicate()
     
     if stdout is not None and len(stdout) > 0:
@@ -187,7 +192,7 @@ def run_coex_cluster(workspace_service_url=None, param_file = None, level=loggin
 
     # parse clustering results
     cid2genelist = {}
-    with open("{0}/{1}".format(CLSTR_DIR, CLSTR_FN),'r') as glh:
+    with intermediate.open_file(clstr_fn, 'r') as glh:
         glh.readline() # skip header
         for line in glh:
             gene, cluster = line.replace('"','').split("\t")
@@ -214,7 +219,8 @@ def run_coex_cluster(workspace_service_url=None, param_file = None, level=loggin
                                                                           'data' : feature_clusters,
                                                                           'name' : (param['out_object_name'])}]})
 
-def run_filter_genes(workspace_service_url=None, param_file = None, level=logging.INFO, logger = None):
+def run_filter_genes(workspace_service_url=None, param_file = None, level=logging.INFO, logger = None,
+                     codec='none', scratch_root=SCRATCH_ROOT):
     """
     Narrative Job Wrapper script to execute coex_filter
     
@@ -223,6 +229,8 @@ def run_filter_genes(workspace_service_url=None, param_file = None, level=loggin
         param_file: parameter file
         object_name: Name of the object in the workspace 
         level: Logging level, defaults to logging.INFO.
+        codec: codec of the intermediates ('none' or 'gzip')
+        scratch_root: directory of the per-run scratch directory
     
     Returns:
         Output is written back in WS
@@ -232,19 +240,13 @@ def run_filter_genes(workspace_service_url=None, param_file = None, level=loggin
     
     """ 
 
+    scr = scratch.Scratch(scratch_root, [RAWEXPR_DIR, FLTRD_DIR, FINAL_DIR], prefix='njs_')
     try:
-        os.makedirs(RAWEXPR_DIR)
-    except:
-        pass
-    try:
-        os.makedirs(FLTRD_DIR)
-    except:
-        pass
-    try:
-        os.makedirs(FINAL_DIR)
-    except:
-        pass
+        return _filter_genes(scr, workspace_service_url, param_file, logger, codec)
+    finally:
+        scr.cleanup()
 
+def _filter_genes(scr, workspace_service_url, param_file, logger, codec):
     if logger is None:
         logger = script_utils.stderrlogger(__file__)
     
@@ -255,15 +257,14 @@ def run_filter_genes(workspace_service_url=None, param_file = None, level=loggin
       param = json.load(paramh)
 
 
-    from biokbase.workspace.client import Workspace
-    ws = Workspace(url=workspace_service_url, token=os.environ['KB_AUTH_TOKEN'])
+    ws = ws_pool.get_pool(workspace_service_url).client(os.environ['KB_AUTH_TOKEN'])
     expr = ws.get_objects([{'workspace': param['workspace_name'], 'name' : param['object_name']}])[0]['data']
 
 
     cmd_dowload_cvt_tsv = [FVE_2_TSV, '--workspace_service_url', workspace_service_url, 
                                       '--workspace_name', param['workspace_name'],
                                       '--object_name', param['object_name'],
-                                      '--working_directory', RAWEXPR_DIR,
+                                      '--working_directory', scr.dir(RAWEXPR_DIR),
                                       '--output_file_name', EXPRESS_FN
                           ]
 
@@ -282,14 +283,17 @@ def run_filter_genes(workspace_service_url=None, param_file = None, level=loggin
 
     ## Prepare sample file
     # detect num of columns
-    with open("{0}/{1}".format(RAWEXPR_DIR, EXPRESS_FN), 'r') as f:
+    # written by the transform script, read whether or not it is compressed
+    expr_fn = "{0}/{1}".format(scr.dir(RAWEXPR_DIR), EXPRESS_FN)
+    with intermediate.open_file(expr_fn, 'r') as f:
       fl = f.readline()
     ncol = len(fl.split('\t'))
     
     # force to use ANOVA if the number of sample is two
     if(ncol == 3): param['method'] = 'anova'
 
-    with open("{0}/{1}".format(RAWEXPR_DIR, SAMPLE_FN), 'wt') as s:
+    sample_fn = intermediate.path("{0}/{1}".format(scr.dir(RAWEXPR_DIR), SAMPLE_FN), codec)
+    with intermediate.open_file(sample_fn, 'wt', codec) as s:
       s.write("0")
       for j in range(1,ncol-1):
         s.write("\t{0}".format(j))
@@ -297,9 +301,12 @@ def run_filter_genes(workspace_service_url=None, param_file = None, level=loggin
 
 
     ## Run coex_filter
-    cmd_coex_filter = [COEX_FILTER, '-i', "{0}/{1}".format(RAWEXPR_DIR, EXPRESS_FN), '-o', "{0}/{1}".format(FLTRD_DIR, FLTRD_FN),
-                       '-m', param['method'], '-s', "{0}/{1}".format(RAWEXPR_DIR, SAMPLE_FN),
-                       '-x', "{0}/{1}".format(RAWEXPR_DIR, GENELST_FN), '-t', 'y']
+    # filtered.tsv stays uncompressed: the upload transform reads every file of fltr_dir as plain TSV
+    fltrd_fn = "{0}/{1}".format(scr.dir(FLTRD_DIR), FLTRD_FN)
+    genelst_fn = intermediate.path("{0}/{1}".format(scr.dir(RAWEXPR_DIR), GENELST_FN), codec)
+    cmd_coex_filter = [COEX_FILTER, '-i', expr_fn, '-o', fltrd_fn,
+                       '-m', param['method'], '-s', sample_fn,
+                       '-x', genelst_fn, '-t', 'y']
     if 'num_features' in param:
       cmd_coex_filter.append("-n")
       cmd_coex_filter.append(str(param['num_features']))
@@ -317,7 +324,7 @@ def run_filter_genes(workspace_service_url=None, param_file = None, level=loggin
     #  logger.error("Both of p_value and num_features cannot be defined together");
     #  sys.exit(3)
 
-    tool_process = subprocess.Popen(cmd_coex_filter, stderr=subprocess.PIPE)
+    tool_process = subprocess.Popen(cmd_coex_filter, stderr=subprocess.PIPE, cwd=scr.root)
     stdout, stderr = tool_process.communicate()
     
     if stdout is not None and len(stdout) > 0:
@@ -328,9 +335,9 @@ def run_filter_genes(workspace_service_url=None, param_file = None, level=loggin
 
     ## Header correction
     try:
-        with open("{0}/{1}".format(FLTRD_DIR, FLTRD_FN), 'r') as ff:
+        with open(fltrd_fn, 'r') as ff:
             fe = ff.readlines()
-        with open("{0}/{1}".format(FLTRD_DIR, FLTRD_FN), 'w') as ff:
+        with open(fltrd_fn, 'w') as ff:
             ff.write(fl) # use original first line that has correct header information
             fe.pop(0)
             ff.writelines(fe)
@@ -340,7 +347,7 @@ def run_filter_genes(workspace_service_url=None, param_file = None, level=loggin
         
     
     ## checking genelist
-    with open("{0}/{1}".format(RAWEXPR_DIR, GENELST_FN),'r') as glh:
+    with intermediate.open_file(genelst_fn, 'r') as glh:
       gl = glh.readlines()
     gl = [x.strip('\n') for x in gl]
 
@@ -354,8 +361,8 @@ def run_filter_genes(workspace_service_url=None, param_file = None, level=loggin
     # Updates: change missing genome handling strategy by copying reference to working workspace
     cmd_upload_expr = [TSV_2_FVE, '--workspace_service_url', workspace_service_url, 
                                       '--object_name', param['out_expr_object_name'],
-                                      '--working_directory', FINAL_DIR,
-                                      '--input_directory', FLTRD_DIR,
+                                      '--working_directory', scr.dir(FINAL_DIR),
+                                      '--input_directory', scr.dir(FLTRD_DIR),
                                       '--output_file_name', FINAL_FN
                           ]
     tmp_ws = param['workspace_name']
@@ -401,7 +408,8 @@ def run_filter_genes(workspace_service_url=None, param_file = None, level=loggin
         logger.info(stderr)
 
     
-    with open("{0}/{1}".format(FINAL_DIR,FINAL_FN),'r') as et:
+    # final_dir is written by the upload transform, which only writes plain JSON
+    with open("{0}/{1}".format(scr.dir(FINAL_DIR), FINAL_FN),'r') as et:
       eo = json.load(et)
 
     if 'description' not in expr: 
@@ -445,6 +453,8 @@ if __name__ == "__main__":
     parser.add_argument('-c','--command', help ='Command name', action='store', type=str, nargs='?', required=True)
     parser.add_argument('-p','--param_file', help ='Input parameter file name', action='store', type=str, nargs='?', required=True)
     parser.add_argument('-t','--token', help ='token', action='store', type=str, nargs='?', default=None, required=False)
+    parser.add_argument('-z','--codec', help ='Codec of the intermediates', action='store', type=str, nargs='?', default='none', choices=sorted(intermediate.CODECS), required=False)
+    parser.add_argument('-d','--scratch_root', help ='Directory of the per-run scratch directory', action='store', type=str, nargs='?', default=SCRATCH_ROOT, required=False)
 
     args = parser.parse_args()
 
@@ -452,9 +462,9 @@ if __name__ == "__main__":
     try:
         #ret_json = run_coex_cluster(args.ws_url, args.param_file, logger=logger)
         if args.command == 'coex_filter':
-            ret_json = run_filter_genes(args.ws_url, args.param_file, logger=logger)
+            ret_json = run_filter_genes(args.ws_url, args.param_file, logger=logger, codec=args.codec, scratch_root=args.scratch_root)
         elif args.command == "coex_cluster":
-            ret_json = run_coex_cluster(args.ws_url, args.param_file, logger=logger)
+            ret_json = run_coex_cluster(args.ws_url, args.param_file, logger=logger, codec=args.codec, scratch_root=args.scratch_root)
         else:
             logger.error("No defined method -{0}, please check your method name.".format(args.command))
             raise Exception("No defined method '{0}', please check your method name.".format(args.command))
@@ -0,0 +1,120 @@
+"""
+Shared helpers of the engine unit tests: the ltest input matrices and
+optional runs of the R tools the native engines reproduce.
+
+Comparisons against R run only where Rscript and the needed packages are
+installed (the module image); elsewhere they are skipped.  Their R outputs
+are recorded in test/data (make record-r-outputs), so that the native
+engines are also compared with R where R is not installed.
+"""
+import os
+import json
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INPUT_DATA_DIR = os.path.join(TOP_DIR, 'ltest', 'script_test', 'input_data')
+SCRIPTS_DIR = os.path.join(TOP_DIR, 'scripts')
+DATA_DIR = os.path.join(TOP_DIR, 'test', 'data')
+RECORD_ENV = 'COEX_RECORD_R'
+
+
+def load_object(name):
+    """Data of a workspace object dump in ltest/script_test/input_data."""
+    with open(os.path.join(INPUT_DATA_DIR, name + '.json')) as fh:
+        return json.load(fh)[0]['data']
+
+
+def load_matrix(name):
+    """row_ids, col_ids and float values (NaN for missing) of an ltest ExpressionMatrix."""
+    data = load_object(name)['data']
+    values = np.array([[np.nan if x is None else x for x in row] for row in data['values']], dtype=float)
+    return data['row_ids'], data['col_ids'], values
+
+
+def recorded_output(fn):
+    """Lines of the R output recorded as test/data/fn, or None when it is not recorded."""
+    path = os.path.join(DATA_DIR, fn)
+    if not os.path.exists(path):
+        return None
+    with open(path) as fh:
+        return [line.rstrip('\n') for line in fh]
+
+
+def record_output(fn, lines):
+    """Record an R output as test/data/fn when RECORD_ENV is set."""
+    if not os.environ.get(RECORD_ENV):
+        return
+    if not os.path.isdir(DATA_DIR):
+        os.makedirs(DATA_DIR)
+    with open(os.path.join(DATA_DIR, fn), 'w') as fh:
+        fh.write(''.join([line + '\n' for line in lines]))
+
+
+def requires_recorded(fn):
+    """Skip a test until the R output fn is recorded in test/data."""
+    return unittest.skipUnless(os.path.exists(os.path.join(DATA_DIR, fn)),
+                               "R output {0} is not recorded; run make record-r-outputs".format(fn))
+
+
+_have_r = {}
+
+
+def have_r(*packages):
+    """True when Rscript runs and loads every package."""
+    key = tuple(packages)
+    if key not in _have_r:
+        expr = ';'.join(["suppressPackageStartupMessages(library('{0}'))".format(p) for p in packages]) or 'q()'
+        try:
+            with open(os.devnull, 'w') as null:
+                _have_r[key] = subprocess.call(['Rscript', '-e', expr], stdout=null, stderr=null) == 0
+        except OSError:
+            _have_r[key] = False
+    return _have_r[key]
+
+
+def requires_r(*packages):
+    """Skip a test unless R and packages are installed."""
+    return unittest.skipUnless(have_r(*packages), "R with {0} is not installed".format(', '.join(packages)))
+
+
+class RRun(object):
+    """Temporary directory to run one R tool of scripts/ in."""
+
+    def __init__(self):
+        self.dir = tempfile.mkdtemp(prefix='coex_test_')
+
+    def path(self, fn):
+        return os.path.join(self.dir, fn)
+
+    def write_matrix(self, fn, row_ids, col_ids, values):
+        # as CoExpressionImpl._dumpExp2File writes it
+        pd.DataFrame(values, index=row_ids, columns=col_ids).to_csv(self.path(fn), sep='\t', na_rep='NA')
+        return self.path(fn)
+
+    def write_sample(self, fn, ncol):
+        # every column its own sample, as CoExpression writes sample.tsv
+        with open(self.path(fn), 'w') as fh:
+            fh.write("\t".join([str(j) for j in range(ncol)]) + "\n")
+        return self.path(fn)
+
+    def run(self, script, args):
+        return subprocess.check_output(['Rscript', os.path.join(SCRIPTS_DIR, script)] + args, cwd=self.dir)
+
+    def eval(self, code):
+        # output of an R snippet run in the directory
+        return subprocess.check_output(['Rscript', '-e', code], cwd=self.dir)
+
+    def read_table(self, fn):
+        # rows of a tab separated R output without its header, quotes removed
+        with open(self.path(fn)) as fh:
+            fh.readline()
+            return [line.rstrip('\n').replace('"', '').split('\t') for line in fh]
+
+    def cleanup(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
@@ -0,0 +1,71 @@
+import time
+import unittest
+
+import biokbase.CoExpression.auth_cache as auth_cache
+
+
+class AuthService(object):
+    """validate_token stand-in counting calls; raises error when set."""
+
+    def __init__(self, expiry=None):
+        self.calls = 0
+        self.error = None
+        self.expiry = expiry or time.time() + 3600
+
+    def validate_token(self, token):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return ('user', 'client', str(self.expiry))
+
+
+class AuthCacheTest(unittest.TestCase):
+
+    def test_valid_token_is_cached(self):
+        service, cache = AuthService(), auth_cache.AuthCache()
+        for i in range(3):
+            self.assertEqual(cache.validate(service.validate_token, 'token')[0], 'user')
+        self.assertEqual(service.calls, 1)
+        self.assertEqual(cache.stats()['valid'], {'hits': 2, 'misses': 1, 'size': 1})
+
+    def test_expired_token_is_validated_again(self):
+        service, cache = AuthService(time.time() - 1), auth_cache.AuthCache()
+        cache.validate(service.validate_token, 'token')
+        cache.validate(service.validate_token, 'token')
+        self.assertEqual(service.calls, 2)
+
+    def test_rejected_token_is_cached(self):
+        service, cache = AuthService(), auth_cache.AuthCache()
+        service.error = ValueError('Invalid Signature')
+        for i in range(2):
+            self.assertRaises(ValueError, cache.validate, service.validate_token, 'token')
+        self.assertEqual(service.calls, 1)
+
+    def test_transient_failures_are_not_cached(self):
+        for error in [IOError('Connection refused'), ValueError('No JSON object could be decoded'),
+                      RuntimeError('500 Internal Server Error')]:
+            service, cache = AuthService(), auth_cache.AuthCache()
+            service.error = error
+            self.assertRaises(type(error), cache.validate, service.validate_token, 'token')
+            service.error = None
+            self.assertEqual(cache.validate(service.validate_token, 'token')[0], 'user')
+            self.assertEqual(service.calls, 2)
+
+    def test_stats_are_reported(self):
+        reports = []
+        service, cache = AuthService(), auth_cache.AuthCache(stats_interval=2, report=reports.append)
+        for i in range(5):
+            cache.validate(service.validate_token, 'token')
+        self.assertEqual([r['valid']['hits'] for r in reports], [1, 3])
+
+    def test_caching_client(self):
+        service = AuthService()
+        client = auth_cache.CachingAuthClient(service, auth_cache.AuthCache())
+        client.validate_token('token')
+        self.assertEqual(client.validate_token('token')[0], 'user')
+        self.assertEqual(service.calls, 1)
+        self.assertEqual(client.expiry, service.expiry)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,237 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+from scipy.cluster import hierarchy
+from scipy.spatial import distance
+
+import biokbase.CoExpression.coex_cluster as coex_cluster
+from helpers import load_matrix, load_object, requires_r, RRun
+
+
+def dense_tom(values, power):
+    # TOMsimilarity of the signed adjacency, in memory
+    a = ((1 + np.corrcoef(values)) / 2) ** power
+    np.fill_diagonal(a, 0)
+    k = a.sum(axis=1)
+    tom = (a.dot(a) + a) / (np.minimum(k[:, None], k[None, :]) + 1 - a)
+    np.fill_diagonal(tom, 1)
+    return tom
+
+
+# clusters 3000 genes under a data limit too small for their 36 MB condensed dissimilarity
+LIMITED_LINKAGE = """
+import resource, shutil, tempfile
+import numpy as np
+import biokbase.CoExpression.coex_cluster as coex_cluster
+
+n = 3000
+values = np.random.RandomState(1).normal(size=(n, 6))
+values.dot(values.T[:, :8])  # allocate the BLAS buffers before the limit
+with open('/proc/self/status') as fh:
+    used = [int(line.split()[1]) * 1024 for line in fh if line.startswith('VmData:')][0]
+resource.setrlimit(resource.RLIMIT_DATA, (used + 16 * 1024 * 1024, resource.RLIM_INFINITY))
+try:
+    np.empty(n * (n - 1) // 2)
+    print('unlimited')
+except MemoryError:
+    workdir = tempfile.mkdtemp(prefix='coex_test_')
+    try:
+        diss = coex_cluster.tom_dissimilarity(values, 6, workdir, dtype=np.float64, memory_budget=4 * 1024 * 1024)
+        tree = coex_cluster.nn_chain_linkage(diss, 'average')
+        print(int(tree[-1, 3]))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+"""
+
+
+def r_tree_cut(run):
+    # the tree cut CoExpressionImpl gives the native clustering: coex_cluster2 --tree, in run's directory
+    def tree_cut(tree, cut_height, min_size):
+        coex_cluster.write_r_tree(run.path('tree.tsv'), tree)
+        run.run('coex_cluster2.R', ['--tree', 'tree.tsv', '-o', 'modules.tsv', '-s', str(min_size), '-d', str(cut_height)])
+        return [row[0] for row in run.read_table('modules.tsv')]
+    return tree_cut
+
+
+def r_modules(name):
+    # module of every gene in a stored FeatureClusters output of coex_cluster2
+    row_ids, col_ids, values = load_matrix(name)
+    modules = np.zeros(len(row_ids), dtype=int)
+    for i, cluster in enumerate(load_object('WGCNA_output_Feb16_2')['feature_clusters']):
+        for gene, pos in cluster['id_to_pos'].items():
+            modules[pos] = i + 1
+    return values, modules
+
+
+class TomTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='coex_test_')
+        rs = np.random.RandomState(7)
+        self.values = rs.normal(size=(45, 9))
+        self.values[:15] += 2 * rs.normal(size=9)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_blocks_match_dense(self):
+        # a budget of a few rows per block forces many blocks
+        budget = 3 * (8 * 2 * 45 + 8 * 45)
+        diss = coex_cluster.tom_dissimilarity(self.values, 4, self.workdir, dtype=np.float64, memory_budget=budget)
+        self.assertEqual(coex_cluster.block_rows(45, budget), 3)
+        self.assertTrue(np.allclose(diss, 1 - dense_tom(self.values, 4)))
+
+    def test_float32_memmap(self):
+        diss = coex_cluster.tom_dissimilarity(self.values, 6, self.workdir)
+        self.assertEqual(diss.dtype, np.float32)
+        self.assertTrue(np.allclose(diss, 1 - dense_tom(self.values, 6), atol=1e-5))
+
+
+class LinkageTest(unittest.TestCase):
+
+    def test_matches_scipy(self):
+        # rounded dissimilarities have ties, which must be broken as scipy does
+        rs = np.random.RandomState(8)
+        for n in [2, 3, 40, 150]:
+            x = np.round(rs.uniform(size=(n, n)), 2)
+            x = (x + x.T) / 2
+            np.fill_diagonal(x, 0)
+            for method in ['average', 'complete']:
+                expected = hierarchy.linkage(distance.squareform(x), method)
+                self.assertTrue(np.array_equal(coex_cluster.nn_chain_linkage(x.copy(), method), expected))
+
+    def test_in_place_on_memmap(self):
+        workdir = tempfile.mkdtemp(prefix='coex_test_')
+        try:
+            values = np.random.RandomState(10).normal(size=(60, 8))
+            expected = hierarchy.linkage(distance.pdist(values, 'correlation'), 'complete')
+            diss = coex_cluster.adjacency_dissimilarity(values, os.path.join(workdir, 'diss.mmap'), block_size=16)
+            self.assertTrue(isinstance(diss, np.memmap))
+            self.assertTrue(np.allclose(coex_cluster.nn_chain_linkage(diss, 'complete'), expected))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def test_hclust_modules(self):
+        values = np.random.RandomState(11).normal(size=(50, 7))
+        workdir = tempfile.mkdtemp(prefix='coex_test_')
+        try:
+            modules, stats = coex_cluster.detect_modules(values, 'simple', 'hclust', min_module_size=4, workdir=workdir)
+            self.assertEqual(os.listdir(workdir), [])
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        tree = hierarchy.linkage(1 - distance.squareform(np.corrcoef(values), checks=False), 'complete')
+        self.assertEqual(modules, [str(x) for x in coex_cluster.cutree_k(tree, 4)])
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), "needs /proc and RLIMIT_DATA")
+    def test_without_condensed_copy(self):
+        out = subprocess.check_output([sys.executable, '-c', LIMITED_LINKAGE],
+                                      env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path),
+                                               OPENBLAS_NUM_THREADS='1'))
+        if out.strip() == 'unlimited':
+            self.skipTest("RLIMIT_DATA is not enforced")
+        self.assertEqual(out.strip(), '3000')
+
+
+class RTreeTest(unittest.TestCase):
+
+    def test_merge_and_order(self):
+        tree = hierarchy.linkage(np.array([[0.0], [10.0], [1.0], [12.0]]), 'average')
+        merge, height, order = coex_cluster.r_tree(tree)
+        self.assertEqual(merge.tolist(), [[-1, -3], [-2, -4], [1, 2]])
+        self.assertEqual(order.tolist(), [1, 3, 2, 4])
+        # a gene comes before a cluster, whatever their numbers
+        tree = hierarchy.linkage(np.array([[0.0], [1.0], [3.0], [10.0]]), 'average')
+        merge, height, order = coex_cluster.r_tree(tree)
+        self.assertEqual(merge.tolist(), [[-1, -2], [-3, 1], [-4, 2]])
+        self.assertEqual(order.tolist(), [4, 3, 1, 2])
+        self.assertEqual(height.tolist(), tree[:, 2].tolist())
+
+    def test_write(self):
+        workdir = tempfile.mkdtemp(prefix='coex_test_')
+        try:
+            path = os.path.join(workdir, 'tree.tsv')
+            coex_cluster.write_r_tree(path, hierarchy.linkage(np.array([[0.0], [1.0], [3.0]]), 'average'))
+            with open(path) as fh:
+                self.assertEqual(fh.read(), "merge1\tmerge2\theight\n-1\t-2\t1.0\n-3\t1\t2.5\n")
+            with open(path + '.order') as fh:
+                self.assertEqual(fh.read(), "3\n1\n2\n")
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def test_wgcna_needs_tree_cut(self):
+        self.assertRaises(ValueError, coex_cluster.detect_modules, np.zeros((10, 3)), 'WGCNA', 'WGCNA', 6)
+
+
+class StoredROutputTest(unittest.TestCase):
+    # WGCNA_output_Feb16_2 is coex_cluster2's WGCNA clustering of the top500 matrix (power 6, defaults)
+
+    def test_module_stats(self):
+        values, modules = r_modules('GSE71046_maizeRNAseq_top500')
+        stats = coex_cluster.module_stats(values, [str(m) for m in modules], 'WGCNA', 6)
+        expected = dict((str(i + 1), c['meancor'])
+                        for i, c in enumerate(load_object('WGCNA_output_Feb16_2')['feature_clusters']))
+        for module, mcor, msec in stats:
+            self.assertAlmostEqual(mcor, expected[module], places=9)
+
+    @requires_r('optparse', 'WGCNA')
+    def test_cutree_dynamic(self):
+        # R found modules of 175, 224 and 101 genes
+        values, modules = r_modules('GSE71046_maizeRNAseq_top500')
+        run = RRun()
+        try:
+            native, stats = coex_cluster.detect_modules(values, 'WGCNA', 'WGCNA', 6, workdir=run.path('clstr'),
+                                                        tree_cut=r_tree_cut(run))
+        finally:
+            run.cleanup()
+        pairs = set(zip(modules, native))
+        self.assertEqual(len(pairs), len(set(modules)))
+        self.assertEqual(len(pairs), len(set(native)))
+
+
+class CoexCluster2RTest(unittest.TestCase):
+    # regression against coex_cluster2.R on the const_coex_net_clust test input
+
+    @requires_r('optparse', 'jsonlite', 'WGCNA', 'ape', 'reshape')
+    def test_hclust(self):
+        row_ids, col_ids, values = load_matrix('GSE71046_maizeRNAseq_top500')
+        run = RRun()
+        try:
+            run.write_matrix('expression.tsv', row_ids, col_ids, values)
+            run.run('coex_cluster2.R', ['-i', 'expression.tsv', '-o', 'clusters.tsv', '-m', 'cluster_stat.tsv',
+                                        '-t', 'y', '-n', 'WGCNA', '-w', '6', '-c', 'hclust', '-s', '5'])
+            expected = dict(run.read_table('clusters.tsv'))
+            expected_stats = dict((m, float(mcor)) for m, mcor, msec in run.read_table('cluster_stat.tsv'))
+        finally:
+            run.cleanup()
+        workdir = tempfile.mkdtemp(prefix='coex_test_')
+        try:
+            modules, stats = coex_cluster.detect_modules(values, 'WGCNA', 'hclust', 6, 5, workdir=workdir)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        self.assertEqual(dict(zip(row_ids, modules)), expected)
+        for module, mcor, msec in stats:
+            self.assertAlmostEqual(mcor, expected_stats[module], places=6)
+
+    @requires_r('optparse', 'jsonlite', 'WGCNA', 'reshape', 'flashClust')
+    def test_wgcna(self):
+        row_ids, col_ids, values = load_matrix('GSE71046_maizeRNAseq_top500')
+        run = RRun()
+        try:
+            run.write_matrix('expression.tsv', row_ids, col_ids, values)
+            run.run('coex_cluster2.R', ['-i', 'expression.tsv', '-o', 'clusters.tsv', '-m', 'cluster_stat.tsv',
+                                        '-t', 'y', '-n', 'WGCNA', '-w', '6', '-c', 'WGCNA'])
+            expected = dict(run.read_table('clusters.tsv'))
+            modules, stats = coex_cluster.detect_modules(values, 'WGCNA', 'WGCNA', 6, workdir=run.path('clstr'),
+                                                         tree_cut=r_tree_cut(run))
+        finally:
+            run.cleanup()
+        self.assertEqual(dict(zip(row_ids, modules)), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
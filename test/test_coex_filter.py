@@ -0,0 +1,178 @@
+import unittest
+
+import numpy as np
+from scipy import stats
+
+import biokbase.CoExpression.coex_filter as coex_filter
+from helpers import load_matrix, recorded_output, record_output, requires_recorded, requires_r, RRun
+
+# coex_filter -n 100 selected.tsv of E_coli_v4_Build_6_impute_1 with method anova
+ANOVA_SELECTED = 'coex_filter_anova_E_coli_v4_Build_6_impute_1_100.tsv'
+# coex_filter -n 50 selected.tsv of GSE71046_maizeRNAseq_top500 with method lor
+LOR_SELECTED = 'coex_filter_lor_GSE71046_maizeRNAseq_top500_50.tsv'
+
+
+class SelectGenesTest(unittest.TestCase):
+    # expected positions are coex_filter's genelist[which(order(p) <= n)], worked by hand
+
+    def test_order_le_is_not_top_n(self):
+        # order(c(0.5, 0.1, 0.3, 0.2)) = 2 4 3 1; which(. <= 2) = 1 4
+        p = [0.5, 0.1, 0.3, 0.2]
+        self.assertEqual(coex_filter.select_genes(p, num_features=2).tolist(), [0, 3])
+        self.assertEqual(coex_filter.select_genes(p, num_features=2, selection='top').tolist(), [1, 3])
+
+    def test_ties_follow_order(self):
+        # order(c(0.2, 0.1, 0.1, 0.3)) = 2 3 1 4; which(. <= 1) = 3
+        self.assertEqual(coex_filter.select_genes([0.2, 0.1, 0.1, 0.3], num_features=1).tolist(), [2])
+
+    def test_threshold_then_number(self):
+        # p < 0.045 keeps 2..5 with p 0.03 0.01 0.04 0.02; order = 2 4 1 3; which(. <= 2) = 1 3
+        p = [0.5, 0.03, 0.01, 0.04, 0.02]
+        self.assertEqual(coex_filter.select_genes(p, 0.045, 2).tolist(), [1, 3])
+        self.assertEqual(coex_filter.select_genes(p, 0.045, 2, selection='top').tolist(), [2, 4])
+        self.assertEqual(coex_filter.select_genes(p, 0.045).tolist(), [1, 2, 3, 4])
+
+    def test_listing_order(self):
+        # lor lists genes in topTable order; the selection keeps that order
+        p = np.array([0.3, 0.01, 0.2, 0.02])
+        order = np.array([1, 3, 2, 0])
+        self.assertEqual(coex_filter.select_genes(p, num_features=2, order=order).tolist(), [1, 3])
+
+    def test_errors(self):
+        self.assertRaises(ValueError, coex_filter.select_genes, [0.1, 0.2], None, 3)
+        self.assertRaises(ValueError, coex_filter.select_genes, [0.5, 0.6], 0.05, 1)
+        self.assertRaises(ValueError, coex_filter.select_genes, [0.1, 0.2], 0.5, 1, None, 'best')
+
+
+class PAdjustTest(unittest.TestCase):
+
+    def test_bh(self):
+        # p.adjust(c(0.001, 0.02, 0.5), 'BH') = 0.003 0.03 0.5
+        self.assertTrue(np.allclose(coex_filter.p_adjust([0.001, 0.02, 0.5], 'BH'), [0.003, 0.03, 0.5]))
+        # monotone step-up: p.adjust(c(0.01, 0.04, 0.03, 0.02), 'BH') = 0.04 0.04 0.04 0.04
+        self.assertTrue(np.allclose(coex_filter.p_adjust([0.01, 0.04, 0.03, 0.02], 'fdr'), [0.04] * 4))
+
+    def test_bonferroni_and_missing(self):
+        adjusted = coex_filter.p_adjust([0.001, np.nan, 0.02, 0.5], 'bonferroni')
+        self.assertTrue(np.isnan(adjusted[1]))
+        self.assertTrue(np.allclose(adjusted[[0, 2, 3]], [0.003, 0.06, 1.0]))
+        self.assertRaises(ValueError, coex_filter.p_adjust, [0.1], 'holm')
+
+
+class PvalueHistogramTest(unittest.TestCase):
+
+    def test_bins(self):
+        # -log2(c(1, 0.5, 0.25)) = 0 1 2 over three equal bins; missing p-values are left out
+        edges, counts = coex_filter.pvalue_histogram([1, 0.5, 0.25, np.nan], 3)
+        self.assertTrue(np.allclose(edges, [0, 2 / 3.0, 4 / 3.0, 2]))
+        self.assertEqual(counts.tolist(), [1, 1, 1])
+
+    def test_zero_pvalue_is_finite(self):
+        edges, counts = coex_filter.pvalue_histogram([0.0, 0.5])
+        self.assertTrue(np.isfinite(edges).all())
+        self.assertEqual(counts.sum(), 2)
+
+
+class AnovaTest(unittest.TestCase):
+
+    def test_matches_regression_on_sample_index(self):
+        # aov(y ~ sample_index) with a numeric index is the slope test of a simple regression
+        rs = np.random.RandomState(1)
+        values = rs.normal(size=(20, 6))
+        values[3, 2] = np.nan
+        fstat, p = coex_filter.anova_pvalues(values, range(6))
+        x = np.tile(np.arange(1, 7, dtype=float), 2)
+        for i in range(values.shape[0]):
+            y = np.concatenate([values[i], values[i]])
+            ok = ~np.isnan(y)
+            self.assertAlmostEqual(p[i], stats.linregress(x[ok], y[ok])[3], places=10)
+
+    def test_constant_gene_is_na(self):
+        fstat, p = coex_filter.anova_pvalues(np.array([[1.0, 1.0, 1.0], [1.0, 2.0, 4.0]]))
+        self.assertEqual(p[0], coex_filter.NA_PVALUE)
+        self.assertTrue(p[1] < 1)
+
+
+class LorTest(unittest.TestCase):
+
+    def test_design(self):
+        # coex_filter's DES repeats each unique index by its count (S1 S1 S2 S2 S10 S10, not
+        # the column order) and model.matrix(~DES) sorts the levels as strings: S1 S10 S2
+        design = coex_filter.lor_design(np.array([1, 2, 10, 1, 2, 10], dtype=float))
+        self.assertEqual(design[:, 1].tolist(), [0, 0, 0, 0, 1, 1])
+        self.assertEqual(design[:, 2].tolist(), [0, 0, 1, 1, 0, 0])
+
+    def test_trigamma_inverse(self):
+        from scipy import special
+        for y in [0.3, 2.0, 15.0]:
+            self.assertAlmostEqual(coex_filter._trigamma_inverse(special.polygamma(1, y)), y, places=6)
+
+    def test_fit_f_dist_recovers_prior(self):
+        # sigma2 ~ s0^2 chi2(d0)/d0 * F(df, d0) moments give back d0 and s0^2
+        rs = np.random.RandomState(2)
+        df = np.repeat(4.0, 200000)
+        s2 = 0.5 * rs.chisquare(4, len(df)) / 4 / (rs.chisquare(10, len(df)) / 10)
+        s20, d0 = coex_filter._fit_f_dist(s2, df)
+        self.assertAlmostEqual(s20, 0.5, delta=0.02)
+        self.assertAlmostEqual(d0, 10, delta=1)
+
+    def test_ranking(self):
+        rs = np.random.RandomState(3)
+        values = rs.normal(size=(200, 4))
+        # the duplicated columns are labelled S1 S1 S2 S2 ..., so coefficient S2 contrasts columns 3-4 with 1-2
+        values[:10, 2:4] += 10
+        res = coex_filter.lor_stats(values, range(4))
+        self.assertTrue(set(res['order'][:10].tolist()) == set(range(10)))
+        self.assertTrue(np.all(np.diff(res['lods'][res['order']]) <= 0))
+
+
+class CoexFilterRTest(unittest.TestCase):
+    # regression against coex_filter.R on the filter_genes test input
+
+    def native_genes(self, row_ids, values, method, num_features):
+        if method == 'anova':
+            stat, pvalues = coex_filter.anova_pvalues(values, range(values.shape[1]))
+            order = None
+        else:
+            pvalues, order = coex_filter.lor_pvalues(values, range(values.shape[1]))
+        return [row_ids[i] for i in coex_filter.select_genes(pvalues, None, num_features, order)]
+
+    def r_genes(self, row_ids, col_ids, values, method, num_features):
+        run = RRun()
+        try:
+            run.write_matrix('expression.tsv', row_ids, col_ids, values)
+            run.write_sample('sample.tsv', len(col_ids))
+            run.run('coex_filter.R', ['-i', 'expression.tsv', '-o', 'filtered.tsv', '-m', method, '-s', 'sample.tsv',
+                                      '-x', 'selected.tsv', '-t', 'y', '-n', str(num_features)])
+            with open(run.path('selected.tsv')) as fh:
+                return [x.strip('\n') for x in fh.readlines()]
+        finally:
+            run.cleanup()
+
+    @requires_r('optparse', 'jsonlite')
+    def test_anova(self):
+        row_ids, col_ids, values = load_matrix('E_coli_v4_Build_6_impute_1')
+        expected = self.r_genes(row_ids, col_ids, values, 'anova', 100)
+        record_output(ANOVA_SELECTED, expected)
+        self.assertEqual(self.native_genes(row_ids, values, 'anova', 100), expected)
+
+    @requires_recorded(ANOVA_SELECTED)
+    def test_anova_recorded(self):
+        row_ids, col_ids, values = load_matrix('E_coli_v4_Build_6_impute_1')
+        self.assertEqual(self.native_genes(row_ids, values, 'anova', 100), recorded_output(ANOVA_SELECTED))
+
+    @requires_r('optparse', 'jsonlite', 'limma')
+    def test_lor(self):
+        row_ids, col_ids, values = load_matrix('GSE71046_maizeRNAseq_top500')
+        expected = self.r_genes(row_ids, col_ids, values, 'lor', 50)
+        record_output(LOR_SELECTED, expected)
+        self.assertEqual(self.native_genes(row_ids, values, 'lor', 50), expected)
+
+    @requires_recorded(LOR_SELECTED)
+    def test_lor_recorded(self):
+        row_ids, col_ids, values = load_matrix('GSE71046_maizeRNAseq_top500')
+        self.assertEqual(self.native_genes(row_ids, values, 'lor', 50), recorded_output(LOR_SELECTED))
+
+
+if __name__ == '__main__':
+    unittest.main()
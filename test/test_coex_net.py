@@ -0,0 +1,166 @@
+import unittest
+
+import numpy as np
+from scipy import stats
+
+import biokbase.CoExpression.coex_net as coex_net
+from helpers import load_matrix, requires_r, RRun
+
+
+def fit_index(k, nbreaks=10):
+    # WGCNA scaleFreeFitIndex for one connectivity vector, step by step
+    dx = k.max() - k.min()
+    breaks = np.linspace(k.min(), k.max(), nbreaks + 1)
+    breaks[0] -= dx / 1000
+    breaks[-1] += dx / 1000
+    bins = np.digitize(k, breaks[1:-1], right=True)
+    # hist(k, seq(min(k), max(k), length = nbreaks + 1))$mids
+    edges = np.linspace(k.min(), k.max(), nbreaks + 1)
+    mids = (edges[:-1] + edges[1:]) / 2
+    dk = np.array([k[bins == b].mean() if (bins == b).any() else mids[b] for b in range(nbreaks)])
+    dk[dk == 0] = mids[dk == 0]
+    pk = np.array([(bins == b).sum() for b in range(nbreaks)]) / float(len(k))
+    x, y = np.log10(dk), np.log10(pk + 1e-9)
+    slope, intercept = np.polyfit(x, y, 1)
+    rsq = np.corrcoef(x, y)[0, 1] ** 2
+    design = np.column_stack([np.ones(nbreaks), x, dk])
+    resid = y - design.dot(np.linalg.lstsq(design, y, rcond=None)[0])
+    rsq2 = 1 - (resid ** 2).sum() / ((y - y.mean()) ** 2).sum()
+    return rsq, slope, 1 - (1 - rsq2) * (nbreaks - 1) / float(nbreaks - 3)
+
+
+class CorrelationEdgesTest(unittest.TestCase):
+
+    def test_known_value(self):
+        # cor(1:4, c(1, 3, 2, 4)) = 0.8
+        net = coex_net.correlation_edges([[1, 2, 3, 4], [1, 3, 2, 4], [4, 3, 2, 1]], 0.5)
+        self.assertEqual(net.nnz, 1)
+        self.assertAlmostEqual(net[0, 1], 0.8)
+
+    def test_tiles_match_dense(self):
+        rs = np.random.RandomState(4)
+        values = rs.normal(size=(57, 8))
+        values[:20] += rs.normal(size=8)
+        r = np.corrcoef(values)
+        expected = np.triu(np.where(r > 0.3, r, 0), 1)
+        for block_size in [7, 16, 57, 100]:
+            net = coex_net.correlation_edges(values, 0.3, block_size)
+            self.assertTrue(np.allclose(net.toarray(), expected))
+
+    def test_missing_and_constant_rows(self):
+        # missing values take the row mean, constant rows correlate 0 with every gene
+        values = np.array([[1.0, 2.0, np.nan, 4.0], [1.0, 2.0, 3.0, 4.0], [5.0, 5.0, 5.0, 5.0]])
+        z = coex_net.standardize(values)
+        self.assertAlmostEqual(z[0].dot(z[1]), np.corrcoef([1, 2, 7 / 3.0, 4], [1, 2, 3, 4])[0, 1])
+        self.assertEqual(np.abs(z[2]).sum(), 0)
+
+    def test_float32(self):
+        rs = np.random.RandomState(5)
+        values = rs.normal(size=(30, 6))
+        net64 = coex_net.correlation_edges(values, -1.0, 8)
+        net32 = coex_net.correlation_edges(values, -1.0, 8, dtype=np.float32)
+        self.assertTrue(np.allclose(net32.toarray(), net64.toarray(), atol=1e-5))
+
+
+def bicor(x, y):
+    # biweight midcorrelation as WGCNA's bicor defines it
+    def weighted(v):
+        u = (v - np.median(v)) / (9 * np.median(np.abs(v - np.median(v))))
+        w = np.where(np.abs(u) < 1, (1 - u * u) ** 2, 0)
+        t = (v - np.median(v)) * w
+        return t / np.sqrt((t * t).sum())
+    return weighted(x).dot(weighted(y))
+
+
+class KernelTest(unittest.TestCase):
+
+    def test_rank_rows(self):
+        # rank(c(3, 1, 3, NA, 2), na.last = 'keep') = 3.5 1 3.5 NA 2
+        ranks = coex_net.rank_rows([[3, 1, 3, np.nan, 2], [np.nan] * 5, [5, 4, 3, 2, 1]])
+        self.assertEqual(ranks[0, [0, 1, 2, 4]].tolist(), [3.5, 1, 3.5, 2])
+        self.assertTrue(np.isnan(ranks[0, 3]) and np.isnan(ranks[1]).all())
+        self.assertEqual(ranks[2].tolist(), [5, 4, 3, 2, 1])
+
+    def test_rank_rows_matches_rankdata(self):
+        rs = np.random.RandomState(10)
+        values = rs.randint(0, 4, size=(50, 9)).astype(float)
+        values[rs.uniform(size=values.shape) < 0.2] = np.nan
+        ranks = coex_net.rank_rows(values)
+        for i in range(values.shape[0]):
+            ok = ~np.isnan(values[i])
+            self.assertEqual(ranks[i, ok].tolist(), stats.rankdata(values[i, ok]).tolist())
+            self.assertTrue(np.isnan(ranks[i, ~ok]).all())
+
+    def test_spearman(self):
+        rs = np.random.RandomState(11)
+        values = rs.normal(size=(6, 10))
+        values[0, 3] = values[0, 4]
+        z = coex_net.kernel_rows(values, 'spearman')
+        self.assertTrue(np.allclose(z.dot(z.T), stats.spearmanr(values, axis=1)[0]))
+
+    def test_bicor(self):
+        rs = np.random.RandomState(12)
+        values = rs.normal(size=(5, 12))
+        values[1, 2] = 40
+        z = coex_net.kernel_rows(values, 'bicor')
+        for i in range(5):
+            for j in range(5):
+                self.assertAlmostEqual(z[i].dot(z[j]), bicor(values[i], values[j]))
+
+    def test_bicor_zero_mad_falls_back_to_pearson(self):
+        values = np.array([[1.0, 1.0, 1.0, 1.0, 5.0], [2.0, 1.0, 3.0, 4.0, 6.0]])
+        z = coex_net.kernel_rows(values, 'bicor')
+        self.assertAlmostEqual(z[0].dot(coex_net.standardize(values)[1]), np.corrcoef(values)[0, 1])
+
+
+class SoftThresholdTest(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(6)
+        self.values = rs.normal(size=(80, 10))
+        self.values[:30] += 2 * rs.normal(size=10)
+
+    def test_connectivity_matches_dense(self):
+        a = (1 + np.corrcoef(self.values)) / 2
+        np.fill_diagonal(a, 0)
+        powers = [1, 2, 3, 5, 8]
+        k = coex_net.connectivity(self.values, powers, block_size=13)
+        for j, p in enumerate(powers):
+            self.assertTrue(np.allclose(k[:, j], (a ** p).sum(axis=1)))
+
+    def test_scale_free_fit_matches_single_fits(self):
+        k = coex_net.connectivity(self.values, range(1, 11))
+        rsq, slope, adj_rsq = coex_net.scale_free_fit(k)
+        for j in range(k.shape[1]):
+            expected = fit_index(k[:, j])
+            self.assertAlmostEqual(rsq[j], expected[0])
+            self.assertAlmostEqual(slope[j], expected[1])
+            self.assertAlmostEqual(adj_rsq[j], expected[2])
+
+    def test_selection_rule(self):
+        power, table = coex_net.pick_soft_threshold(self.values, 20, 0.5, 40)
+        ok = [r > 0.5 and m <= 40 for r, m in zip(table['SFT.R.sq'], table['median.k.'])]
+        self.assertEqual(power, table['Power'][ok.index(True)])
+        self.assertEqual(sorted(table.keys()), sorted(coex_net.SFT_COLUMNS))
+        self.assertRaises(ValueError, coex_net.pick_soft_threshold, self.values, 3, 1.0)
+
+    @requires_r('WGCNA')
+    def test_pick_soft_threshold_r(self):
+        row_ids, col_ids, values = load_matrix('GSE71046_maizeRNAseq_top500')
+        run = RRun()
+        try:
+            run.write_matrix('expression.tsv', row_ids, col_ids, values)
+            run.eval("suppressPackageStartupMessages(library(WGCNA));"
+                     "d <- t(read.table('expression.tsv', header=TRUE, row.names=1, sep='\\t', check.names=FALSE));"
+                     "sft <- pickSoftThreshold(d, powerVector=1:20, networkType='signed', verbose=0);"
+                     "write.table(sft$fitIndices, 'sft.tsv', sep='\\t', quote=FALSE, row.names=FALSE)")
+            expected = np.array(run.read_table('sft.tsv'), dtype=float)
+        finally:
+            run.cleanup()
+        power, table = coex_net.pick_soft_threshold(values, 20)
+        for j, column in enumerate(coex_net.SFT_COLUMNS):
+            self.assertTrue(np.allclose(table[column], expected[:, j], rtol=1e-6), column)
+
+
+if __name__ == '__main__':
+    unittest.main()
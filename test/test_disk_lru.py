@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from biokbase.CoExpression.disk_lru import DiskLRU
+
+
+def writer(text):
+    def write(tmp):
+        with open(tmp, 'w') as fh:
+            fh.write(text)
+    return write
+
+
+class DiskLRUTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='coex_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def path(self, name, suffix):
+        return os.path.join(self.dir, name + suffix)
+
+    def test_write(self):
+        store = DiskLRU(os.path.join(self.dir, 'new'), 1000, '.json', ['.npy'])
+        store.write([(os.path.join(store.cache_dir, 'a.npy'), writer('values')),
+                     (os.path.join(store.cache_dir, 'a.json'), writer('{}'))])
+        self.assertEqual(sorted(os.listdir(store.cache_dir)), ['a.json', 'a.npy'])
+
+    def test_evicts_least_recently_used(self):
+        store = DiskLRU(self.dir, 0, '.json', ['.npy'])
+        for i, name in enumerate(['a', 'b', 'c']):
+            for suffix in ['.npy', '.json']:
+                writer('x' * 100)(self.path(name, suffix))
+            os.utime(self.path(name, '.json'), (i, i))
+        store.touch(self.path('a', '.json'))  # now the most recently used
+        writer('partial')(self.path('.tmp_d', '.json'))
+        store.max_bytes = 400  # two entries of a .json and its .npy
+        store.evict()
+        self.assertEqual(sorted(os.listdir(self.dir)), ['.tmp_d.json', 'a.json', 'a.npy', 'c.json', 'c.npy'])
+        store.max_bytes = 399
+        store.evict()
+        self.assertEqual(sorted(os.listdir(self.dir)), ['.tmp_d.json', 'a.json', 'a.npy'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import json
+import unittest
+
+import numpy as np
+
+import biokbase.CoExpression.expr_stream as expr_stream
+
+
+def response(data):
+    return json.dumps({'version': '1.1', 'result': [[{'data': data, 'info': []}]]})
+
+
+def chunks(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class DecodeObjectTest(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(13)
+        self.values = rs.normal(size=(7, 3))
+        self.values[2, 1] = np.nan
+        rows = [[None if np.isnan(x) else x for x in row] for row in self.values.tolist()]
+        self.data = {'type': 'level', 'data': {'row_ids': ['g{0}'.format(i) for i in range(7)],
+                                               'col_ids': ['a', 'b', 'c'], 'values': rows}}
+
+    def check(self, text, size):
+        data = expr_stream.decode_object(chunks(text, size))
+        self.assertEqual(data['type'], 'level')
+        self.assertEqual(data['data']['row_ids'], self.data['data']['row_ids'])
+        values = data['data']['values']
+        self.assertEqual(values.shape, (7, 3))
+        self.assertTrue(np.array_equal(np.isnan(values), np.isnan(self.values)))
+        self.assertTrue(np.array_equal(values[~np.isnan(values)], self.values[~np.isnan(self.values)]))
+
+    def test_any_chunking(self):
+        # keys, rows and numbers split at every position
+        text = response(self.data)
+        for size in [1, 2, 3, 5, 7, 64, len(text)]:
+            self.check(text, size)
+
+    def test_compact_separators_and_order(self):
+        text = json.dumps({'version': '1.1', 'result': [[{'data': self.data}]]}, separators=(',', ':'))
+        self.check(text, 4)
+        # row_ids after values: no preallocation, the array grows
+        self.data['data'] = dict((k, self.data['data'][k]) for k in ['values', 'row_ids', 'col_ids'])
+        self.check(response(self.data), 3)
+
+    def test_empty_values(self):
+        data = expr_stream.decode_object(chunks(response({'data': {'row_ids': [], 'col_ids': [], 'values': []}}), 3))
+        self.assertEqual(data['data']['values'].shape, (0, 0))
+
+    def test_errors(self):
+        error = json.dumps({'version': '1.1', 'error': {'message': 'Object not found'}})
+        self.assertRaises(Exception, expr_stream.decode_object, [error])
+        self.assertRaises(ValueError, expr_stream.decode_object, chunks(response(self.data), 10)[:-3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+
+import numpy as np
+
+import biokbase.CoExpression.filtered_view as filtered_view
+
+
+def source(ref):
+    return {'type': 'level', 'data': {'row_ids': ['g0', 'g1', 'g2', 'g3'], 'col_ids': ['c1', 'c2'],
+                                      'values': [[0, 1], [2, 3], [4, 5], [6, 7]]}}
+
+
+class FilteredViewTest(unittest.TestCase):
+
+    def test_materializes_rows_in_view_order(self):
+        loads = []
+        view = filtered_view.FilteredView(filtered_view.view_object('1/2/3', [3, 1], 'top'),
+                                          lambda ref: loads.append(ref) or source(ref))
+        self.assertEqual(loads, [])
+        expr = view.expression_matrix()
+        self.assertEqual(loads, ['1/2/3'])
+        self.assertEqual(expr['data']['row_ids'], ['g3', 'g1'])
+        self.assertTrue(np.array_equal(expr['data']['values'], [[6, 7], [2, 3]]))
+        self.assertEqual(expr['description'], 'top')
+        view.expression_matrix()
+        self.assertEqual(loads, ['1/2/3'])
+
+    def test_source_rows(self):
+        # rows selected from a view are positions in its source
+        view = filtered_view.FilteredView(filtered_view.view_object('1/2/3', [3, 1, 0]), source)
+        self.assertEqual(view.source_rows([2, 0]), [0, 3])
+        self.assertEqual(view.source_ref(), '1/2/3')
+
+    def test_versioned_source(self):
+        self.assertRaises(ValueError, filtered_view.view_object, '1/2', [0])
+        self.assertTrue(filtered_view.is_view_type(filtered_view.VIEW_TYPE + '-1.0'))
+        self.assertFalse(filtered_view.is_view_type('KBaseFeatureValues.ExpressionMatrix-1.0'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from biokbase.CoExpression.matrix_cache import MatrixCache
+
+
+def matrix(nrow):
+    return {'type': 'level', 'data': {'row_ids': ['g{0}'.format(i) for i in range(nrow)], 'col_ids': ['c1', 'c2'],
+                                      'values': [[float(i), None] for i in range(nrow)]}}
+
+
+class MatrixCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='coex_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_round_trip(self):
+        cache = MatrixCache(self.dir)
+        self.assertEqual(cache.get('1/2/3'), None)
+        cache.put('1/2/3', matrix(3))
+        expr = cache.get('1/2/3')
+        self.assertEqual(expr['type'], 'level')
+        self.assertEqual(expr['data']['row_ids'], ['g0', 'g1', 'g2'])
+        self.assertTrue(isinstance(expr['data']['values'], np.memmap))
+        self.assertEqual(expr['data']['values'][:, 0].tolist(), [0, 1, 2])
+        self.assertTrue(np.isnan(expr['data']['values'][:, 1]).all())
+
+    def test_key_is_the_version(self):
+        # a new version of the object is a different entry, so stored data never goes stale
+        cache = MatrixCache(self.dir)
+        cache.put('1/2/3', matrix(3))
+        self.assertEqual(cache.get('1/2/4'), None)
+        self.assertEqual(cache.key('1/2/3'), '1_2_3')
+        self.assertRaises(ValueError, cache.key, 'ws/name')
+        self.assertRaises(ValueError, cache.key, '1/2')
+
+    def test_disabled_and_damaged(self):
+        cache = MatrixCache(self.dir, 0)
+        cache.put('1/2/3', matrix(3))
+        self.assertEqual(os.listdir(self.dir), [])
+        cache = MatrixCache(self.dir)
+        cache.put('1/2/3', matrix(3))
+        with open(cache.paths('1/2/3')[1], 'w') as fh:
+            fh.write('{')
+        self.assertEqual(cache.get('1/2/3'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
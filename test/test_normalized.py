@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import biokbase.CoExpression.normalized as normalized
+from biokbase.CoExpression.normalized import NormalizedStore
+
+
+class NormalizedMatrixTest(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(14)
+        self.values = rs.normal(size=(12, 7))
+        self.values[3, 2] = np.nan
+
+    def test_correlation(self):
+        nm = normalized.NormalizedMatrix(normalized.transform(self.values, 'pearson'), 'pearson')
+        r = nm.correlation([0, 1, 2])
+        self.assertAlmostEqual(r[0, 1], np.corrcoef(self.values[0], self.values[1])[0, 1])
+        self.assertEqual(nm.correlation([0, 1], [4, 5, 6]).shape, (2, 3))
+
+    def test_mean_correlation(self):
+        # mean of the correlation block, diagonal included
+        nm = normalized.NormalizedMatrix(normalized.transform(self.values, 'pearson'), 'pearson')
+        positions = [0, 2, 5, 7]
+        self.assertAlmostEqual(nm.mean_correlation(positions), nm.correlation(positions).mean())
+        self.assertTrue(np.isnan(nm.mean_correlation([])))
+
+    def test_l2(self):
+        z = normalized.l2_rows([[3.0, 4.0], [0.0, 0.0], [np.nan, 2.0]])
+        self.assertEqual(z[0].tolist(), [0.6, 0.8])
+        self.assertTrue(np.isnan(z[1]).all())
+        self.assertEqual(z[2, 1], 1.0)
+        nm = normalized.NormalizedMatrix(z, 'l2')
+        self.assertRaises(ValueError, nm.mean_correlation, [0])
+
+
+class NormalizedStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='coex_test_')
+        rs = np.random.RandomState(15)
+        self.values = rs.normal(size=(20, 6))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_path_key(self):
+        store = NormalizedStore(self.dir)
+        fn = os.path.basename(store.path('1/2/3', 'bicor', np.float32))
+        self.assertEqual(fn, '1_2_3_bicor_float32.v{0}.npy'.format(normalized.FORMAT_VERSION))
+        self.assertNotEqual(store.path('1/2/4', 'bicor'), store.path('1/2/3', 'bicor'))
+        self.assertNotEqual(store.path('1/2/3', 'pearson'), store.path('1/2/3', 'bicor'))
+        self.assertRaises(ValueError, store.path, 'ws/name', 'pearson')
+        self.assertRaises(ValueError, store.path, '1/2', 'pearson')
+        self.assertRaises(ValueError, store.path, '1/2/3', 'kendall')
+
+    def test_load_stores_once(self):
+        store = NormalizedStore(self.dir)
+        self.assertEqual(store.get('1/2/3', 'pearson'), None)
+        nm = store.load('1/2/3', 'pearson', self.values)
+        stored = store.load('1/2/3', 'pearson', None)  # read back without the values
+        self.assertTrue(isinstance(stored.z, np.memmap))
+        self.assertTrue(np.array_equal(stored.rows([4, 1]), nm.z[[4, 1]]))
+        self.assertEqual(store.get('1/2/3', 'pearson', np.float32), None)
+
+    def test_format_version_invalidates(self):
+        store = NormalizedStore(self.dir)
+        store.load('1/2/3', 'spearman', self.values)
+        version = normalized.FORMAT_VERSION
+        normalized.FORMAT_VERSION = version + 1
+        try:
+            self.assertEqual(store.get('1/2/3', 'spearman'), None)
+        finally:
+            normalized.FORMAT_VERSION = version
+        self.assertNotEqual(store.get('1/2/3', 'spearman'), None)
+
+    def test_disabled(self):
+        store = NormalizedStore(self.dir, 0)
+        nm = store.load('1/2/3', 'l2', self.values)
+        self.assertEqual(nm.z.shape, self.values.shape)
+        self.assertEqual(os.listdir(self.dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import biokbase.CoExpression.result_cache as result_cache
+from biokbase.CoExpression.result_cache import ResultCache
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='coex_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_key(self):
+        cache = ResultCache(self.dir)
+        key = cache.key('1/2/3', 'filter_genes', {'method': 'anova', 'num_features': 5})
+        # scalars compare as strings, and the parameter order does not matter
+        self.assertEqual(cache.key('1/2/3', 'filter_genes', {'num_features': '5', 'method': 'anova'}), key)
+        self.assertNotEqual(cache.key('1/2/4', 'filter_genes', {'method': 'anova', 'num_features': 5}), key)
+        self.assertNotEqual(cache.key('1/2/3', 'const_coex_net_clust', {'method': 'anova', 'num_features': 5}), key)
+        self.assertNotEqual(cache.key('1/2/3', 'filter_genes', {'method': 'lor', 'num_features': 5}), key)
+        self.assertEqual(cache.key(['1/2/3', '1/5/1'], 'view_heatmap', {}),
+                         cache.key(['1/2/3', '1/5/1'], 'view_heatmap', {}))
+
+    def test_engine_version_invalidates(self):
+        cache = ResultCache(self.dir)
+        param = {'method': 'anova'}
+        key = cache.key('1/2/3', 'filter_genes', param)
+        cache.put(key, {'rows': [1, 2]})
+        version = result_cache.ENGINE_VERSION
+        result_cache.ENGINE_VERSION = version + 1
+        try:
+            self.assertEqual(cache.get(cache.key('1/2/3', 'filter_genes', param)), None)
+        finally:
+            result_cache.ENGINE_VERSION = version
+        self.assertEqual(cache.get(key), {'rows': [1, 2]})
+
+    def test_round_trip(self):
+        cache = ResultCache(self.dir)
+        self.assertEqual(cache.get('k'), None)
+        cache.put('k', {'rows': np.arange(3), 'power': np.int64(6), 'clusters': [['1', ['g1', 'g2']]]})
+        self.assertEqual(cache.get('k'), {'rows': [0, 1, 2], 'power': 6, 'clusters': [['1', ['g1', 'g2']]]})
+        self.assertEqual([fn for fn in os.listdir(self.dir) if fn.startswith('.tmp_')], [])
+
+    def test_disabled_and_damaged(self):
+        cache = ResultCache(self.dir, 0)
+        cache.put('k', {'rows': [1]})
+        self.assertEqual(os.listdir(self.dir), [])
+        self.assertEqual(cache.get('k'), None)
+        cache = ResultCache(self.dir)
+        cache.put('k', {'rows': [1]})
+        with open(cache.path('k'), 'w') as fh:
+            fh.write('{')
+        self.assertEqual(cache.get('k'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import threading
+import time
+import unittest
+
+import numpy as np
+
+import biokbase.CoExpression.series as series
+
+
+class Levels(dict):
+    """Sample data noting when the matrix takes its expression_levels."""
+
+    def __init__(self, service, *args):
+        dict.__init__(self, *args)
+        self.service = service
+
+    def pop(self, key, *args):
+        if key == 'expression_levels':
+            self.service.taken()
+        return dict.pop(self, key, *args)
+
+
+class SampleService(object):
+    """Workspace stand-in recording the chunks fetched but not yet added, and the client threads."""
+
+    def __init__(self, nsamples, chunk_size, delay=0):
+        self.chunk_size = chunk_size
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.live = []  # samples fetched and not yet added, per chunk
+        self.max_live = 0
+        self.clients = []
+
+    def new_client(self):
+        service = self
+        owner = threading.current_thread()
+
+        class Client(object):
+            def get_objects(self, refs):
+                assert threading.current_thread() is owner
+                with service.lock:
+                    service.live.append(len(refs))
+                    service.max_live = max(service.max_live, len(service.live))
+                return [{'data': Levels(service, {'source_id': r['ref'],
+                                                  'expression_levels': {'g1': float(r['ref']), 'g2': 1.0}})}
+                        for r in refs]
+        with self.lock:
+            self.clients.append(owner)
+        return Client()
+
+    def taken(self):
+        time.sleep(self.delay)  # a matrix slower than the fetches
+        with self.lock:
+            self.live[0] -= 1
+            if self.live[0] == 0:
+                self.live.pop(0)
+
+
+class FetchSampleMatrixTest(unittest.TestCase):
+
+    def test_matrix(self):
+        service = SampleService(23, 5)
+        refs = [{'ref': str(i)} for i in range(23)]
+        samples, gids, values = series.fetch_sample_matrix(service.new_client, refs, 5, 3)
+        self.assertEqual([s['data']['source_id'] for s in samples], [r['ref'] for r in refs])
+        self.assertEqual(gids, ['g1', 'g2'])
+        self.assertTrue(np.array_equal(values[0], np.arange(23)))
+
+    def test_bounded_chunks_and_own_clients(self):
+        service = SampleService(60, 2, delay=0.001)
+        refs = [{'ref': str(i)} for i in range(60)]
+        series.fetch_sample_matrix(service.new_client, refs, 2, 3)
+        self.assertTrue(service.max_live <= 3)
+        self.assertTrue(len(service.clients) <= 3)
+        self.assertEqual(len(set(service.clients)), len(service.clients))
+
+    def test_error(self):
+        def new_client():
+            raise IOError('workspace down')
+        self.assertRaises(IOError, series.fetch_sample_matrix, new_client, [{'ref': '1'}, {'ref': '2'}], 1, 2)
+        samples, gids, values = series.fetch_sample_matrix(new_client, [], 1, 2)
+        self.assertEqual(values.shape, (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
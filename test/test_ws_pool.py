@@ -0,0 +1,113 @@
+import json
+import sys
+import types
+import unittest
+
+import requests
+
+import biokbase
+
+
+def _workspace_client_stub():
+    # the generated Workspace client ships with the module image; outside it stand in the
+    # generated CoExpression client, which comes from the same template
+    import biokbase.CoExpression.Client as generated
+
+    class Workspace(generated.CoExpression):
+        pass
+
+    package = types.ModuleType('biokbase.workspace')
+    client = types.ModuleType('biokbase.workspace.client')
+    client.Workspace = Workspace
+    client.ServerError = generated.ServerError
+    client._JSONObjectEncoder = generated._JSONObjectEncoder
+    package.client = client
+    sys.modules['biokbase.workspace'] = package
+    sys.modules['biokbase.workspace.client'] = client
+    biokbase.workspace = package
+    return client
+
+
+try:
+    import biokbase.workspace.client as ws_client
+except ImportError:
+    ws_client = _workspace_client_stub()
+
+import biokbase.CoExpression.ws_pool as ws_pool
+from biokbase.CoExpression.token_cache import TokenCache
+
+
+class Response(object):
+
+    def __init__(self, status_code, body, content_type='application/json'):
+        self.status_code = status_code
+        self.text = json.dumps(body)
+        self.headers = {'content-type': content_type}
+
+    def raise_for_status(self):
+        raise requests.HTTPError(str(self.status_code), response=self)
+
+
+class WorkspacePoolTest(unittest.TestCase):
+
+    def test_generated_client(self):
+        pool = ws_pool.get_pool('http://localhost:7058/pooled', 3, 60)
+        self.assertTrue(ws_pool.get_pool('http://localhost:7058/pooled') is pool)
+        ws = pool.client('token')
+        self.assertTrue(isinstance(ws, ws_client.Workspace))
+        self.assertTrue(ws.session is pool.session)
+        self.assertEqual(ws.timeout, 60)
+        self.assertEqual(ws._headers['AUTHORIZATION'], 'token')
+
+    def test_calls_use_the_pooled_session(self):
+        pool = ws_pool.WorkspacePool('http://localhost:7058/posts')
+        posts = []
+
+        def post(url, data=None, headers=None, **kwargs):
+            posts.append((url, json.loads(data), headers))
+            return Response(200, {'result': ['0.8.0']})
+        pool.session.post = post
+        self.assertEqual(pool.client('token')._call('Workspace.ver', []), ['0.8.0'])
+        url, body, headers = posts[0]
+        self.assertEqual((url, body['method'], body['params'], headers['AUTHORIZATION']),
+                         ('http://localhost:7058/posts', 'Workspace.ver', [], 'token'))
+        # the generated module is not patched
+        self.assertTrue(getattr(ws_client, '_requests', requests) is requests)
+
+    def test_server_error(self):
+        pool = ws_pool.WorkspacePool('http://localhost:7058/errors')
+        error = {'name': 'JSONRPCError', 'code': -32500, 'message': 'No object with name x exists'}
+        pool.session.post = lambda url, **kwargs: Response(500, {'error': error})
+        with self.assertRaises(ws_client.ServerError) as cm:
+            pool.client('token')._call('Workspace.get_objects', [[{'ref': '1/x'}]])
+        self.assertEqual(cm.exception.message, 'No object with name x exists')
+
+
+    def test_revoked_token(self):
+        # a rejected token is dropped from the user id cache by the first workspace call
+        user_cache = TokenCache(300)
+        user_cache.put('revoked', 'someone')
+        pool = ws_pool.WorkspacePool('http://localhost:7058/revoked')
+        error = {'name': 'JSONRPCError', 'code': -32400,
+                 'message': 'Token validation failed: Auth service returned an error: 10020 Invalid token'}
+        pool.session.post = lambda url, **kwargs: Response(500, {'error': error})
+        ws = pool.client('revoked', user_cache.invalidate)
+        self.assertRaises(ws_client.ServerError, ws._call, 'Workspace.get_object_info_new', [{}])
+        self.assertEqual(user_cache.get('revoked'), None)
+
+        user_cache.put('revoked', 'someone')
+        pool.session.post = lambda url, **kwargs: Response(401, {}, 'text/plain')
+        self.assertRaises(requests.HTTPError, ws._call, 'Workspace.ver', [])
+        self.assertEqual(user_cache.get('revoked'), None)
+
+    def test_other_errors_keep_the_token(self):
+        forgotten = []
+        pool = ws_pool.WorkspacePool('http://localhost:7058/missing')
+        error = {'name': 'JSONRPCError', 'code': -32500, 'message': 'No workspace with name x exists'}
+        pool.session.post = lambda url, **kwargs: Response(500, {'error': error})
+        ws = pool.client('token', forgotten.append)
+        self.assertRaises(ws_client.ServerError, ws._call, 'Workspace.get_objects', [])
+        self.assertEqual(forgotten, [])
+
+if __name__ == '__main__':
+    unittest.main()